@@ -0,0 +1,125 @@
+"""
+How long it takes to turn the rows of a chat into the body of `GET /chat`, the way it
+used to be done (validate each row on its own, then FastAPI validates the response
+against the `response_model`, turns it into dicts, and `json.dumps` them), and the way
+it's done now (validate the rows in one go, and serialize them straight to JSON bytes
+with `PydanticJSONResponse`).
+
+`model_construct`-ing the rows is there too: it skips validation, but it's slower.
+
+No DB needed, the rows are made up. From `backend/`:
+
+```zsh
+uv run python benchmarks/chat_serialization.py
+uv run python benchmarks/chat_serialization.py --num-messages 1000
+```
+"""
+
+import argparse
+import datetime
+import json
+import timeit
+from typing import Any
+
+from api.message_management import Chat, ChatInDb
+from api.responses import PydanticJSONResponse
+from backend_commons.messages import MessageInDb, messages_in_db_from_rows
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+_chat_adapter = TypeAdapter(Chat)
+
+
+def make_rows(num_messages: int) -> tuple[dict[str, Any], list[dict[str, Any]]]:
+    started_at = datetime.datetime(2025, 1, 1, tzinfo=datetime.UTC)
+    message_rows = [
+        {
+            "message_id": message_id,
+            "chat_id": 1,
+            "user_id": 1 if message_id % 2 else None,
+            "text": f"message number {message_id} " * 20,
+            "inserted_at": started_at + datetime.timedelta(seconds=message_id),
+        }
+        for message_id in range(num_messages)
+    ]
+    chat_row = {
+        "chat_id": 1,
+        "user_id": 1,
+        "title": "a long chat",
+        "last_message_timestamp": message_rows[-1]["inserted_at"],
+        "is_archived": False,
+    }
+    return chat_row, message_rows
+
+
+def serialize_like_before(
+    chat_row: dict[str, Any], message_rows: list[dict[str, Any]]
+) -> bytes:
+    chat = Chat(
+        chat_in_db=ChatInDb(**chat_row),
+        messages=[MessageInDb(**message_row) for message_row in message_rows],
+    )
+    # what FastAPI does with the returned value when the route has a `response_model`
+    content = _chat_adapter.dump_python(
+        _chat_adapter.validate_python(chat), mode="json"
+    )
+    return bytes(JSONResponse(content).body)
+
+
+def serialize_constructed(
+    chat_row: dict[str, Any], message_rows: list[dict[str, Any]]
+) -> bytes:
+    chat = Chat.model_construct(
+        chat_in_db=ChatInDb.model_construct(**chat_row),
+        messages=[
+            MessageInDb.model_construct(**message_row) for message_row in message_rows
+        ],
+    )
+    return bytes(PydanticJSONResponse(chat).body)
+
+
+def serialize_like_now(
+    chat_row: dict[str, Any], message_rows: list[dict[str, Any]]
+) -> bytes:
+    chat = Chat.model_construct(
+        chat_in_db=ChatInDb(**chat_row),
+        messages=messages_in_db_from_rows(message_rows),
+    )
+    return bytes(PydanticJSONResponse(chat).body)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-messages", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    chat_row, message_rows = make_rows(args.num_messages)
+    expected_body = json.loads(serialize_like_before(chat_row, message_rows))
+    assert json.loads(serialize_constructed(chat_row, message_rows)) == expected_body
+    assert json.loads(serialize_like_now(chat_row, message_rows)) == expected_body
+
+    print(
+        f"GET /chat of a chat with {args.num_messages} messages, best of {args.repeat}"
+    )
+    seconds_by_path = {}
+    for path_name, serialize in (
+        ("before", serialize_like_before),
+        ("constructed", serialize_constructed),
+        ("now", serialize_like_now),
+    ):
+        seconds_by_path[path_name] = min(
+            timeit.repeat(
+                lambda: serialize(chat_row, message_rows),
+                number=1,
+                repeat=args.repeat,
+            )
+        )
+        print(f"{path_name:>14}: {seconds_by_path[path_name] * 1000:8.1f} ms")
+    print(
+        f"{'speedup':>14}: {seconds_by_path['before'] / seconds_by_path['now']:8.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
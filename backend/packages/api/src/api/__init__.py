@@ -1,17 +1,27 @@
 from ._dependencies import lifespan
 from .auth import auth_router
+from .chat_websocket import chat_websocket_router
 from .chats import chats_router
 from .extensions import extensions_router
 from .providers import providers_router
+from .request_ids import RequestIdMiddleware
 from .setup import setup_router
+from .traces import traces_router
+from .tracing import TracingMiddleware
+from .usage import usage_router
 from .users import users_router
 
 __all__ = [
     "auth_router",
     "chats_router",
+    "chat_websocket_router",
     "extensions_router",
     "setup_router",
     "users_router",
     "providers_router",
+    "usage_router",
     "lifespan",
+    "RequestIdMiddleware",
+    "traces_router",
+    "TracingMiddleware",
 ]
@@ -1,25 +1,76 @@
+import asyncio
+import importlib
+import math
 import uuid
 from asyncio import wait_for
 from contextlib import asynccontextmanager
+from functools import cache
 from typing import AsyncGenerator
 
 import asyncpg
-import bcrypt
-from fastapi import FastAPI, HTTPException, Request, status
-from utils.environment import is_running_in_docker_container
+from backend_commons import run_migrations_and_start_table_managers
+from fastapi import Depends, FastAPI, HTTPException, Request, status
+from fastapi.requests import HTTPConnection
+from k4_logger import log, span
+from utils.environment import (
+    are_rate_limits_shared_across_workers,
+    get_chat_requests_per_minute,
+    is_message_group_commit_enabled,
+    is_running_in_docker_container,
+    is_startup_profiling_enabled,
+)
+from utils.startup_profiling import startup_profile
 
 from k4 import K4
 
+from .chat_generation import ChatGenerations
 from .extension_management import ExtensionsManager
 from .message_management import MessagesManager
-from .session_management import SessionsManager
+from .rate_limiting import RateLimitsManager
+from .session_management import SessionInDb, SessionsManager
+from .usage_management import UsageManager
 from .user_management import AdminUser, NonAdminUser, UsersManager
 
 users_manager = UsersManager()
 sessions_manager = SessionsManager()
 messages_manager = MessagesManager()
 extensions_manager = ExtensionsManager()
-k4 = K4()
+usage_manager = UsageManager()
+chat_generations = ChatGenerations()
+chat_rate_limits_manager = RateLimitsManager(
+    requests_per_minute=get_chat_requests_per_minute(),
+    use_shared_buckets=are_rate_limits_shared_across_workers(),
+)
+
+
+@cache
+def get_k4() -> K4:
+    """
+    Not constructed at import time, since `K4` opens its on-disk caches (and its first
+    use imports litellm, which takes seconds). The lifespan does both in a thread, see
+    `wait_until_k4_is_warmed_up`
+    """
+    return K4()
+
+
+def _warm_up_k4() -> None:
+    with startup_profile.phase("import litellm and create K4"):
+        importlib.import_module("litellm")
+        get_k4()
+
+
+_k4_warm_up: "asyncio.Task[None] | None" = None
+
+
+async def wait_until_k4_is_warmed_up() -> None:
+    """
+    The app starts serving before litellm is imported, since most routes don't need it.
+    Routers whose routes use `get_k4()` depend on this, so that their first requests
+    wait for the import instead of blocking the event loop with it
+    """
+    if _k4_warm_up is not None:
+        # shielded, since many requests may be waiting on it
+        await asyncio.shield(_k4_warm_up)
 
 
 @asynccontextmanager
@@ -49,21 +100,39 @@ async def lifespan(
     try:
         # we do this because the `finally` clause will *always* be run, even if there's an
         # error somewhere during the `yield`
-        postgres_connection_pool = await create_postgres_connection_pool()
-        await users_manager.set_connection_pool_and_run_migrations_and_start(
-            postgres_connection_pool
-        )
-        await messages_manager.set_connection_pool_and_run_migrations_and_start(
-            postgres_connection_pool
-        )
-        await extensions_manager.set_connection_pool_and_run_migrations_and_start(
-            postgres_connection_pool
-        )
-        await sessions_manager.set_connection_pool_and_run_migrations_and_start(
-            postgres_connection_pool
+        global _k4_warm_up
+        lifespan_start_time = asyncio.get_running_loop().time()
+        _k4_warm_up = asyncio.create_task(asyncio.to_thread(_warm_up_k4))
+        with startup_profile.phase("create postgres connection pool"):
+            postgres_connection_pool = await create_postgres_connection_pool()
+        with startup_profile.phase("run migrations and start the table managers"):
+            await run_migrations_and_start_table_managers(
+                postgres_connection_pool,
+                # a stage's tables may only reference tables of earlier stages
+                [
+                    [users_manager, extensions_manager, chat_rate_limits_manager],
+                    [messages_manager, sessions_manager],
+                    [usage_manager],
+                ],
+            )
+        if is_message_group_commit_enabled():
+            messages_manager.message_writer.start()
+        usage_manager.usage_writer.start()
+        startup_profile.record_phase(
+            "lifespan startup", asyncio.get_running_loop().time() - lifespan_start_time
         )
+        if is_startup_profiling_enabled():
+            _k4_warm_up.add_done_callback(
+                lambda _: log.info(startup_profile.get_report())
+            )
         yield  # everything above the yield is for startup, everything after is for shutdown
     finally:
+        # before the writers are stopped, since the generations save their responses
+        await chat_generations.stop()
+        extensions_manager.stop()
+        await sessions_manager.stop()
+        await messages_manager.message_writer.stop()
+        await usage_manager.usage_writer.stop()
         if postgres_connection_pool:
             await wait_for(
                 postgres_connection_pool.close(), 60
@@ -71,7 +140,19 @@ async def lifespan(
             # TODO I think I actually want to wait for requests to finish. do that instead
 
 
+async def share_db_connection_for_request() -> AsyncGenerator[None, None]:
+    """
+    Every `PostgresTableManager` shares one pool connection for the rest of the request,
+    instead of checking one out per query. Put this in a route's `dependencies`, which
+    are resolved before the route's parameters (e.g. the current user)
+    """
+    async with users_manager.share_connection():
+        yield
+
+
 def hash_password(password: str) -> str:
+    import bcrypt
+
     pwd_bytes = password.encode("utf-8")
     salt = bcrypt.gensalt()
     hashed_password = bcrypt.hashpw(password=pwd_bytes, salt=salt)
@@ -79,13 +160,15 @@ def hash_password(password: str) -> str:
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
+    import bcrypt
+
     return bcrypt.checkpw(
         password=plain_password.encode("utf-8"),
         hashed_password=hashed_password.encode("utf-8"),
     )
 
 
-async def get_current_active_admin_user(request: Request) -> AdminUser:
+async def get_current_active_admin_user(request: HTTPConnection) -> AdminUser:
     current_user = await get_current_active_user(request)
     if not isinstance(current_user, AdminUser):
         raise HTTPException(
@@ -95,8 +178,13 @@ async def get_current_active_admin_user(request: Request) -> AdminUser:
     return current_user
 
 
-async def get_current_active_non_admin_user(request: Request) -> NonAdminUser:
-    current_user = await get_current_active_user(request)
+async def get_current_active_non_admin_user(request: HTTPConnection) -> NonAdminUser:
+    return check_that_user_is_non_admin(await get_current_active_user(request))
+
+
+def check_that_user_is_non_admin(
+    current_user: AdminUser | NonAdminUser,
+) -> NonAdminUser:
     if not isinstance(current_user, NonAdminUser):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -105,7 +193,13 @@ async def get_current_active_non_admin_user(request: Request) -> NonAdminUser:
     return current_user
 
 
-async def get_current_active_user(request: Request) -> AdminUser | NonAdminUser:
+async def get_current_active_user(request: HTTPConnection) -> AdminUser | NonAdminUser:
+    with span("auth"):
+        session = await get_current_session(request)
+        return await users_manager.get_user_by_user_id(user_id=session.user_id)
+
+
+async def get_current_session(request: HTTPConnection) -> SessionInDb:
     session_id = request.cookies.get("sessionId")
     if not session_id:
         raise HTTPException(
@@ -115,5 +209,34 @@ async def get_current_active_user(request: Request) -> AdminUser | NonAdminUser:
     session = await sessions_manager.get_unexpired_session(
         session_id=uuid.UUID(session_id)
     )
+    sessions_manager.record_session_seen(session.session_id)
+    return session
+
+
+async def limit_chat_requests_of_user(
+    request: Request,
+    current_user: NonAdminUser = Depends(get_current_active_non_admin_user),
+) -> None:
+    """
+    Put this in a chat route's `dependencies`, before anything that does real work.
+    The user is looked up only once per request, as long as the route gets its user from
+    `get_current_active_non_admin_user` as well
+    """
+    await check_chat_rate_limit(
+        current_user.user_id, f"{request.method} {request.url.path}"
+    )
+
 
-    return await users_manager.get_user_by_user_id(user_id=session.user_id)
+async def check_chat_rate_limit(user_id: int, endpoint: str) -> None:
+    """
+    Raises a 429 if the user is sending messages too quickly through `endpoint`
+    """
+    retry_after_seconds = await chat_rate_limits_manager.try_consume(
+        f"{user_id} {endpoint}"
+    )
+    if retry_after_seconds:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="You're sending messages too quickly, please try again shortly.",
+            headers={"Retry-After": str(math.ceil(retry_after_seconds))},
+        )
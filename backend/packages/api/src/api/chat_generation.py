@@ -0,0 +1,289 @@
+import asyncio
+import uuid
+from collections import deque
+from typing import AsyncGenerator, AsyncIterator, Literal
+
+from fastapi import HTTPException, status
+from k4_logger import log, span
+from pydantic import BaseModel
+
+
+class ChatStreamError(BaseModel):
+    chunk_type: Literal["error"] = "error"
+    status_code: int
+    detail: str
+
+
+class EventsNoLongerBufferedError(Exception):
+    pass
+
+
+def parse_event_id(event_id: str) -> tuple[str, int]:
+    """
+    Raises `ValueError` if `event_id` isn't one of ours
+
+    Returns
+    -------
+    tuple[str, int]
+        The generation's id, and the event's index in the generation
+    """
+    generation_id, _, event_index = event_id.rpartition(":")
+    if not generation_id:
+        raise ValueError(f"{event_id=} is not a valid event id")
+    return generation_id, int(event_index)
+
+
+class ChatGeneration:
+    """
+    The events of one response, serialized once, whoever ends up reading them. The last
+    `max_buffered_events` are kept, so a reader can start over from any of those
+    """
+
+    def __init__(
+        self, chat_id: int, user_id: int, max_buffered_events: int = 4096
+    ) -> None:
+        self.generation_id = str(uuid.uuid4())
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.is_finished = False
+        self._buffered_events: deque[str] = deque(maxlen=max_buffered_events)
+        self._num_events = 0
+        self._has_new_events = asyncio.Event()
+
+    def get_event_id(self, event_index: int) -> str:
+        return f"{self.generation_id}:{event_index}"
+
+    def is_buffered(self, after_event_index: int) -> bool:
+        """
+        Whether every event after `after_event_index` can still be read
+        """
+        return after_event_index + 1 >= self._num_events - len(self._buffered_events)
+
+    def append(self, event: BaseModel) -> None:
+        self._buffered_events.append(event.model_dump_json())
+        self._num_events += 1
+        self._wake_readers()
+
+    def finish(self) -> None:
+        self.is_finished = True
+        self._wake_readers()
+
+    def _wake_readers(self) -> None:
+        self._has_new_events.set()
+        self._has_new_events = asyncio.Event()
+
+    async def follow(
+        self, after_event_index: int = -1
+    ) -> AsyncGenerator[tuple[str, str], None]:
+        """
+        Yields the buffered events after `after_event_index`, then the new ones as they
+        come, until the generation is finished.
+
+        Raises `EventsNoLongerBufferedError` if events after `after_event_index` have
+        already been dropped from the buffer (including while the reader is too slow)
+
+        Yields
+        ------
+        tuple[str, str]
+            The event's id, and the serialized event
+        """
+        next_event_index = after_event_index + 1
+        while True:
+            while next_event_index < self._num_events:
+                # events can be appended, shifting the buffer, while we're suspended
+                first_buffered_event_index = self._num_events - len(
+                    self._buffered_events
+                )
+                if next_event_index < first_buffered_event_index:
+                    raise EventsNoLongerBufferedError(
+                        f"{self.generation_id=} no longer has events from {next_event_index=}"
+                    )
+                yield (
+                    self.get_event_id(next_event_index),
+                    self._buffered_events[
+                        next_event_index - first_buffered_event_index
+                    ],
+                )
+                next_event_index += 1
+            if self.is_finished:
+                return
+            await self._has_new_events.wait()
+
+
+class _ChatSubscription:
+    def __init__(self, max_queued_generations: int) -> None:
+        self.queued_generations: asyncio.Queue[ChatGeneration] = asyncio.Queue(
+            maxsize=max_queued_generations
+        )
+        self.has_fallen_behind = False
+
+
+class ChatGenerations:
+    """
+    Every response being generated by this worker. A generation runs on its own rather
+    than in the request that started it, so it goes on even if its client goes away. And
+    it's kept around for `keep_finished_generations_seconds`, so that a client that lost
+    its connection can pick up where it left off, without asking the LLM again.
+
+    Any number of clients can also subscribe to a chat (e.g. the same chat open on
+    several devices), and get the events of every response generated in it. They all
+    read the same buffer, so the events are serialized once however many subscribers
+    there are. Each subscriber has its own bounded queue of the generations it has yet
+    to read, and is dropped if it falls too far behind.
+
+    ```
+    chat_generation = chat_generations.start(chat_id, user_id, events)
+    async for event_id, serialized_event in chat_generation.follow():
+        ...
+    # later, possibly after a reconnect
+    chat_generation = chat_generations.get(generation_id)
+    # or on another device
+    async for event_id, serialized_event in chat_generations.subscribe(chat_id):
+        ...
+    ```
+    """
+
+    def __init__(
+        self,
+        keep_finished_generations_seconds: float = 60.0,
+        max_buffered_events: int = 4096,
+        max_queued_generations_per_subscriber: int = 8,
+    ) -> None:
+        self.keep_finished_generations_seconds = keep_finished_generations_seconds
+        self.max_buffered_events = max_buffered_events
+        self.max_queued_generations_per_subscriber = (
+            max_queued_generations_per_subscriber
+        )
+        self._generations_by_id: dict[str, ChatGeneration] = {}
+        self._latest_generation_by_chat_id: dict[int, ChatGeneration] = {}
+        self._subscriptions_by_chat_id: dict[int, set[_ChatSubscription]] = {}
+        self._generation_tasks: set[asyncio.Task[None]] = set()
+
+    def start(
+        self, chat_id: int, user_id: int, events: AsyncIterator[BaseModel]
+    ) -> ChatGeneration:
+        chat_generation = ChatGeneration(
+            chat_id, user_id, max_buffered_events=self.max_buffered_events
+        )
+        self._generations_by_id[chat_generation.generation_id] = chat_generation
+        self._latest_generation_by_chat_id[chat_id] = chat_generation
+        for chat_subscription in self._subscriptions_by_chat_id.get(chat_id, ()):
+            try:
+                chat_subscription.queued_generations.put_nowait(chat_generation)
+            except asyncio.QueueFull:
+                chat_subscription.has_fallen_behind = True
+        generation_task = asyncio.create_task(
+            self._generate(chat_generation, events),
+            name=f"chat_generation_{chat_generation.generation_id}",
+        )
+        self._generation_tasks.add(generation_task)
+        generation_task.add_done_callback(self._generation_tasks.discard)
+        return chat_generation
+
+    def get(self, generation_id: str) -> ChatGeneration | None:
+        return self._generations_by_id.get(generation_id)
+
+    def _forget(self, chat_generation: ChatGeneration) -> None:
+        self._generations_by_id.pop(chat_generation.generation_id, None)
+        if (
+            self._latest_generation_by_chat_id.get(chat_generation.chat_id)
+            is chat_generation
+        ):
+            del self._latest_generation_by_chat_id[chat_generation.chat_id]
+
+    async def subscribe(
+        self, chat_id: int, after_event_id: str | None = None
+    ) -> AsyncGenerator[tuple[str, str], None]:
+        """
+        Yields the events of the chat's generation in progress, if any (from its start,
+        or from after `after_event_id`), then those of every generation started in the chat
+        afterwards, until the subscriber stops iterating.
+
+        Raises `EventsNoLongerBufferedError` if the subscriber falls too far behind, and
+        `ValueError` if `after_event_id` isn't a valid event id
+        """
+        chat_generation: ChatGeneration | None
+        after_event_index = -1
+        chat_subscription = _ChatSubscription(
+            self.max_queued_generations_per_subscriber
+        )
+        chat_subscriptions = self._subscriptions_by_chat_id.setdefault(chat_id, set())
+        chat_subscriptions.add(chat_subscription)
+        try:
+            if after_event_id is None:
+                chat_generation = self._latest_generation_by_chat_id.get(chat_id)
+                if chat_generation is not None and chat_generation.is_finished:
+                    # the subscriber can get that one with `GET /chat`
+                    chat_generation = None
+            else:
+                generation_id, after_event_index = parse_event_id(after_event_id)
+                chat_generation = self.get(generation_id)
+                if chat_generation is not None and chat_generation.chat_id != chat_id:
+                    raise ValueError(f"{after_event_id=} is not an event of {chat_id=}")
+            while True:
+                if chat_generation is not None:
+                    async for event in chat_generation.follow(after_event_index):
+                        yield event
+                if chat_subscription.has_fallen_behind:
+                    raise EventsNoLongerBufferedError(
+                        f"A subscriber to {chat_id=} fell too far behind"
+                    )
+                followed_chat_generation = chat_generation
+                chat_generation = await chat_subscription.queued_generations.get()
+                if chat_generation is followed_chat_generation:
+                    # started while we subscribed, so it was also the latest one
+                    chat_generation = await chat_subscription.queued_generations.get()
+                after_event_index = -1
+        finally:
+            chat_subscriptions.discard(chat_subscription)
+            if not chat_subscriptions:
+                self._subscriptions_by_chat_id.pop(chat_id, None)
+
+    async def _generate(
+        self, chat_generation: ChatGeneration, events: AsyncIterator[BaseModel]
+    ) -> None:
+        try:
+            # the generation outlives the request that started it, this span is how its
+            # trace covers the whole response
+            with span(
+                "generate response",
+                chat_id=chat_generation.chat_id,
+                generation_id=chat_generation.generation_id,
+            ):
+                async for event in events:
+                    chat_generation.append(event)
+        except HTTPException as exception:
+            chat_generation.append(
+                ChatStreamError(
+                    status_code=exception.status_code, detail=str(exception.detail)
+                )
+            )
+        except Exception:
+            log.exception(
+                f"Generating a response failed, {chat_generation.generation_id=}"
+            )
+            chat_generation.append(
+                ChatStreamError(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail="Unexpectedly failed to get a response.",
+                )
+            )
+        finally:
+            chat_generation.finish()
+            asyncio.get_running_loop().call_later(
+                self.keep_finished_generations_seconds, self._forget, chat_generation
+            )
+
+    async def stop(self, timeout_seconds: float = 30.0) -> None:
+        """
+        Lets the generations finish (and save their responses) for up to
+        `timeout_seconds`, then cancels the rest
+        """
+        if not self._generation_tasks:
+            return
+        _, pending_generation_tasks = await asyncio.wait(
+            self._generation_tasks, timeout=timeout_seconds
+        )
+        for generation_task in pending_generation_tasks:
+            generation_task.cancel()
+        await asyncio.gather(*pending_generation_tasks, return_exceptions=True)
@@ -0,0 +1,222 @@
+import asyncio
+import datetime
+import json
+import time
+from functools import partial
+from typing import Awaitable, Callable
+
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, status
+from k4_logger import get_request_id, log, trace
+from pydantic import ValidationError
+
+from ._dependencies import (
+    check_chat_rate_limit,
+    check_that_user_is_non_admin,
+    get_current_session,
+    sessions_manager,
+    users_manager,
+    wait_until_k4_is_warmed_up,
+)
+from .chat_generation import ChatStreamError, EventsNoLongerBufferedError
+from .chats import (
+    CreateNewChatRequestBody,
+    create_chat_and_get_complete_chat_for_llm,
+    get_complete_chat_for_llm_of_existing_chat,
+    start_k4_response,
+)
+
+chat_websocket_router = APIRouter()
+
+MAX_CONCURRENT_STREAMS_PER_CONNECTION = 8
+SESSION_RECHECK_INTERVAL_SECONDS = 60.0
+"""
+How long a connection trusts its session before looking it up again, to notice e.g. a
+logout elsewhere
+"""
+
+
+class ChatStreamRequest(CreateNewChatRequestBody):
+    request_id: str
+    """
+    Chosen by the client. Every frame sent in response carries it, which is how the
+    client tells apart the responses to concurrent requests
+    """
+    chat_id: int | None = None
+    """
+    `None` starts a new chat
+    """
+
+
+def _serialize_frame(
+    request_id: str | None, event_id: str | None, serialized_event: str
+) -> str:
+    # the event is already serialized (once, for every reader of the generation)
+    return f'{{"request_id":{json.dumps(request_id)},"event_id":{json.dumps(event_id)},"frame":{serialized_event}}}'
+
+
+type SendFrame = Callable[[str | None, str], Awaitable[None]]
+
+
+@chat_websocket_router.websocket("/chat_stream")
+async def stream_chats(websocket: WebSocket) -> None:
+    """
+    Does what `POST /chat` and `POST /message` do, for any number of chats at once,
+    over one connection. The user is authenticated once, when connecting. After that,
+    only their session is looked up again, at most every
+    `SESSION_RECHECK_INTERVAL_SECONDS` (or once it's due to expire), and the connection
+    is closed once it has ended (logout, expiry).
+
+    The client sends `ChatStreamRequest`s. The response to each is a sequence of
+    frames, `{"request_id": ..., "event_id": ..., "frame": ...}`, whose frames are
+    the events of `POST /message`: the user's message, `msg_start`, the `text` chunks,
+    then `msg_end` once the response is saved. Or an `error`, which ends that response.
+
+    If the connection drops, the responses are still generated, and `event_id` can be
+    used to resume one with `GET /chat/stream`.
+    """
+    try:
+        session = await get_current_session(websocket)
+        current_user = check_that_user_is_non_admin(
+            await users_manager.get_user_by_user_id(user_id=session.user_id)
+        )
+    except HTTPException as exception:
+        await websocket.close(
+            code=status.WS_1008_POLICY_VIOLATION, reason=str(exception.detail)
+        )
+        return
+    session_checked_at = time.monotonic()
+    await websocket.accept()
+
+    # concurrent streams take turns sending their frames
+    send_lock = asyncio.Lock()
+
+    async def send_frame(
+        request_id: str | None, event_id: str | None, serialized_event: str
+    ) -> None:
+        async with send_lock:
+            await websocket.send_text(
+                _serialize_frame(request_id, event_id, serialized_event)
+            )
+
+    stream_tasks: set[asyncio.Task[None]] = set()
+    try:
+        while True:
+            message = await websocket.receive_text()
+            try:
+                chat_stream_request = ChatStreamRequest.model_validate_json(message)
+            except ValidationError as validation_error:
+                await send_frame(
+                    None,
+                    None,
+                    ChatStreamError(
+                        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        detail=str(validation_error),
+                    ).model_dump_json(),
+                )
+                continue
+            if (
+                time.monotonic() - session_checked_at
+                >= SESSION_RECHECK_INTERVAL_SECONDS
+                or datetime.datetime.now(datetime.UTC) >= session.expires_at
+            ):
+                try:
+                    session = await sessions_manager.get_unexpired_session(
+                        session.session_id
+                    )
+                except HTTPException as exception:
+                    await websocket.close(
+                        code=status.WS_1008_POLICY_VIOLATION,
+                        reason=str(exception.detail),
+                    )
+                    return
+                session_checked_at = time.monotonic()
+            # keeps a sliding expiry sliding, like any other request would
+            sessions_manager.record_session_seen(session.session_id)
+            if len(stream_tasks) >= MAX_CONCURRENT_STREAMS_PER_CONNECTION:
+                await send_frame(
+                    chat_stream_request.request_id,
+                    None,
+                    ChatStreamError(
+                        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                        detail=f"At most {MAX_CONCURRENT_STREAMS_PER_CONNECTION} responses can be streamed at once per connection.",
+                    ).model_dump_json(),
+                )
+                continue
+            stream_task = asyncio.create_task(
+                _stream_chat(
+                    chat_stream_request,
+                    current_user.user_id,
+                    send_frame=partial(send_frame, chat_stream_request.request_id),
+                )
+            )
+            stream_tasks.add(stream_task)
+            stream_task.add_done_callback(stream_tasks.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # the responses are still generated, and saved
+        for stream_task in stream_tasks:
+            stream_task.cancel()
+        await asyncio.gather(*stream_tasks, return_exceptions=True)
+
+
+async def _stream_chat(
+    chat_stream_request: ChatStreamRequest, user_id: int, send_frame: SendFrame
+) -> None:
+    # one trace per request on the connection, rather than one for the whole connection
+    with trace(
+        "WEBSOCKET /chat_stream",
+        request_id=get_request_id(),
+        client_request_id=chat_stream_request.request_id,
+        chat_id=chat_stream_request.chat_id,
+    ):
+        try:
+            await check_chat_rate_limit(user_id, "WEBSOCKET /chat_stream")
+            await wait_until_k4_is_warmed_up()
+            if chat_stream_request.chat_id is None:
+                (
+                    chat_id,
+                    complete_chat,
+                ) = await create_chat_and_get_complete_chat_for_llm(
+                    chat_stream_request, user_id
+                )
+            else:
+                chat_id = chat_stream_request.chat_id
+                complete_chat = await get_complete_chat_for_llm_of_existing_chat(
+                    chat_id, chat_stream_request, user_id
+                )
+            chat_generation = await start_k4_response(
+                user_id, chat_id, complete_chat, chat_stream_request
+            )
+        except HTTPException as exception:
+            await send_frame(
+                None,
+                ChatStreamError(
+                    status_code=exception.status_code, detail=str(exception.detail)
+                ).model_dump_json(),
+            )
+            return
+        except Exception:
+            log.exception(
+                f"Starting a response for {chat_stream_request.request_id=} failed"
+            )
+            await send_frame(
+                None,
+                ChatStreamError(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail="Unexpectedly failed to get a response.",
+                ).model_dump_json(),
+            )
+            return
+        try:
+            async for event_id, serialized_event in chat_generation.follow():
+                await send_frame(event_id, serialized_event)
+        except EventsNoLongerBufferedError:
+            # we couldn't keep up with the generation
+            await send_frame(
+                None,
+                ChatStreamError(
+                    status_code=status.HTTP_410_GONE,
+                    detail="Fell too far behind on this response, please reload the chat.",
+                ).model_dump_json(),
+            )
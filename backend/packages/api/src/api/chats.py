@@ -1,15 +1,40 @@
-from typing import Literal
+import asyncio
+from typing import AsyncGenerator, AsyncIterator, Literal
 
+from backend_commons.messages import MessageInDb
 from extensibles import ParamsForAlreadyExistingChat, get_complete_chat_for_llm
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, status
 from fastapi.responses import StreamingResponse
+from k4_logger import detached_span, span
 from k4.llm_provider_management import K4LlmProvider
-from pydantic import BaseModel
-
-from k4 import ChatMessage
-
-from ._dependencies import get_current_active_non_admin_user, k4, messages_manager
+from pydantic import BaseModel, Field
+
+from k4 import ChatMessage, LlmUsage
+
+from ._dependencies import (
+    chat_generations,
+    get_current_active_non_admin_user,
+    get_k4,
+    limit_chat_requests_of_user,
+    messages_manager,
+    share_db_connection_for_request,
+    usage_manager,
+    wait_until_k4_is_warmed_up,
+)
+from .chat_generation import (
+    ChatGeneration,
+    ChatStreamError,
+    EventsNoLongerBufferedError,
+    parse_event_id,
+)
+from .conditional_requests import (
+    does_etag_match,
+    get_etag_headers,
+    make_etag,
+    make_not_modified_response,
+)
 from .message_management import Chat, ChatPreview
+from .responses import PydanticJSONResponse
 from .user_management import NonAdminUser
 
 chats_router = APIRouter()
@@ -26,29 +51,83 @@ class LlmStreamingChunk(BaseModel):
     chunk: str
 
 
-@chats_router.get("/chat")
+class LlmStreamingEnd(BaseModel):
+    """
+    Sent once the response is saved
+    """
+
+    chat_id: int
+    chunk_type: Literal["msg_end"] = "msg_end"
+
+
+NUM_CHAT_PREVIEWS = 20
+
+
+@chats_router.get(
+    "/chat",
+    response_model=Chat,
+    dependencies=[Depends(share_db_connection_for_request)],
+)
 async def get_chat_by_chat_id(
     chat_id: int,
+    if_none_match: str | None = Header(default=None),
     current_user: NonAdminUser = Depends(get_current_active_non_admin_user),
-) -> Chat:
-    if not await messages_manager.does_user_own_this_chat(
-        user_id=current_user.user_id, chat_id=chat_id
-    ):
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You can't access a different user's chats.",
-        )
-    return await messages_manager.get_chat(chat_id=chat_id)
+) -> Response:
+    """
+    Responds with a 304 if the client's `If-None-Match` is still the chat's ETag, after
+    only a cheap check of the chat's version.
+
+    The chat is read straight from our own tables, so it's serialized without being
+    validated again
+    """
+    headers = None
+    chat_version = await messages_manager.get_chat_version(
+        chat_id=chat_id, user_id=current_user.user_id
+    )
+    if chat_version is not None:
+        # if a message is saved in between, the ETag is of an older version than the
+        # chat we respond with, and the next request just gets a 200 again
+        etag = make_etag(chat_version)
+        if does_etag_match(if_none_match, etag):
+            return make_not_modified_response(etag)
+        headers = get_etag_headers(etag)
+    return PydanticJSONResponse(
+        await messages_manager.get_chat_of_user(
+            chat_id=chat_id, user_id=current_user.user_id
+        ),
+        headers=headers,
+    )
 
 
-@chats_router.get("/chat_previews")
+@chats_router.get(
+    "/chat_previews",
+    response_model=list[ChatPreview],
+    dependencies=[Depends(share_db_connection_for_request)],
+)
 async def get_chat_previews(
+    if_none_match: str | None = Header(default=None),
     current_user: NonAdminUser = Depends(get_current_active_non_admin_user),
-) -> list[ChatPreview]:
-    return await messages_manager.get_user_chat_previews(current_user.user_id, 20)
+) -> Response:
+    """
+    Responds with a 304 if the client's `If-None-Match` is still the previews' ETag,
+    see `get_chat_by_chat_id`
+    """
+    etag = make_etag(
+        await messages_manager.get_chat_previews_version(
+            current_user.user_id, NUM_CHAT_PREVIEWS
+        )
+    )
+    if does_etag_match(if_none_match, etag):
+        return make_not_modified_response(etag)
+    return PydanticJSONResponse(
+        await messages_manager.get_user_chat_previews(
+            current_user.user_id, NUM_CHAT_PREVIEWS
+        ),
+        headers=get_etag_headers(etag),
+    )
 
 
-@chats_router.delete("/chat")
+@chats_router.delete("/chat", dependencies=[Depends(share_db_connection_for_request)])
 async def delete_chat(
     chat_id: int,
     current_user: NonAdminUser = Depends(get_current_active_non_admin_user),
@@ -67,137 +146,363 @@ class CreateNewChatRequestBody(BaseModel):
     message: str
     llm_provider: K4LlmProvider
     llm_model_name: str
-
-
-@chats_router.post("/chat")
-async def create_new_chat_with_message_stream(
-    create_new_chat_request_body: CreateNewChatRequestBody,
-    background_tasks: BackgroundTasks,
-    current_user: NonAdminUser = Depends(get_current_active_non_admin_user),
-) -> StreamingResponse:
+    fallback_llm_model_names: list[str] = []
+    """
+    Equivalent models (e.g. the same model through another provider), in order of
+    preference. Used if `llm_model_name` fails, or is too slow to respond when
+    `hedge_after_seconds` is set
+    """
+    hedge_after_seconds: float | None = Field(default=None, gt=0)
+
+
+async def create_chat_and_get_complete_chat_for_llm(
+    create_new_chat_request_body: CreateNewChatRequestBody, user_id: int
+) -> tuple[int, list[ChatMessage]]:
+    """
+    Raises `HTTPException` if the request is invalid, before the chat is created
+
+    Returns
+    -------
+    tuple[int, list[ChatMessage]]
+        The new chat's id, and what to ask the LLM
+    """
     complete_chat = await get_complete_chat_for_llm(
         new_message_from_user=create_new_chat_request_body.message,
         existing_chat_params=None,
     )
-    will_ask_succeed, failure_detail = k4.will_ask_succeed_with_detail(
-        complete_chat=complete_chat,
-        llm_provider=create_new_chat_request_body.llm_provider,
-        model=create_new_chat_request_body.llm_model_name,
+    check_that_ask_will_succeed(complete_chat, create_new_chat_request_body)
+    with span("create chat"):
+        chat_in_db = await messages_manager.create_new_chat(user_id=user_id, title="")
+    return chat_in_db.chat_id, complete_chat
+
+
+async def get_complete_chat_for_llm_of_existing_chat(
+    chat_id: int, create_new_chat_request_body: CreateNewChatRequestBody, user_id: int
+) -> list[ChatMessage]:
+    """
+    Raises `HTTPException` if the request is invalid
+    """
+    with span("load chat", chat_id=chat_id):
+        chat_in_db = await messages_manager.get_chat_in_db(chat_id)
+    if user_id != chat_in_db.user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You can't access another user's chats.",
+        )
+
+    complete_chat = await get_complete_chat_for_llm(
+        new_message_from_user=create_new_chat_request_body.message,
+        existing_chat_params=ParamsForAlreadyExistingChat(
+            chat_id=chat_id,
+            get_messages_of_chat=messages_manager.get_messages_of_chat,
+        ),
     )
+    check_that_ask_will_succeed(complete_chat, create_new_chat_request_body)
+    return complete_chat
+
+
+def check_that_ask_will_succeed(
+    complete_chat: list[ChatMessage],
+    create_new_chat_request_body: CreateNewChatRequestBody,
+) -> None:
+    with span("validation"):
+        will_ask_succeed, failure_detail = get_k4().will_ask_succeed_with_detail(
+            complete_chat=complete_chat,
+            llm_provider=create_new_chat_request_body.llm_provider,
+            model=create_new_chat_request_body.llm_model_name,
+            fallback_models=create_new_chat_request_body.fallback_llm_model_names,
+        )
     if not will_ask_succeed:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=failure_detail,
+            status_code=status.HTTP_400_BAD_REQUEST, detail=failure_detail
         )
-    chat_in_db = await messages_manager.create_new_chat(
-        user_id=current_user.user_id, title=""
+
+
+@chats_router.post(
+    "/chat",
+    dependencies=[
+        Depends(share_db_connection_for_request),
+        Depends(limit_chat_requests_of_user),
+        Depends(wait_until_k4_is_warmed_up),
+    ],
+)
+async def create_new_chat_with_message_stream(
+    create_new_chat_request_body: CreateNewChatRequestBody,
+    current_user: NonAdminUser = Depends(get_current_active_non_admin_user),
+) -> StreamingResponse:
+    chat_id, complete_chat = await create_chat_and_get_complete_chat_for_llm(
+        create_new_chat_request_body, current_user.user_id
     )
-    return await get_and_stream_and_store_k4_response(
-        user_id=current_user.user_id,
-        chat_id=chat_in_db.chat_id,
-        complete_chat=complete_chat,
-        llm_model_name=create_new_chat_request_body.llm_model_name,
-        background_tasks=background_tasks,
+    chat_generation = await start_k4_response(
+        current_user.user_id, chat_id, complete_chat, create_new_chat_request_body
     )
+    return stream_server_sent_events(chat_generation.follow())
 
 
 class SendMessageRequestBody(CreateNewChatRequestBody):
     chat_id: int
 
 
-@chats_router.post("/message")
+@chats_router.post(
+    "/message",
+    dependencies=[
+        Depends(share_db_connection_for_request),
+        Depends(limit_chat_requests_of_user),
+        Depends(wait_until_k4_is_warmed_up),
+    ],
+)
 async def send_message_to_k4_stream(
     send_message_request_body: SendMessageRequestBody,
-    background_tasks: BackgroundTasks,
     current_user: NonAdminUser = Depends(get_current_active_non_admin_user),
 ) -> StreamingResponse:
-    chat_in_db = await messages_manager.get_chat_in_db(
-        send_message_request_body.chat_id
+    complete_chat = await get_complete_chat_for_llm_of_existing_chat(
+        send_message_request_body.chat_id,
+        send_message_request_body,
+        current_user.user_id,
     )
-    if current_user.user_id != chat_in_db.user_id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You can't access another user's chats.",
-        )
-
-    complete_chat = await get_complete_chat_for_llm(
-        new_message_from_user=send_message_request_body.message,
-        existing_chat_params=ParamsForAlreadyExistingChat(
-            chat_id=send_message_request_body.chat_id,
-            get_messages_of_chat=messages_manager.get_messages_of_chat,
-        ),
+    chat_generation = await start_k4_response(
+        current_user.user_id,
+        send_message_request_body.chat_id,
+        complete_chat,
+        send_message_request_body,
     )
+    return stream_server_sent_events(chat_generation.follow())
 
-    will_ask_succeed, failure_detail = k4.will_ask_succeed_with_detail(
-        complete_chat=complete_chat,
-        llm_provider=send_message_request_body.llm_provider,
-        model=send_message_request_body.llm_model_name,
-    )
-    if not will_ask_succeed:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail=failure_detail
-        )
 
-    return await get_and_stream_and_store_k4_response(
-        user_id=current_user.user_id,
-        chat_id=send_message_request_body.chat_id,
-        complete_chat=complete_chat,
-        llm_model_name=send_message_request_body.llm_model_name,
-        background_tasks=background_tasks,
-    )
-
-
-async def save_k4_response_to_db(chat_id: int, all_k4_responses: list[str]) -> None:
+async def save_k4_response_to_db(
+    user_id: int, chat_id: int, all_k4_responses: list[str], llm_usage: LlmUsage
+) -> None:
     k4_response: str = "".join(all_k4_responses)
-    await messages_manager.save_k4_message_to_db(chat_id=chat_id, text=k4_response)
+    with span("save response"):
+        k4_message = await messages_manager.save_k4_message_to_db(
+            chat_id=chat_id, text=k4_response
+        )
+    if llm_usage.model:
+        # otherwise the stream didn't complete, so we don't know the usage
+        usage_manager.record_usage(
+            message_id=k4_message.message_id, user_id=user_id, llm_usage=llm_usage
+        )
 
 
-async def get_and_stream_and_store_k4_response(
-    user_id: int,
-    chat_id: int,
-    complete_chat: list[ChatMessage],
-    llm_model_name: str,
-    background_tasks: BackgroundTasks,
-) -> StreamingResponse:
+async def save_user_message_to_db(
+    user_id: int, chat_id: int, complete_chat: list[ChatMessage]
+) -> MessageInDb:
     text = complete_chat[-1].get("unmodified_content")
     if not text:
         text = complete_chat[-1]["content"]
-    user_message = await messages_manager.save_client_message_to_db(
-        chat_id=chat_id, user_id=user_id, text=text
-    )
-
-    all_k4_response_tokens: list[str] = []
+    with span("save user message"):
+        return await messages_manager.save_client_message_to_db(
+            chat_id=chat_id, user_id=user_id, text=text
+        )
 
-    def _format_pydantic_instance_for_stream_response(
-        pydantic_instance: BaseModel,
-    ) -> str:
-        return f"{pydantic_instance.model_dump_json()}\n"
 
-    async def stream_response_and_async_write_to_db():  # type: ignore[no-untyped-def]
-        yield _format_pydantic_instance_for_stream_response(user_message)
-        yield _format_pydantic_instance_for_stream_response(
-            LlmStreamingStart(chat_id=chat_id)
-        )
-        async for response_token in k4.ask_stream(
+async def stream_k4_response(
+    user_id: int,
+    chat_id: int,
+    complete_chat: list[ChatMessage],
+    llm_model_name: str,
+    fallback_llm_model_names: list[str],
+    hedge_after_seconds: float | None,
+    all_k4_response_tokens: list[str],
+    llm_usage: LlmUsage,
+) -> AsyncGenerator[LlmStreamingStart | LlmStreamingChunk, None]:
+    """
+    The response's tokens are also appended to `all_k4_response_tokens`, and its usage
+    is filled in once it's complete, so that they can be saved afterwards
+    """
+    yield LlmStreamingStart(chat_id=chat_id)
+    with detached_span("stream response") as stream_span:
+        async for response_token in get_k4().ask_stream(
             messages=complete_chat,
             model=llm_model_name,
+            user_id=user_id,
+            fallback_models=fallback_llm_model_names,
+            hedge_after_seconds=hedge_after_seconds,
+            usage=llm_usage,
         ):
             if isinstance(response_token, str):
                 # ignore the final chunk, which is `None`
-                yield _format_pydantic_instance_for_stream_response(
-                    LlmStreamingChunk(chunk=response_token, chat_id=chat_id)
-                )
+                if not all_k4_response_tokens:
+                    stream_span.set_attribute(
+                        "time_to_first_token_seconds", stream_span.get_elapsed_seconds()
+                    )
+                yield LlmStreamingChunk(chunk=response_token, chat_id=chat_id)
                 all_k4_response_tokens.append(response_token)
+        stream_span.set_attribute("num_chunks", len(all_k4_response_tokens))
+
 
-    background_tasks.add_task(
-        # I believe this is guaranteed to run AFTER this the generator is consumed. We
-        # need that guarantee, otherwise `all_k4_responses` is incomplete.
-        # https://fastapi.tiangolo.com/tutorial/background-tasks/
-        save_k4_response_to_db,
+async def generate_k4_response(
+    user_id: int,
+    chat_id: int,
+    user_message: MessageInDb,
+    complete_chat: list[ChatMessage],
+    llm_model_name: str,
+    fallback_llm_model_names: list[str],
+    hedge_after_seconds: float | None,
+) -> AsyncGenerator[BaseModel, None]:
+    """
+    Every event of a response: the user's message, the streamed response, and once the
+    response is saved, `LlmStreamingEnd`
+    """
+    all_k4_response_tokens: list[str] = []
+    llm_usage = LlmUsage()
+    yield user_message
+    async for streaming_event in stream_k4_response(
+        user_id=user_id,
+        chat_id=chat_id,
+        complete_chat=complete_chat,
+        llm_model_name=llm_model_name,
+        fallback_llm_model_names=fallback_llm_model_names,
+        hedge_after_seconds=hedge_after_seconds,
+        all_k4_response_tokens=all_k4_response_tokens,
+        llm_usage=llm_usage,
+    ):
+        yield streaming_event
+    await save_k4_response_to_db(
+        user_id=user_id,
         chat_id=chat_id,
         all_k4_responses=all_k4_response_tokens,
+        llm_usage=llm_usage,
     )
+    yield LlmStreamingEnd(chat_id=chat_id)
+
+
+async def start_k4_response(
+    user_id: int,
+    chat_id: int,
+    complete_chat: list[ChatMessage],
+    create_new_chat_request_body: CreateNewChatRequestBody,
+) -> ChatGeneration:
+    """
+    Saves the user's message, and starts generating the response in the background
+    """
+    user_message = await save_user_message_to_db(user_id, chat_id, complete_chat)
+    # the response can take a while, and doesn't need the request's connection
+    await messages_manager.release_shared_connection()
+    return chat_generations.start(
+        chat_id,
+        user_id,
+        generate_k4_response(
+            user_id=user_id,
+            chat_id=chat_id,
+            user_message=user_message,
+            complete_chat=complete_chat,
+            llm_model_name=create_new_chat_request_body.llm_model_name,
+            fallback_llm_model_names=create_new_chat_request_body.fallback_llm_model_names,
+            hedge_after_seconds=create_new_chat_request_body.hedge_after_seconds,
+        ),
+    )
+
+
+def stream_server_sent_events(
+    events: AsyncIterator[tuple[str, str]], keepalive_seconds: float | None = None
+) -> StreamingResponse:
+    """
+    Each event's `id` can be sent back as `Last-Event-ID` to `GET /chat/stream`, to
+    resume the stream after that event
+
+    Parameters
+    ----------
+    events : AsyncIterator[tuple[str, str]]
+        Event ids and serialized events, e.g. from `ChatGeneration.follow()`
+    keepalive_seconds : float | None, optional
+        For streams that can go quiet for a while: a comment is sent whenever there
+        hasn't been an event for this long, so that proxies don't time out the
+        connection. By default None
+    """
+
+    async def stream_events() -> AsyncGenerator[str, None]:
+        next_event = asyncio.ensure_future(anext(events))
+        try:
+            while True:
+                await asyncio.wait({next_event}, timeout=keepalive_seconds)
+                if not next_event.done():
+                    yield ": keepalive\n\n"
+                    continue
+                try:
+                    event_id, serialized_event = next_event.result()
+                except StopAsyncIteration:
+                    return
+                except EventsNoLongerBufferedError:
+                    error = ChatStreamError(
+                        status_code=status.HTTP_410_GONE,
+                        detail="Fell too far behind on this stream, please reload the chat.",
+                    )
+                    yield f"data: {error.model_dump_json()}\n\n"
+                    return
+                yield f"id: {event_id}\ndata: {serialized_event}\n\n"
+                next_event = asyncio.ensure_future(anext(events))
+        finally:
+            next_event.cancel()
+
     return StreamingResponse(
-        stream_response_and_async_write_to_db(),  # type: ignore[no-untyped-call]
+        stream_events(),
         media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
+
+
+@chats_router.get("/chat/subscribe")
+async def subscribe_to_chat(
+    chat_id: int,
+    last_event_id: str | None = Header(default=None, alias="Last-Event-ID"),
+    current_user: NonAdminUser = Depends(get_current_active_non_admin_user),
+) -> StreamingResponse:
+    """
+    Streams the response being generated in the chat, if any, then every response
+    generated in it afterwards, whichever client asked for it. E.g. for the same chat
+    open on another device, instead of polling `GET /chat`.
+
+    Only responses generated by the same worker are streamed.
+    """
+    if not await messages_manager.does_user_own_this_chat(
+        user_id=current_user.user_id, chat_id=chat_id
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You can't access another user's chats.",
+        )
+    if last_event_id is not None:
+        try:
+            parse_event_id(last_event_id)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"{last_event_id} is not a valid Last-Event-ID",
+            )
+    return stream_server_sent_events(
+        chat_generations.subscribe(chat_id, last_event_id), keepalive_seconds=15
+    )
+
+
+@chats_router.get("/chat/stream")
+async def resume_chat_stream(
+    last_event_id: str = Header(alias="Last-Event-ID"),
+    current_user: NonAdminUser = Depends(get_current_active_non_admin_user),
+) -> StreamingResponse:
+    """
+    Streams the rest of a response, from after `Last-Event-ID`. The response is being
+    generated regardless, so this doesn't ask the LLM again.
+
+    The response can only be resumed from the worker that's generating it, and until a
+    minute after it's complete. After that, get the response with `GET /chat`
+    """
+    try:
+        generation_id, event_index = parse_event_id(last_event_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{last_event_id} is not a valid Last-Event-ID",
+        )
+    chat_generation = chat_generations.get(generation_id)
+    if chat_generation is None or chat_generation.user_id != current_user.user_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="This response is no longer being streamed, please reload the chat.",
+        )
+    if not chat_generation.is_buffered(event_index):
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="This stream can no longer be resumed from there, please reload the chat.",
+        )
+    return stream_server_sent_events(chat_generation.follow(event_index))
@@ -0,0 +1,39 @@
+import hashlib
+
+from fastapi import Response, status
+
+# the browser revalidates every time, and only keeps the response for this user
+CONDITIONAL_CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(version: str) -> str:
+    """
+    A weak ETag: the response is the same resource, not necessarily the same bytes
+    (e.g. once gzipped)
+    """
+    return f'W/"{hashlib.sha256(version.encode()).hexdigest()[:32]}"'
+
+
+def does_etag_match(if_none_match: str | None, etag: str) -> bool:
+    """
+    Whether the client already has this version, per its `If-None-Match` header. ETags
+    are compared weakly, as they should be for `If-None-Match`
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        client_etag.strip().removeprefix("W/") == etag.removeprefix("W/")
+        for client_etag in if_none_match.split(",")
+    )
+
+
+def get_etag_headers(etag: str) -> dict[str, str]:
+    return {"ETag": etag, "Cache-Control": CONDITIONAL_CACHE_CONTROL}
+
+
+def make_not_modified_response(etag: str) -> Response:
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED, headers=get_etag_headers(etag)
+    )
@@ -1,19 +1,26 @@
+import asyncio
 import re
+import shutil
+import uuid
+from enum import StrEnum
 from pathlib import Path
-from typing import Annotated
+from typing import Annotated, Coroutine
 
 import asyncpg
 from backend_commons import PostgresTableManager
 from backend_commons.postgres_table_manager import IdempotentMigration
 from extensibles import (
     GetCompleteChatDefaultImplementation,
+    ProcessIsolatedPlugin,
+    load_external_plugin,
     plugin_manager,
-    replace_plugin_with_external_plugin,
+    replace_plugin,
+    unload_external_plugin_modules,
 )
 from fastapi import HTTPException, status
-from git import Repo
 from k4_logger import log
 from pydantic import AfterValidator, BaseModel, Json, RootModel
+from utils.environment import get_extension_deadline_seconds
 
 
 def git_repo_url_validator(value: str) -> str:
@@ -46,9 +53,21 @@ class GitUrl(RootModel[str]):
         return self.root
 
 
+class ExtensionExecutionMode(StrEnum):
+    IN_PROCESS = "in_process"
+    """
+    The extension runs on the event loop, so it should only do I/O-bound work
+    """
+    PROCESS_POOL = "process_pool"
+    """
+    The extension runs in worker processes, for extensions doing CPU-heavy work
+    """
+
+
 class ExtensionMetadata(BaseModel):
     installed_version: str
     git_repo_url: GitUrl
+    execution_mode: ExtensionExecutionMode = ExtensionExecutionMode.IN_PROCESS
 
 
 class ExtensionInDb(BaseModel):
@@ -58,7 +77,87 @@ class ExtensionInDb(BaseModel):
     metadata: Json[ExtensionMetadata]
 
 
+class ExtensionInstallationStatus(StrEnum):
+    QUEUED = "queued"
+    CLONING = "cloning"
+    VERIFYING = "verifying"
+    INSTALLED = "installed"
+    FAILED = "failed"
+
+
+class ExtensionInstallationJob(BaseModel):
+    job_id: str
+    git_repo_url: GitUrl
+    execution_mode: ExtensionExecutionMode
+    status: ExtensionInstallationStatus = ExtensionInstallationStatus.QUEUED
+    progress_message: str = ""
+    progress_percent: float | None = None
+    error: str | None = None
+    extension: ExtensionInDb | None = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (
+            ExtensionInstallationStatus.INSTALLED,
+            ExtensionInstallationStatus.FAILED,
+        )
+
+
+class CloneProgress:
+    """
+    Reports `git clone`'s progress on the installation job. `update` is called from the
+    thread doing the clone, and only assigns attributes, so the job can be read
+    concurrently
+    """
+
+    def __init__(self, installation_job: ExtensionInstallationJob) -> None:
+        self.installation_job = installation_job
+
+    def update(
+        self,
+        op_code: int,
+        cur_count: str | float,
+        max_count: str | float | None = None,
+        message: str = "",
+    ) -> None:
+        from git import RemoteProgress
+
+        stage_names = {
+            RemoteProgress.COUNTING: "Counting objects",
+            RemoteProgress.COMPRESSING: "Compressing objects",
+            RemoteProgress.RECEIVING: "Receiving objects",
+            RemoteProgress.RESOLVING: "Resolving deltas",
+            RemoteProgress.CHECKING_OUT: "Checking out files",
+        }
+        self.installation_job.progress_message = stage_names.get(
+            op_code & RemoteProgress.OP_MASK, message
+        )
+        self.installation_job.progress_percent = (
+            100 * float(cur_count) / float(max_count) if max_count else None
+        )
+
+
 class ExtensionsManager(PostgresTableManager):
+    """
+    Installing an extension means cloning its repo, which can take a while. So
+    `start_adding_extension()` returns an `ExtensionInstallationJob` right away, and the
+    clone happens in a thread in the background. The plugin is swapped only once the
+    clone is complete and the extension's plugin has loaded successfully.
+
+    The most recently installed extension is the active one. Swapping it (installing,
+    reloading or removing an extension) doesn't need a restart: requests that already
+    called into the old plugin finish on it, and new requests use the new one.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.installation_jobs: dict[str, ExtensionInstallationJob] = {}
+        # the event loop only keeps weak references to tasks
+        self._background_tasks: set[asyncio.Task[None]] = set()
+        self._active_plugin: object | None = None
+        self._active_extension_id: int | None = None
+        self._plugin_swap_lock = asyncio.Lock()
+
     @property
     def create_table_queries(self) -> list[str]:
         return [
@@ -80,54 +179,223 @@ class ExtensionsManager(PostgresTableManager):
     def IDEMPOTENT_MIGRATIONS(self) -> list[IdempotentMigration]:
         return []
 
-    async def set_connection_pool_and_run_migrations_and_start(
-        self, connection_pool: "asyncpg.Pool[asyncpg.Record]"
-    ) -> None:
-        await super().set_connection_pool_and_run_migrations_and_start(connection_pool)
+    async def start(self) -> None:
         plugin_manager.register(
             GetCompleteChatDefaultImplementation(), name="get_complete_chat_for_llm"
         )
-        installed_extensions = await self.get_installed_extensions()
-        if installed_extensions:
-            replace_plugin_with_external_plugin(
-                "get_complete_chat_for_llm", installed_extensions[-1].local_path
+        latest_installed_extension = await self._get_latest_installed_extension()
+        if latest_installed_extension:
+            log.info(
+                f"Installing an extension for get_complete_chat_for_llm from {latest_installed_extension.local_path=}"
             )
+            self._activate_plugin(
+                await self._load_plugin(
+                    latest_installed_extension.local_path,
+                    latest_installed_extension.metadata.execution_mode,
+                ),
+                latest_installed_extension.extension_id,
+            )
+
+    def stop(self) -> None:
+        """
+        Stops the worker processes of the active extension, if it has any
+        """
+        if isinstance(self._active_plugin, ProcessIsolatedPlugin):
+            self._active_plugin.close()
+
+    async def _load_plugin(
+        self, local_path_of_extension: Path, execution_mode: ExtensionExecutionMode
+    ) -> object:
+        """
+        Raises if the extension can't be loaded. In-process extensions are imported in a
+        thread, since importing runs the extension's module-level code
+        """
+        match execution_mode:
+            case ExtensionExecutionMode.IN_PROCESS:
+                return await asyncio.to_thread(
+                    load_external_plugin,
+                    "get_complete_chat_for_llm",
+                    local_path_of_extension,
+                )
+            case ExtensionExecutionMode.PROCESS_POOL:
+                process_isolated_plugin = ProcessIsolatedPlugin(
+                    "get_complete_chat_for_llm",
+                    local_path_of_extension,
+                    call_timeout_seconds=get_extension_deadline_seconds() or 30.0,
+                )
+                await process_isolated_plugin.start()
+                return process_isolated_plugin
+
+    def _activate_plugin(self, plugin: object, extension_id: int | None) -> None:
+        """
+        `extension_id` is `None` for the default implementation. Requests that already
+        called into the previous plugin hold on to it and finish on it
+        """
+        previous_plugin = self._active_plugin
+        replace_plugin("get_complete_chat_for_llm", plugin)
+        self._active_plugin = plugin
+        self._active_extension_id = extension_id
+        if isinstance(previous_plugin, ProcessIsolatedPlugin):
+            self._run_in_background(previous_plugin.stop(), name="stop_extension")
+
+    def _run_in_background(
+        self, coroutine: Coroutine[None, None, None], name: str
+    ) -> None:
+        task = asyncio.create_task(coroutine, name=name)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
 
     async def get_installed_extensions(self) -> list[ExtensionInDb]:
         async with self.get_connection() as connection:
-            extensions = await connection.fetch("SELECT * FROM extensions LIMIT 10")
+            extensions = await connection.fetch(
+                "SELECT * FROM extensions ORDER BY extension_id LIMIT 10"
+            )
             return [ExtensionInDb(**extension) for extension in extensions]
 
+    async def _get_latest_installed_extension(self) -> ExtensionInDb | None:
+        async with self.get_connection() as connection:
+            extension = await connection.fetchrow(
+                "SELECT * FROM extensions ORDER BY extension_id DESC LIMIT 1"
+            )
+            return ExtensionInDb(**extension) if extension else None
+
+    def get_local_path_of_extension(self, git_repo_url: GitUrl) -> Path:
+        k4_extensions_directory_path = Path.home().joinpath(".k4/extensions")
+        repo_name = str(git_repo_url).split("/")[-1]
+        return k4_extensions_directory_path.joinpath(repo_name)
+
     async def download_extension_to_file_system_if_necessary_and_get_local_path(
-        self, git_repo_url: GitUrl
+        self, git_repo_url: GitUrl, clone_progress: CloneProgress | None = None
     ) -> Path:
-        k4_extensions_directory_path = Path.home().joinpath(".k4/extensions")
-        k4_extensions_directory_path.mkdir(
+        # GitPython is only needed here, so it's not imported until it is
+        from git import Repo
+
+        local_path_of_extension = self.get_local_path_of_extension(git_repo_url)
+        local_path_of_extension.parent.mkdir(
             exist_ok=True,
             parents=True,
         )  # create the directories if they don't already exist
-        repo_name = str(git_repo_url).split("/")[-1]
-        local_path_of_extension = k4_extensions_directory_path.joinpath(repo_name)
         if local_path_of_extension.exists():
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"An extension with {repo_name=} is already downloaded.",
+                detail=f"An extension with repo_name={local_path_of_extension.name!r} is already downloaded.",
             )
-        Repo.clone_from(str(git_repo_url), local_path_of_extension)
+        # clone next to the final location and rename when done, so a half-finished
+        # clone is never mistaken for a downloaded extension
+        partial_clone_path = local_path_of_extension.with_name(
+            f".{local_path_of_extension.name}.partial-{uuid.uuid4()}"
+        )
+        try:
+            # shallow and single-branch, since we only ever need the latest code
+            await asyncio.to_thread(
+                Repo.clone_from,
+                str(git_repo_url),
+                partial_clone_path,
+                progress=clone_progress.update if clone_progress else None,
+                depth=1,
+                single_branch=True,
+            )
+            partial_clone_path.rename(local_path_of_extension)
+        finally:
+            if partial_clone_path.exists():
+                await asyncio.to_thread(shutil.rmtree, partial_clone_path)
         return local_path_of_extension
 
-    async def add_extension(self, git_repo_url: GitUrl) -> ExtensionInDb:
-        local_path_of_extension = await self.download_extension_to_file_system_if_necessary_and_get_local_path(
-            git_repo_url
+    def start_adding_extension(
+        self,
+        git_repo_url: GitUrl,
+        execution_mode: ExtensionExecutionMode = ExtensionExecutionMode.IN_PROCESS,
+    ) -> ExtensionInstallationJob:
+        if self.get_local_path_of_extension(git_repo_url).exists() or any(
+            not installation_job.is_finished
+            and str(installation_job.git_repo_url) == str(git_repo_url)
+            for installation_job in self.installation_jobs.values()
+        ):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"{git_repo_url} is already installed or being installed.",
+            )
+        installation_job = ExtensionInstallationJob(
+            job_id=str(uuid.uuid4()),
+            git_repo_url=git_repo_url,
+            execution_mode=execution_mode,
+        )
+        self.installation_jobs[installation_job.job_id] = installation_job
+        self._run_in_background(
+            self._install_extension(installation_job),
+            name=f"install_extension_{installation_job.job_id}",
         )
+        return installation_job
+
+    def get_installation_job(self, job_id: str) -> ExtensionInstallationJob:
+        installation_job = self.installation_jobs.get(job_id)
+        if not installation_job:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"No extension installation with {job_id=} was found.",
+            )
+        return installation_job
+
+    async def _install_extension(
+        self, installation_job: ExtensionInstallationJob
+    ) -> None:
+        local_path_of_extension: Path | None = None
         try:
-            async with self.get_transaction_connection() as connection:
+            installation_job.status = ExtensionInstallationStatus.CLONING
+            local_path_of_extension = await self.download_extension_to_file_system_if_necessary_and_get_local_path(
+                installation_job.git_repo_url, CloneProgress(installation_job)
+            )
+
+            installation_job.status = ExtensionInstallationStatus.VERIFYING
+            plugin = await self._load_plugin(
+                local_path_of_extension, installation_job.execution_mode
+            )
+
+            try:
+                installation_job.extension = (
+                    await self._add_extension_and_replace_plugin(
+                        installation_job.git_repo_url,
+                        local_path_of_extension,
+                        installation_job.execution_mode,
+                        plugin,
+                    )
+                )
+            except BaseException:
+                if isinstance(plugin, ProcessIsolatedPlugin):
+                    plugin.close()
+                raise
+            installation_job.status = ExtensionInstallationStatus.INSTALLED
+        except Exception as exception:
+            log.exception(f"Failed to install an extension {installation_job=}")
+            installation_job.status = ExtensionInstallationStatus.FAILED
+            installation_job.error = (
+                str(exception.detail)
+                if isinstance(exception, HTTPException)
+                else repr(exception)
+            )
+            if local_path_of_extension and local_path_of_extension.exists():
+                await asyncio.to_thread(shutil.rmtree, local_path_of_extension)
+
+    async def _add_extension_and_replace_plugin(
+        self,
+        git_repo_url: GitUrl,
+        local_path_of_extension: Path,
+        execution_mode: ExtensionExecutionMode,
+        plugin: object,
+    ) -> ExtensionInDb:
+        try:
+            async with (
+                self._plugin_swap_lock,
+                self.get_transaction_connection() as connection,
+            ):
                 new_row = await connection.fetchrow(
                     "INSERT INTO extensions (name, local_path, metadata) VALUES ($1, $2, $3) RETURNING *",
                     str(git_repo_url),
                     str(local_path_of_extension),
                     ExtensionMetadata(
-                        installed_version="0.0.1", git_repo_url=git_repo_url
+                        installed_version="0.0.1",
+                        git_repo_url=git_repo_url,
+                        execution_mode=execution_mode,
                     ).model_dump_json(),
                 )
                 if not new_row:
@@ -135,10 +403,12 @@ class ExtensionsManager(PostgresTableManager):
                         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                         detail="Unexpectedly could not add extension to the database.",
                     )
-                replace_plugin_with_external_plugin(
-                    "get_complete_chat_for_llm", local_path_of_extension
+                log.info(
+                    f"Installing an extension for get_complete_chat_for_llm from {local_path_of_extension=}"
                 )
-                return ExtensionInDb(**new_row)
+                new_extension = ExtensionInDb(**new_row)
+                self._activate_plugin(plugin, new_extension.extension_id)
+                return new_extension
         except asyncpg.exceptions.UniqueViolationError:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -146,23 +416,77 @@ class ExtensionsManager(PostgresTableManager):
             )
 
     async def remove_extension(self, extension_id: int) -> ExtensionInDb:
-        # TODO this method is not completely implemented!!
-        async with self.get_transaction_connection() as connection:
-            query_result = await connection.fetchrow(
-                "SELECT * FROM extensions WHERE extension_id=$1", extension_id
-            )
-            if not query_result:
+        """
+        If it's the active extension, the previously installed extension (or the
+        default implementation, if there's none) takes its place
+        """
+        async with self._plugin_swap_lock:
+            async with self.get_transaction_connection() as connection:
+                query_result = await connection.fetchrow(
+                    "DELETE FROM extensions WHERE extension_id=$1 RETURNING *",
+                    extension_id,
+                )
+                if not query_result:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=f"No extension with {extension_id=} was found in the database.",
+                    )
+                extension_in_db = ExtensionInDb(**query_result)
+
+            if extension_id == self._active_extension_id:
+                await self._activate_latest_installed_extension()
+
+        unloaded_module_names = unload_external_plugin_modules(
+            extension_in_db.local_path
+        )
+        log.info(
+            f"Removed {extension_in_db=}, and forgot its modules {unloaded_module_names=}"
+        )
+        # in-flight requests still using the extension's modules have them loaded already
+        await asyncio.to_thread(
+            shutil.rmtree, extension_in_db.local_path, ignore_errors=True
+        )
+        return extension_in_db
+
+    async def reload_extension(self, extension_id: int) -> ExtensionInDb:
+        """
+        Re-imports the active extension's code from disk, e.g. after editing it
+        """
+        async with self._plugin_swap_lock:
+            if extension_id != self._active_extension_id:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=f"No extension with {extension_id=} was found in the database.",
+                    detail=f"Extension {extension_id=} is not the active extension.",
                 )
-            extension_in_db = ExtensionInDb(**query_result)
-            await connection.execute(
-                "DELETE FROM extensions WHERE extension_id=$1", extension_id
-            )
-            log.info(
-                f"Would have deleted this directory: {extension_in_db.local_path=}"
+            extension_in_db = await self._get_latest_installed_extension()
+            assert extension_in_db and extension_in_db.extension_id == extension_id
+            # forgotten first, so that the extension's own imports are imported afresh.
+            # The old plugin keeps its references to the old modules
+            unload_external_plugin_modules(extension_in_db.local_path)
+            self._activate_plugin(
+                await self._load_plugin(
+                    extension_in_db.local_path,
+                    extension_in_db.metadata.execution_mode,
+                ),
+                extension_id,
             )
-            # extension_in_db.local_path.rmdir()
-            # remove the plugin and replace with the default function
+            log.info(f"Reloaded {extension_in_db=}")
             return extension_in_db
+
+    async def _activate_latest_installed_extension(self) -> None:
+        latest_installed_extension = await self._get_latest_installed_extension()
+        if not latest_installed_extension:
+            self._activate_plugin(GetCompleteChatDefaultImplementation(), None)
+            return
+        try:
+            plugin = await self._load_plugin(
+                latest_installed_extension.local_path,
+                latest_installed_extension.metadata.execution_mode,
+            )
+        except Exception:
+            log.exception(
+                f"Could not load {latest_installed_extension=}, using the default implementation instead"
+            )
+            self._activate_plugin(GetCompleteChatDefaultImplementation(), None)
+            return
+        self._activate_plugin(plugin, latest_installed_extension.extension_id)
@@ -1,12 +1,19 @@
-from fastapi import APIRouter, Depends
+from extensibles import HookImplMetrics, get_hook_impl_metrics
+from fastapi import APIRouter, Depends, status
 from k4_logger import log
 
 from ._dependencies import (
     extensions_manager,
     get_current_active_admin_user,
     get_current_active_non_admin_user,
+    get_current_active_user,
+)
+from .extension_management import (
+    ExtensionExecutionMode,
+    ExtensionInDb,
+    ExtensionInstallationJob,
+    GitUrl,
 )
-from .extension_management import ExtensionInDb, GitUrl
 from .user_management import AdminUser, NonAdminUser
 
 extensions_router = APIRouter()
@@ -19,13 +26,34 @@ async def get_extensions(
     return await extensions_manager.get_installed_extensions()
 
 
-@extensions_router.post("/extension")
+@extensions_router.get("/extension/metrics")
+def get_extension_metrics(
+    current_admin_user: AdminUser = Depends(get_current_active_admin_user),
+) -> list[HookImplMetrics]:
+    return get_hook_impl_metrics()
+
+
+@extensions_router.post("/extension", status_code=status.HTTP_202_ACCEPTED)
 async def add_extension(
     git_repo_url: GitUrl,
+    execution_mode: ExtensionExecutionMode = ExtensionExecutionMode.IN_PROCESS,
     current_user: NonAdminUser = Depends(get_current_active_non_admin_user),
-) -> ExtensionInDb:
-    log.info(f"{current_user=} is adding an extension {git_repo_url=}")
-    return await extensions_manager.add_extension(git_repo_url)
+) -> ExtensionInstallationJob:
+    """
+    Installs in the background. Poll `GET /extension/installation` for progress
+    """
+    log.info(
+        f"{current_user=} is adding an extension {git_repo_url=} {execution_mode=}"
+    )
+    return extensions_manager.start_adding_extension(git_repo_url, execution_mode)
+
+
+@extensions_router.get("/extension/installation")
+async def get_extension_installation(
+    job_id: str,
+    current_user: AdminUser | NonAdminUser = Depends(get_current_active_user),
+) -> ExtensionInstallationJob:
+    return extensions_manager.get_installation_job(job_id)
 
 
 @extensions_router.delete("/extension")
@@ -35,3 +63,12 @@ async def uninstall_extension(
 ) -> None:
     log.info(f"{current_admin_user=} is uninstalling an extension {extension_id=}")
     await extensions_manager.remove_extension(extension_id=extension_id)
+
+
+@extensions_router.post("/extension/reload")
+async def reload_extension(
+    extension_id: int,
+    current_admin_user: AdminUser = Depends(get_current_active_admin_user),
+) -> ExtensionInDb:
+    log.info(f"{current_admin_user=} is reloading an extension {extension_id=}")
+    return await extensions_manager.reload_extension(extension_id=extension_id)
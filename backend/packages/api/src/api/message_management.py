@@ -1,8 +1,8 @@
 import datetime
-from typing import Iterable
+from typing import Iterable, NamedTuple
 
-from backend_commons import PostgresTableManager
-from backend_commons.messages import MessageInDb
+from backend_commons import BatchedWriter, PostgresTableManager
+from backend_commons.messages import MessageInDb, messages_in_db_from_rows
 from backend_commons.postgres_table_manager import IdempotentMigration
 from fastapi import HTTPException, status
 from pydantic import BaseModel, Field
@@ -26,7 +26,28 @@ class ChatPreview(BaseModel):
     most_recent_message_in_db: MessageInDb
 
 
+class NewMessage(NamedTuple):
+    chat_id: int
+    user_id: int | None
+    text: str
+
+
 class MessagesManager(PostgresTableManager):
+    """
+    Saving a message also bumps its chat's `last_message_timestamp`, in a single
+    statement.
+
+    If `message_writer` is started, concurrent saves are grouped into one multi-row
+    insert (one transaction, one commit) per batch. Call `await message_writer.stop()`
+    before closing the connection pool.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.message_writer = BatchedWriter[NewMessage, MessageInDb](
+            "messages", write_batch=self._save_messages_to_db, max_batch_size=100
+        )
+
     @property
     def create_table_queries(self) -> list[str]:
         # If you're changing the tables, you'll need to drop the existing table
@@ -68,6 +89,9 @@ class MessagesManager(PostgresTableManager):
         return (
             "CREATE INDEX IF NOT EXISTS idx_user_id ON chats(user_id)",
             "CREATE INDEX IF NOT EXISTS idx_chat_id ON messages(chat_id)",
+            # for the versions of chats, see `get_chat_version`
+            "CREATE INDEX IF NOT EXISTS idx_chats_user_id_last_message_timestamp ON chats(user_id, last_message_timestamp DESC)",
+            "CREATE INDEX IF NOT EXISTS idx_messages_chat_id_message_id ON messages(chat_id, message_id)",
         )
 
     @property
@@ -105,9 +129,24 @@ class MessagesManager(PostgresTableManager):
         user_id : int | None
             `None` iff the message is from k4
         """
-        async with self.get_transaction_connection() as connection:
+        if self.message_writer.is_running:
+            return await self.message_writer.write(
+                NewMessage(chat_id=chat_id, user_id=user_id, text=text)
+            )
+        async with self.get_connection() as connection:
+            # a data-modifying statement in a `WITH` always runs to completion, even if
+            # nothing references it. One round trip, one (implicit) transaction
             new_message = await connection.fetchrow(
-                "INSERT INTO messages (chat_id, user_id, text) VALUES ($1, $2, $3) RETURNING *",
+                """
+                WITH new_message AS (
+                    INSERT INTO messages (chat_id, user_id, text) VALUES ($1, $2, $3)
+                    RETURNING *
+                ), updated_chat AS (
+                    UPDATE chats SET last_message_timestamp = new_message.inserted_at
+                    FROM new_message WHERE chats.chat_id = new_message.chat_id
+                )
+                SELECT * FROM new_message
+                """,
                 chat_id,
                 user_id,
                 text,
@@ -117,13 +156,52 @@ class MessagesManager(PostgresTableManager):
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                     detail=f"Unexpectedly could not save the message to the database. {chat_id=} {user_id=}",
                 )
-            new_message_in_db = MessageInDb(**new_message)
-            await connection.execute(
-                "UPDATE chats SET last_message_timestamp=$1 WHERE chat_id=$2",
-                new_message_in_db.inserted_at,
-                new_message_in_db.chat_id,
+            return MessageInDb(**new_message)
+
+    async def _save_messages_to_db(
+        self, new_messages: list[NewMessage]
+    ) -> list[MessageInDb]:
+        async with self.get_connection() as connection:
+            # `RETURNING` rows come in no particular order, so each message's position in
+            # `new_messages` comes back with it. The message_ids are taken in that order
+            # too (volatile functions are evaluated after `ORDER BY`), so that messages of
+            # the same chat in one batch keep their order
+            rows = await connection.fetch(
+                """
+                WITH input_messages AS (
+                    SELECT
+                        nextval(pg_get_serial_sequence('messages', 'message_id')) AS message_id,
+                        chat_id, user_id, text, position
+                    FROM unnest($1::INT[], $2::INT[], $3::TEXT[])
+                        WITH ORDINALITY AS input_messages(chat_id, user_id, text, position)
+                    ORDER BY position
+                ), new_messages AS (
+                    INSERT INTO messages (message_id, chat_id, user_id, text)
+                    SELECT message_id, chat_id, user_id, text FROM input_messages
+                    RETURNING *
+                ), updated_chats AS (
+                    UPDATE chats SET last_message_timestamp = latest_messages.inserted_at
+                    FROM (
+                        SELECT chat_id, max(inserted_at) AS inserted_at
+                        FROM new_messages GROUP BY chat_id
+                    ) AS latest_messages
+                    WHERE chats.chat_id = latest_messages.chat_id
+                )
+                SELECT new_messages.*, input_messages.position
+                FROM new_messages JOIN input_messages USING (message_id)
+                """,
+                [new_message.chat_id for new_message in new_messages],
+                [new_message.user_id for new_message in new_messages],
+                [new_message.text for new_message in new_messages],
+            )
+            if len(rows) != len(new_messages):
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail=f"Unexpectedly saved {len(rows)} of {len(new_messages)} messages to the database.",
+                )
+            return messages_in_db_from_rows(
+                sorted(rows, key=lambda row: row["position"])
             )
-            return new_message_in_db
 
     async def save_client_message_to_db(
         self, chat_id: int, user_id: int, text: str
@@ -151,7 +229,7 @@ class MessagesManager(PostgresTableManager):
             for chat in chats:
                 chat_id = ChatInDb(**chat).chat_id
                 latest_message = await connection.fetchrow(
-                    "SELECT * FROM messages WHERE chat_id=$1 ORDER BY inserted_at DESC LIMIT 1",
+                    "SELECT * FROM messages WHERE chat_id=$1 ORDER BY inserted_at DESC, message_id DESC LIMIT 1",
                     chat_id,
                 )
                 if not latest_message:
@@ -167,6 +245,55 @@ class MessagesManager(PostgresTableManager):
                 )
             return chat_previews
 
+    async def get_chat_previews_version(self, user_id: int, num_chats: int) -> str:
+        """
+        Changes whenever `get_user_chat_previews` would return something else. Much
+        cheaper to get than the previews themselves, see `get_chat_version`
+        """
+        async with self.get_connection() as connection:
+            rows = await connection.fetch(
+                """
+                SELECT chats.chat_id, chats.last_message_timestamp, latest_message.message_id
+                FROM chats, LATERAL (
+                    SELECT max(message_id) AS message_id FROM messages
+                    WHERE messages.chat_id = chats.chat_id
+                ) AS latest_message
+                WHERE chats.user_id=$1
+                ORDER BY chats.last_message_timestamp DESC LIMIT $2
+                """,
+                user_id,
+                num_chats,
+            )
+            return f"{user_id=}" + "".join(
+                f"|{row['chat_id']},{row['last_message_timestamp'].isoformat()},{row['message_id']}"
+                for row in rows
+            )
+
+    async def get_chat_version(self, chat_id: int, user_id: int) -> str | None:
+        """
+        Changes whenever `get_chat_of_user` would return something else, or `None` if
+        the user doesn't own the chat.
+
+        Chats and messages are only ever added to, and adding a message bumps its chat's
+        `last_message_timestamp`. But messages saved in the same transaction get the same
+        timestamp, so the latest message's id is part of the version too. Both come
+        straight from an index
+        """
+        async with self.get_connection() as connection:
+            row = await connection.fetchrow(
+                """
+                SELECT chats.last_message_timestamp, (
+                    SELECT max(message_id) FROM messages WHERE messages.chat_id = chats.chat_id
+                ) AS latest_message_id
+                FROM chats WHERE chats.chat_id=$1 AND chats.user_id=$2
+                """,
+                chat_id,
+                user_id,
+            )
+            if not row:
+                return None
+            return f"{user_id=}|{chat_id},{row['last_message_timestamp'].isoformat()},{row['latest_message_id']}"
+
     async def does_user_own_this_chat(self, user_id: int, chat_id: int) -> bool:
         async with self.get_connection() as connection:
             val: int = await connection.fetchval(
@@ -174,11 +301,58 @@ class MessagesManager(PostgresTableManager):
             )
             return user_id == val
 
-    async def get_chat(self, chat_id: int) -> Chat:
-        return Chat(
-            chat_in_db=await self.get_chat_in_db(chat_id=chat_id),
-            messages=await self.get_messages_of_chat(chat_id=chat_id),
-        )
+    async def get_chat_of_user(self, chat_id: int, user_id: int) -> Chat:
+        """
+        The chat and all of its messages in one query, which also checks that the user
+        owns the chat
+        """
+        async with self.get_connection() as connection:
+            rows = await connection.fetch(
+                """
+                SELECT
+                    chats.chat_id,
+                    chats.user_id AS chat_user_id,
+                    chats.title,
+                    chats.last_message_timestamp,
+                    chats.is_archived,
+                    messages.message_id,
+                    messages.user_id AS message_user_id,
+                    messages.text,
+                    messages.inserted_at
+                FROM chats LEFT JOIN messages ON messages.chat_id = chats.chat_id
+                WHERE chats.chat_id=$1 AND chats.user_id=$2
+                ORDER BY messages.inserted_at, messages.message_id
+                """,
+                chat_id,
+                user_id,
+            )
+            if not rows:
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail="You can't access a different user's chats.",
+                )
+            # the messages were just validated, no need to go over them again
+            return Chat.model_construct(
+                chat_in_db=ChatInDb(
+                    chat_id=rows[0]["chat_id"],
+                    user_id=rows[0]["chat_user_id"],
+                    title=rows[0]["title"],
+                    last_message_timestamp=rows[0]["last_message_timestamp"],
+                    is_archived=rows[0]["is_archived"],
+                ),
+                messages=messages_in_db_from_rows(
+                    {
+                        "message_id": row["message_id"],
+                        "chat_id": row["chat_id"],
+                        "user_id": row["message_user_id"],
+                        "text": row["text"],
+                        "inserted_at": row["inserted_at"],
+                    }
+                    # a chat without messages comes back as one row of NULL messages
+                    for row in rows
+                    if row["message_id"] is not None
+                ),
+            )
 
     async def get_chat_in_db(self, chat_id: int) -> ChatInDb:
         async with self.get_connection() as connection:
@@ -198,13 +372,13 @@ class MessagesManager(PostgresTableManager):
         async with self.get_connection() as connection:
             if limit:
                 records = await connection.fetch(
-                    "SELECT * FROM messages WHERE chat_id=$1 ORDER BY inserted_at DESC LIMIT $2",
+                    "SELECT * FROM messages WHERE chat_id=$1 ORDER BY inserted_at DESC, message_id DESC LIMIT $2",
                     chat_id,
                     limit,
                 )
             else:
                 records = await connection.fetch(
-                    "SELECT * FROM messages WHERE chat_id=$1 ORDER BY inserted_at DESC",
+                    "SELECT * FROM messages WHERE chat_id=$1 ORDER BY inserted_at DESC, message_id DESC",
                     chat_id,
                 )
-            return [MessageInDb(**record) for record in reversed(records)]
+            return messages_in_db_from_rows(reversed(records))
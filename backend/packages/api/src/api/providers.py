@@ -2,11 +2,22 @@ from dataclasses import dataclass
 
 from api.user_management import AdminUser, NonAdminUser
 from fastapi import APIRouter, Depends
-from k4.llm_provider_management import K4LlmProvider, LlmProviderConfig, LlmProviderInfo
+from k4.llm_provider_management import (
+    K4LlmProvider,
+    LlmProviderConfig,
+    LlmProviderInfo,
+    LlmRequestLimits,
+)
+from k4.llm_request_scheduling import LlmRequestQueueMetrics
 
-from ._dependencies import get_current_active_admin_user, get_current_active_user, k4
+from ._dependencies import (
+    get_current_active_admin_user,
+    get_current_active_user,
+    get_k4,
+    wait_until_k4_is_warmed_up,
+)
 
-providers_router = APIRouter()
+providers_router = APIRouter(dependencies=[Depends(wait_until_k4_is_warmed_up)])
 
 
 @dataclass
@@ -19,7 +30,7 @@ class ConfigureProviderDetails:
 def get_providers(
     current_admin_user: AdminUser = Depends(get_current_active_admin_user),
 ) -> dict[K4LlmProvider, LlmProviderInfo]:
-    return k4.llm_provider_manager.providers_cache.create_dict()
+    return get_k4().llm_provider_manager.providers_cache.create_dict()
 
 
 @providers_router.post("/provider")
@@ -30,7 +41,7 @@ def configure_provider(
     llm_provider = configure_provider_details.llm_provider
     config = configure_provider_details.llm_provider_config
 
-    k4.llm_provider_manager.set_provider_config(
+    get_k4().llm_provider_manager.set_provider_config(
         llm_provider=llm_provider,
         config=config,
     )
@@ -41,14 +52,43 @@ def remove_provider(
     llm_provider_to_remove: K4LlmProvider,
     current_admin_user: AdminUser = Depends(get_current_active_admin_user),
 ) -> None:
-    k4.llm_provider_manager.set_provider_config(
+    get_k4().llm_provider_manager.set_provider_config(
         llm_provider=llm_provider_to_remove,
         config=None,
     )
 
 
+@dataclass
+class ConfigureRequestLimitsDetails:
+    llm_provider: K4LlmProvider
+    model: str | None
+    """
+    `None` sets the limits for the whole provider, i.e. across all of its models
+    """
+    limits: LlmRequestLimits
+
+
+@providers_router.post("/provider/limits")
+def configure_request_limits(
+    configure_request_limits_details: ConfigureRequestLimitsDetails,
+    current_admin_user: AdminUser = Depends(get_current_active_admin_user),
+) -> None:
+    get_k4().set_llm_request_limits(
+        llm_provider=configure_request_limits_details.llm_provider,
+        model=configure_request_limits_details.model,
+        limits=configure_request_limits_details.limits,
+    )
+
+
+@providers_router.get("/provider/metrics")
+def get_request_queue_metrics(
+    current_admin_user: AdminUser = Depends(get_current_active_admin_user),
+) -> list[LlmRequestQueueMetrics]:
+    return get_k4().llm_request_scheduler.get_metrics()
+
+
 @providers_router.get("/models")
 def get_available_models(
     current_user: AdminUser | NonAdminUser = Depends(get_current_active_user),
 ) -> dict[str, list[str]]:
-    return k4.llm_provider_manager.get_available_models()
+    return get_k4().llm_provider_manager.get_available_models()
@@ -0,0 +1,143 @@
+from typing import Iterable
+
+from backend_commons.postgres_table_manager import (
+    IdempotentMigration,
+    PostgresTableManager,
+)
+from utils import TokenBucket
+
+# past this many buckets, the full ones are forgotten (see `_forget_full_buckets`)
+MIN_NUM_BUCKETS_BEFORE_FORGETTING = 1024
+
+
+class RateLimitsManager(PostgresTableManager):
+    """
+    One token bucket per key (e.g. a user and an endpoint), holding up to
+    `requests_per_minute` tokens and refilled at that rate.
+
+    Every worker has its own buckets, which turn requests away without touching the
+    DB. With `use_shared_buckets`, a request that gets past its worker's bucket has to
+    get past a bucket in Postgres as well. Those are shared by every worker, so the limit
+    holds no matter how many workers there are.
+
+    ```
+    retry_after_seconds = await rate_limits_manager.try_consume(f"{user_id} POST /message")
+    if retry_after_seconds:
+        ...  # 429
+    ```
+    """
+
+    def __init__(
+        self, requests_per_minute: float | None, use_shared_buckets: bool
+    ) -> None:
+        super().__init__()
+        self.requests_per_minute = requests_per_minute
+        self.use_shared_buckets = use_shared_buckets
+        self._token_bucket_by_key: dict[str, TokenBucket] = {}
+        self._max_num_buckets = MIN_NUM_BUCKETS_BEFORE_FORGETTING
+
+    @property
+    def create_table_queries(self) -> Iterable[str]:
+        return [
+            """
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            bucket_key VARCHAR(255) PRIMARY KEY,
+            available_tokens DOUBLE PRECISION NOT NULL,
+            refilled_at TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+        """
+        ]
+
+    @property
+    def create_indexes_queries(self) -> Iterable[str]:
+        return []
+
+    @property
+    def IDEMPOTENT_MIGRATIONS(self) -> list[IdempotentMigration]:
+        return []
+
+    async def try_consume(self, key: str) -> float:
+        """
+        Returns
+        -------
+        float
+            `0` if the request may go ahead. Otherwise, the number of seconds until it
+            may be retried
+        """
+        if self.requests_per_minute is None:
+            return 0
+        token_bucket = self._token_bucket_by_key.get(key)
+        if token_bucket is None:
+            if len(self._token_bucket_by_key) >= self._max_num_buckets:
+                self._forget_full_buckets()
+            token_bucket = self._token_bucket_by_key[key] = TokenBucket(
+                capacity=self.requests_per_minute,
+                refill_rate_per_second=self.requests_per_minute / 60,
+            )
+        retry_after_seconds = token_bucket.try_consume()
+        if retry_after_seconds or not self.use_shared_buckets:
+            return retry_after_seconds
+        retry_after_seconds = await self._try_consume_shared(
+            key, self.requests_per_minute
+        )
+        if retry_after_seconds:
+            # turned away, so retrying shouldn't drain this worker's bucket as well
+            token_bucket.refund()
+        return retry_after_seconds
+
+    def _forget_full_buckets(self) -> None:
+        """
+        Every user and endpoint that was ever limited has a bucket, and a bucket that's
+        full again (i.e. idle for a minute or so) is no different from a new one. The
+        next time is once there are twice as many buckets as are left, so that forgetting
+        takes constant time per request on average
+        """
+        self._token_bucket_by_key = {
+            key: token_bucket
+            for key, token_bucket in self._token_bucket_by_key.items()
+            if not token_bucket.is_full()
+        }
+        self._max_num_buckets = max(
+            MIN_NUM_BUCKETS_BEFORE_FORGETTING, 2 * len(self._token_bucket_by_key)
+        )
+
+    async def _try_consume_shared(self, key: str, requests_per_minute: float) -> float:
+        # the bucket is refilled and (maybe) consumed in one statement, which locks the
+        # row, so concurrent requests from other workers can't both take the last token
+        consume_query = """
+            WITH bucket AS (
+                SELECT LEAST(
+                    $2,
+                    available_tokens + EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - refilled_at) * $3
+                ) AS refilled_tokens
+                FROM rate_limit_buckets WHERE bucket_key=$1
+                FOR UPDATE
+            )
+            UPDATE rate_limit_buckets SET
+                available_tokens = CASE WHEN bucket.refilled_tokens >= 1
+                    THEN bucket.refilled_tokens - 1
+                    ELSE bucket.refilled_tokens
+                END,
+                refilled_at = CURRENT_TIMESTAMP
+            FROM bucket
+            WHERE bucket_key=$1
+            RETURNING bucket.refilled_tokens
+        """
+        refill_rate_per_second = requests_per_minute / 60
+        async with self.get_connection() as connection:
+            refilled_tokens = await connection.fetchval(
+                consume_query, key, requests_per_minute, refill_rate_per_second
+            )
+            if refilled_tokens is None:
+                # the key's first request
+                await connection.execute(
+                    "INSERT INTO rate_limit_buckets (bucket_key, available_tokens, refilled_at) VALUES ($1, $2, CURRENT_TIMESTAMP) ON CONFLICT DO NOTHING",
+                    key,
+                    requests_per_minute,
+                )
+                refilled_tokens = await connection.fetchval(
+                    consume_query, key, requests_per_minute, refill_rate_per_second
+                )
+        if refilled_tokens >= 1:
+            return 0
+        return float((1 - refilled_tokens) / refill_rate_per_second)
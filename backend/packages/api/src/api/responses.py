@@ -0,0 +1,22 @@
+from typing import Any
+
+import pydantic_core
+from fastapi.responses import JSONResponse
+
+
+class PydanticJSONResponse(JSONResponse):
+    """
+    Serializes pydantic models (and lists, dicts... of them) straight to JSON bytes,
+    instead of FastAPI validating them against the route's `response_model` and turning
+    them into dicts first. Return it from routes that still declare a `response_model`,
+    so that the docs keep the schema.
+
+    ```
+    @router.get("/chat", response_model=Chat)
+    async def get_chat(...) -> Response:
+        return PydanticJSONResponse(await messages_manager.get_chat_of_user(...))
+    ```
+    """
+
+    def render(self, content: Any) -> bytes:
+        return pydantic_core.to_json(content)
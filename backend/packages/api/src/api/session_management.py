@@ -2,12 +2,17 @@ import datetime
 import uuid
 from typing import Iterable
 
+from backend_commons import PeriodicTask
 from backend_commons.postgres_table_manager import (
     IdempotentMigration,
     PostgresTableManager,
 )
 from fastapi import HTTPException, status
+from k4_logger import log
 from pydantic import BaseModel
+from utils.environment import is_sliding_session_expiry_enabled
+
+SESSION_LIFETIME = datetime.timedelta(days=14)
 
 
 class SessionInDb(BaseModel):
@@ -22,6 +27,40 @@ class SessionInDb(BaseModel):
 
 
 class SessionsManager(PostgresTableManager):
+    """
+    Expired and deactivated sessions are deleted in the background, in batches of
+    `reap_batch_size`, so that the table (and its indexes) only hold live sessions.
+    Every worker reaps; they skip the rows another worker is already deleting.
+
+    `last_seen_at` isn't written on every request: `record_session_seen` only notes it
+    in memory, and every `last_seen_at_flush_interval_seconds` the worker writes what
+    it noted in one `UPDATE`. With sliding expiry, that `UPDATE` pushes back
+    `expires_at` as well.
+
+    `start()` is called by `run_migrations_and_start_table_managers`, so only
+    `await sessions_manager.stop()` before closing the connection pool.
+    """
+
+    def __init__(
+        self,
+        reap_interval_seconds: float = 300.0,
+        reap_batch_size: int = 1000,
+        last_seen_at_flush_interval_seconds: float = 60.0,
+    ) -> None:
+        super().__init__()
+        self.reap_batch_size = reap_batch_size
+        self.sessions_reaper = PeriodicTask(
+            "sessions_reaper",
+            run_once=self.reap_sessions,
+            interval_seconds=reap_interval_seconds,
+        )
+        self._last_seen_at_by_session_id: dict[uuid.UUID, datetime.datetime] = {}
+        self.last_seen_at_flusher = PeriodicTask(
+            "sessions_last_seen_at_flusher",
+            run_once=self.flush_last_seen_at,
+            interval_seconds=last_seen_at_flush_interval_seconds,
+        )
+
     @property
     def create_table_queries(self) -> Iterable[str]:
         return [
@@ -43,17 +82,100 @@ class SessionsManager(PostgresTableManager):
     def create_indexes_queries(self) -> Iterable[str]:
         return [
             "CREATE INDEX IF NOT EXISTS idx_user_id ON sessions(user_id)",
+            # what `get_unexpired_session` looks up on every request. Expiry can't be
+            # part of the predicate (it isn't immutable), but the reaper keeps the
+            # expired sessions out of it soon enough
+            "CREATE INDEX IF NOT EXISTS idx_sessions_active ON sessions(session_id) WHERE is_active",
+            # what `reap_sessions` looks for. Both sides of its `OR` need an index, or
+            # every reap scans the whole table. The inactive ones are few, since
+            # they're reaped
+            "CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions(expires_at)",
+            "CREATE INDEX IF NOT EXISTS idx_sessions_inactive ON sessions(session_id) WHERE NOT is_active",
         ]
 
     @property
     def IDEMPOTENT_MIGRATIONS(self) -> list[IdempotentMigration]:
         return []
 
+    async def start(self) -> None:
+        self.sessions_reaper.start()
+        self.last_seen_at_flusher.start()
+
+    async def stop(self) -> None:
+        await self.sessions_reaper.stop()
+        await self.last_seen_at_flusher.stop(run_once_more=True)
+
+    def record_session_seen(self, session_id: uuid.UUID) -> None:
+        """
+        Costs a dict assignment. The DB hears about it on the next flush
+        """
+        self._last_seen_at_by_session_id[session_id] = datetime.datetime.now(
+            datetime.UTC
+        )
+
+    async def flush_last_seen_at(self) -> None:
+        if not self._last_seen_at_by_session_id:
+            return
+        last_seen_at_by_session_id = self._last_seen_at_by_session_id
+        self._last_seen_at_by_session_id = {}
+        try:
+            async with self.get_transaction_connection() as connection:
+                await connection.execute(
+                    """
+                    UPDATE sessions SET
+                        last_seen_at = seen.last_seen_at,
+                        expires_at = CASE WHEN $3
+                            THEN GREATEST(sessions.expires_at, seen.last_seen_at + $4::INTERVAL)
+                            ELSE sessions.expires_at
+                        END
+                    FROM unnest($1::UUID[], $2::TIMESTAMP WITH TIME ZONE[]) AS seen(session_id, last_seen_at)
+                    WHERE sessions.session_id = seen.session_id
+                        AND sessions.last_seen_at < seen.last_seen_at
+                    """,
+                    list(last_seen_at_by_session_id),
+                    list(last_seen_at_by_session_id.values()),
+                    is_sliding_session_expiry_enabled(),
+                    SESSION_LIFETIME,
+                )
+        except BaseException:
+            # try again on the next flush, unless the session has been seen since
+            for session_id, last_seen_at in last_seen_at_by_session_id.items():
+                self._last_seen_at_by_session_id.setdefault(session_id, last_seen_at)
+            raise
+
+    async def reap_sessions(self) -> int:
+        """
+        Deletes every expired or deactivated session, one batch per transaction, and
+        returns how many were deleted
+        """
+        num_reaped_sessions = 0
+        while True:
+            async with self.get_transaction_connection() as connection:
+                delete_status = await connection.execute(
+                    """
+                    DELETE FROM sessions WHERE session_id IN (
+                        SELECT session_id FROM sessions
+                        WHERE expires_at <= CURRENT_TIMESTAMP OR NOT is_active
+                        LIMIT $1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    """,
+                    self.reap_batch_size,
+                )
+            # e.g. "DELETE 1000"
+            num_deleted_sessions = int(delete_status.split()[-1])
+            num_reaped_sessions += num_deleted_sessions
+            if num_deleted_sessions < self.reap_batch_size:
+                break
+        if num_reaped_sessions:
+            log.info(f"Reaped {num_reaped_sessions} expired or deactivated sessions")
+        return num_reaped_sessions
+
     async def create_session(
         self, user_id: int, user_agent: str, ip_address: str
     ) -> SessionInDb:
         session_id = uuid.uuid4()
-        expires_at = datetime.datetime.now(datetime.UTC) + datetime.timedelta(days=14)
+        expires_at = datetime.datetime.now(datetime.UTC) + SESSION_LIFETIME
         async with self.get_transaction_connection() as connection:
             new_session = await connection.fetchrow(
                 "INSERT INTO sessions (session_id, user_id, expires_at, user_agent, ip_address) VALUES ($1, $2, $3, $4, $5) RETURNING *",
@@ -69,7 +191,7 @@ class SessionsManager(PostgresTableManager):
     async def get_unexpired_session(self, session_id: uuid.UUID) -> SessionInDb:
         async with self.get_connection() as connection:
             row = await connection.fetchrow(
-                "SELECT * FROM sessions WHERE session_id=$1 AND expires_at > CURRENT_TIMESTAMP",
+                "SELECT * FROM sessions WHERE session_id=$1 AND is_active AND expires_at > CURRENT_TIMESTAMP",
                 str(session_id),
             )
             if not row:
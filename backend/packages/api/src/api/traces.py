@@ -0,0 +1,37 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from k4_logger import Trace, in_memory_traces
+
+from ._dependencies import get_current_active_admin_user
+from .user_management import AdminUser
+
+traces_router = APIRouter()
+
+
+# `async`, so that it reads the traces on the event loop, where they're exported
+@traces_router.get("/traces")
+async def get_traces(
+    limit: int = Query(default=50, gt=0),
+    name_prefix: str | None = None,
+    min_duration_seconds: float = 0.0,
+    current_admin_user: AdminUser = Depends(get_current_active_admin_user),
+) -> list[Trace]:
+    """
+    The latest traces this worker kept in memory, most recent first. E.g.
+    `GET /traces?name_prefix=POST /message&min_duration_seconds=5` for the slow
+    messages, and where their time went
+    """
+    if in_memory_traces is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Traces aren't kept in memory, see K4_TRACES_IN_MEMORY.",
+        )
+    matching_traces: list[Trace] = []
+    for trace in in_memory_traces.get_traces():
+        if name_prefix is not None and not trace.name.startswith(name_prefix):
+            continue
+        if trace.duration_seconds < min_duration_seconds:
+            continue
+        matching_traces.append(trace)
+        if len(matching_traces) >= limit:
+            break
+    return matching_traces
@@ -0,0 +1,31 @@
+from k4_logger import get_request_id, trace
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+class TracingMiddleware:
+    """
+    Traces every HTTP request, so that `span`s opened while handling it (and in the
+    tasks it starts) are part of its trace. WebSocket connections aren't traced as a
+    whole, each of their requests is (see `chat_websocket`).
+
+    Add it inside `RequestIdMiddleware`, so that traces carry the request's id. A plain
+    ASGI middleware, for the same reason as `RequestIdMiddleware`
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with trace(
+            f"{scope['method']} {scope['path']}", request_id=get_request_id()
+        ) as request_span:
+
+            async def send_with_status_code(message: Message) -> None:
+                if message["type"] == "http.response.start":
+                    request_span.set_attribute("status_code", message["status"])
+                await send(message)
+
+            await self.app(scope, receive, send_with_status_code)
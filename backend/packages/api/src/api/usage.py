@@ -0,0 +1,21 @@
+from fastapi import APIRouter, Depends
+
+from ._dependencies import get_current_active_admin_user, usage_manager
+from .usage_management import ModelUsage, UserUsage
+from .user_management import AdminUser
+
+usage_router = APIRouter()
+
+
+@usage_router.get("/usage/users")
+async def get_usage_by_user(
+    current_admin_user: AdminUser = Depends(get_current_active_admin_user),
+) -> list[UserUsage]:
+    return await usage_manager.get_usage_by_user()
+
+
+@usage_router.get("/usage/models")
+async def get_usage_by_model(
+    current_admin_user: AdminUser = Depends(get_current_active_admin_user),
+) -> list[ModelUsage]:
+    return await usage_manager.get_usage_by_model()
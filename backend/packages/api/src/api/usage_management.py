@@ -0,0 +1,176 @@
+from typing import Iterable
+
+from backend_commons import BatchedWriter, PostgresTableManager
+from backend_commons.postgres_table_manager import IdempotentMigration
+from pydantic import BaseModel
+
+from k4 import LlmUsage
+
+
+class LlmUsageRecord(BaseModel):
+    message_id: int
+    user_id: int
+    llm_usage: LlmUsage
+
+
+class UsageTotals(BaseModel):
+    num_messages: int
+    prompt_tokens: int
+    completion_tokens: int
+    estimated_cost_usd: float
+
+
+class UserUsage(UsageTotals):
+    user_id: int
+
+
+class ModelUsage(UsageTotals):
+    model: str
+
+
+class UsageManager(PostgresTableManager):
+    """
+    Every assistant message gets a row in `llm_usage`. The per-(user, model) totals in
+    `llm_usage_rollups` are kept up to date as rows are inserted, so reading the
+    aggregates doesn't scan the whole history.
+
+    Writes go through a `BatchedWriter`, so call `usage_writer.start()` once the
+    connection pool is set, and `await usage_writer.stop()` before closing it.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.usage_writer = BatchedWriter[LlmUsageRecord, None](
+            "llm_usage",
+            write_batch=self._write_usage_records,
+            max_delay_seconds=1.0,
+        )
+
+    @property
+    def create_table_queries(self) -> list[str]:
+        # user_id is the owner of the chat, since assistant messages have no user_id
+        return [
+            """
+        CREATE TABLE IF NOT EXISTS llm_usage (
+            usage_id SERIAL PRIMARY KEY,
+            message_id INT NOT NULL REFERENCES messages (message_id) ON DELETE CASCADE,
+            user_id INT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+            model VARCHAR(255) NOT NULL,
+            prompt_tokens INT NOT NULL,
+            completion_tokens INT NOT NULL,
+            estimated_cost_usd DOUBLE PRECISION NOT NULL,
+            is_counted_locally BOOLEAN NOT NULL,
+            inserted_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+            # not cascaded from messages: deleting a chat doesn't undo its usage
+            """
+        CREATE TABLE IF NOT EXISTS llm_usage_rollups (
+            user_id INT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+            model VARCHAR(255) NOT NULL,
+            num_messages BIGINT NOT NULL,
+            prompt_tokens BIGINT NOT NULL,
+            completion_tokens BIGINT NOT NULL,
+            estimated_cost_usd DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (user_id, model)
+        )
+        """,
+        ]
+
+    @property
+    def create_indexes_queries(self) -> Iterable[str]:
+        return (
+            "CREATE INDEX IF NOT EXISTS idx_llm_usage_message_id ON llm_usage(message_id)",
+        )
+
+    @property
+    def IDEMPOTENT_MIGRATIONS(self) -> list[IdempotentMigration]:
+        return []
+
+    def record_usage(self, message_id: int, user_id: int, llm_usage: LlmUsage) -> None:
+        self.usage_writer.write_nowait(
+            LlmUsageRecord(message_id=message_id, user_id=user_id, llm_usage=llm_usage)
+        )
+
+    async def _write_usage_records(
+        self, usage_records: list[LlmUsageRecord]
+    ) -> list[None]:
+        rollup_by_user_id_and_model: dict[tuple[int, str], UsageTotals] = {}
+        for usage_record in usage_records:
+            rollup = rollup_by_user_id_and_model.setdefault(
+                (usage_record.user_id, usage_record.llm_usage.model),
+                UsageTotals(
+                    num_messages=0,
+                    prompt_tokens=0,
+                    completion_tokens=0,
+                    estimated_cost_usd=0,
+                ),
+            )
+            rollup.num_messages += 1
+            rollup.prompt_tokens += usage_record.llm_usage.prompt_tokens
+            rollup.completion_tokens += usage_record.llm_usage.completion_tokens
+            rollup.estimated_cost_usd += usage_record.llm_usage.estimated_cost_usd
+
+        async with self.get_transaction_connection() as connection:
+            await connection.executemany(
+                "INSERT INTO llm_usage (message_id, user_id, model, prompt_tokens, completion_tokens, estimated_cost_usd, is_counted_locally) VALUES ($1, $2, $3, $4, $5, $6, $7)",
+                [
+                    (
+                        usage_record.message_id,
+                        usage_record.user_id,
+                        usage_record.llm_usage.model,
+                        usage_record.llm_usage.prompt_tokens,
+                        usage_record.llm_usage.completion_tokens,
+                        usage_record.llm_usage.estimated_cost_usd,
+                        usage_record.llm_usage.is_counted_locally,
+                    )
+                    for usage_record in usage_records
+                ],
+            )
+            # sorted, so that two workers upserting the same rollups lock them in the
+            # same order and can't deadlock
+            await connection.executemany(
+                """
+                INSERT INTO llm_usage_rollups (user_id, model, num_messages, prompt_tokens, completion_tokens, estimated_cost_usd)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                ON CONFLICT (user_id, model) DO UPDATE SET
+                    num_messages = llm_usage_rollups.num_messages + EXCLUDED.num_messages,
+                    prompt_tokens = llm_usage_rollups.prompt_tokens + EXCLUDED.prompt_tokens,
+                    completion_tokens = llm_usage_rollups.completion_tokens + EXCLUDED.completion_tokens,
+                    estimated_cost_usd = llm_usage_rollups.estimated_cost_usd + EXCLUDED.estimated_cost_usd
+                """,
+                [
+                    (
+                        user_id,
+                        model,
+                        rollup.num_messages,
+                        rollup.prompt_tokens,
+                        rollup.completion_tokens,
+                        rollup.estimated_cost_usd,
+                    )
+                    for (user_id, model), rollup in sorted(
+                        rollup_by_user_id_and_model.items()
+                    )
+                ],
+            )
+        return [None] * len(usage_records)
+
+    async def get_usage_by_user(self) -> list[UserUsage]:
+        async with self.get_connection() as connection:
+            rows = await connection.fetch(
+                """
+                SELECT user_id, sum(num_messages)::BIGINT AS num_messages, sum(prompt_tokens)::BIGINT AS prompt_tokens, sum(completion_tokens)::BIGINT AS completion_tokens, sum(estimated_cost_usd) AS estimated_cost_usd
+                FROM llm_usage_rollups GROUP BY user_id ORDER BY estimated_cost_usd DESC
+                """
+            )
+            return [UserUsage(**row) for row in rows]
+
+    async def get_usage_by_model(self) -> list[ModelUsage]:
+        async with self.get_connection() as connection:
+            rows = await connection.fetch(
+                """
+                SELECT model, sum(num_messages)::BIGINT AS num_messages, sum(prompt_tokens)::BIGINT AS prompt_tokens, sum(completion_tokens)::BIGINT AS completion_tokens, sum(estimated_cost_usd) AS estimated_cost_usd
+                FROM llm_usage_rollups GROUP BY model ORDER BY estimated_cost_usd DESC
+                """
+            )
+            return [ModelUsage(**row) for row in rows]
@@ -51,7 +51,7 @@ class UsersManager(PostgresTableManager):
     ```
     users_manager = UsersManager()
     connection_pool: asyncpg.Pool = await asyncpg.create_pool(...)
-    users_manager.set_connection_pool_and_start(connection_pool)
+    await users_manager.set_connection_pool_and_run_migrations_and_start(connection_pool)
     # now it's usable
     ```
     """
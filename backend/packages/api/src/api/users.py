@@ -1,5 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from k4_logger import log
+from k4_logger import lazy, log
 from pydantic import SecretStr
 
 from ._dependencies import (
@@ -22,7 +22,9 @@ async def create_user(
         hash_password(new_user_details.desired_user_password.get_secret_value())
     )
     log.info(
-        f"Admin `{current_admin_user.user_email}` is creating a non-admin user. {new_user_details.model_dump_json()}"
+        "Admin `%s` is creating a non-admin user. %s",
+        current_admin_user.user_email,
+        lazy(new_user_details.model_dump_json),
     )
     return await users_manager.create_user(
         desired_user_email=new_user_details.desired_user_email,
@@ -51,7 +53,9 @@ async def reactivate_user(
     current_admin_user: AdminUser = Depends(get_current_active_admin_user),
 ) -> None:
     log.info(
-        f"Admin `{current_admin_user.user_email}` is reactivating a user. {user_to_reactivate.model_dump_json()}"
+        "Admin `%s` is reactivating a user. %s",
+        current_admin_user.user_email,
+        lazy(user_to_reactivate.model_dump_json),
     )
     await users_manager.reactivate_user(user_to_reactivate)
 
@@ -79,7 +83,9 @@ async def create_admin_user(
         hash_password(new_user_details.desired_user_password.get_secret_value())
     )
     log.info(
-        f"Admin `{current_admin_user.user_email}` is creating an admin user. {new_user_details.model_dump_json()}"
+        "Admin `%s` is creating an admin user. %s",
+        current_admin_user.user_email,
+        lazy(new_user_details.model_dump_json),
     )
     return await users_manager.create_user(
         desired_user_email=new_user_details.desired_user_email,
@@ -1,4 +1,16 @@
 __version__ = "0.0.1"
-from .postgres_table_manager import IdempotentMigration, PostgresTableManager
+from .batched_writer import BatchedWriter
+from .periodic_task import PeriodicTask
+from .postgres_table_manager import (
+    IdempotentMigration,
+    PostgresTableManager,
+    run_migrations_and_start_table_managers,
+)
 
-__all__ = ["PostgresTableManager", "IdempotentMigration"]
+__all__ = [
+    "PostgresTableManager",
+    "IdempotentMigration",
+    "BatchedWriter",
+    "PeriodicTask",
+    "run_migrations_and_start_table_managers",
+]
@@ -0,0 +1,127 @@
+import asyncio
+from typing import Awaitable, Callable
+
+from k4_logger import log
+
+
+class BatchedWriter[_ItemType, _ResultType]:
+    """
+    Collects items written by many coroutines and hands them to `write_batch` in
+    batches, so that e.g. N concurrent single-row inserts become one multi-row insert in
+    one transaction.
+
+    While a batch is being written, new items pile up in the queue and become the next
+    batch. So under load the batches grow on their own, and when things are quiet an
+    item is written right away (unless `max_delay_seconds` says to wait for company).
+
+    ```
+    writer = BatchedWriter("usage", write_batch=insert_usage_rows)
+    writer.start()
+    writer.write_nowait(usage)  # fire-and-forget
+    message = await writer.write(message)  # waits until its batch is committed
+    await writer.stop()  # writes whatever is still queued
+    ```
+    """
+
+    def __init__(
+        self,
+        name: str,
+        write_batch: Callable[[list[_ItemType]], Awaitable[list[_ResultType]]],
+        max_batch_size: int = 500,
+        max_delay_seconds: float = 0.0,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        name : str
+            Only used for logging
+        write_batch : Callable[[list[_ItemType]], Awaitable[list[_ResultType]]]
+            Writes the items, and returns one result per item, in the same order. Must
+            write all of them or none (e.g. in one transaction): if a batch fails, its
+            items are written again one at a time, so that only the failing ones fail
+        max_batch_size : int, optional
+            by default 500
+        max_delay_seconds : float, optional
+            How long the first item of a batch may wait for more items to arrive, by
+            default 0
+        """
+        self.name = name
+        self.write_batch = write_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay_seconds = max_delay_seconds
+        self._queue: asyncio.Queue[
+            tuple[_ItemType, asyncio.Future[_ResultType] | None]
+        ] = asyncio.Queue()
+        self._flushing_task: asyncio.Task[None] | None = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._flushing_task is not None
+
+    def start(self) -> None:
+        if self._flushing_task is None:
+            self._flushing_task = asyncio.create_task(
+                self._flush_forever(), name=f"{self.name}_batched_writer"
+            )
+
+    async def stop(self) -> None:
+        """
+        Waits for everything queued to be written, then stops
+        """
+        if self._flushing_task is None:
+            return
+        await self._queue.join()
+        self._flushing_task.cancel()
+        await asyncio.gather(self._flushing_task, return_exceptions=True)
+        self._flushing_task = None
+
+    async def write(self, item: _ItemType) -> _ResultType:
+        if not self.is_running:
+            return (await self.write_batch([item]))[0]
+        future: asyncio.Future[_ResultType] = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    def write_nowait(self, item: _ItemType) -> None:
+        """
+        The item is written eventually. Failures are logged, since there's no one to
+        raise them to. Items written before `start()` is called wait in the queue.
+        """
+        self._queue.put_nowait((item, None))
+
+    async def _flush_forever(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            if self.max_delay_seconds:
+                await asyncio.sleep(self.max_delay_seconds)
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _write(
+        self, batch: list[tuple[_ItemType, asyncio.Future[_ResultType] | None]]
+    ) -> None:
+        try:
+            results = await self.write_batch([item for item, _ in batch])
+        except Exception as exception:
+            if len(batch) > 1:
+                # one bad item (e.g. a row whose chat was just deleted) shouldn't fail
+                # everyone else's, so find it
+                log.warning(
+                    f"{self.name}: failed to write a batch of {len(batch)} ({exception!r}), writing its items one at a time"
+                )
+                for item_and_future in batch:
+                    await self._write([item_and_future])
+                return
+            log.exception(f"{self.name}: failed to write an item")
+            for _, future in batch:
+                if future is not None and not future.done():
+                    future.set_exception(exception)
+            return
+        for (_, future), result in zip(batch, results, strict=True):
+            if future is not None and not future.done():
+                future.set_result(result)
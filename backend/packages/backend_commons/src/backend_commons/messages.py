@@ -1,6 +1,8 @@
 import datetime
+from typing import Any, Iterable, Mapping
 
-from pydantic import BaseModel, RootModel
+from asyncpg import Record
+from pydantic import BaseModel, RootModel, TypeAdapter
 
 
 class MessageInDb(BaseModel):
@@ -11,6 +13,21 @@ class MessageInDb(BaseModel):
     inserted_at: datetime.datetime
 
 
+_messages_in_db_adapter = TypeAdapter(list[MessageInDb])
+
+
+def messages_in_db_from_rows(
+    rows: Iterable[Record | Mapping[str, Any]],
+) -> list[MessageInDb]:
+    """
+    Same as `[MessageInDb(**row) for row in rows]`, but the rows are validated in one
+    call into pydantic-core instead of one call each, which adds up on long chats.
+
+    `MessageInDb.model_construct` skips validation, but runs in Python, and ends up slower
+    """
+    return _messages_in_db_adapter.validate_python([dict(row) for row in rows])
+
+
 class Message(BaseModel):
     text: str
     sender_id: int
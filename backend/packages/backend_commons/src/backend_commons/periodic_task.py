@@ -0,0 +1,64 @@
+import asyncio
+from typing import Awaitable, Callable
+
+from k4_logger import log
+
+
+class PeriodicTask:
+    """
+    Calls `run_once` every `interval_seconds` in the background, e.g. to clean up a
+    table. A failing run is logged, and the next one happens on schedule anyway.
+
+    ```
+    reaper = PeriodicTask("sessions_reaper", run_once=reap_sessions, interval_seconds=300)
+    reaper.start()
+    await reaper.stop()
+    ```
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run_once: Callable[[], Awaitable[object]],
+        interval_seconds: float,
+    ) -> None:
+        self.name = name
+        self.run_once = run_once
+        self.interval_seconds = interval_seconds
+        self._running_task: asyncio.Task[None] | None = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._running_task is not None
+
+    def start(self) -> None:
+        if self._running_task is None:
+            self._running_task = asyncio.create_task(
+                self._run_forever(), name=self.name
+            )
+
+    async def stop(self, run_once_more: bool = False) -> None:
+        """
+        Parameters
+        ----------
+        run_once_more : bool, optional
+            e.g. to flush whatever accumulated since the last run, by default False
+        """
+        if self._running_task is None:
+            return
+        self._running_task.cancel()
+        await asyncio.gather(self._running_task, return_exceptions=True)
+        self._running_task = None
+        if run_once_more:
+            await self._run_once_and_log_failure()
+
+    async def _run_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            await self._run_once_and_log_failure()
+
+    async def _run_once_and_log_failure(self) -> None:
+        try:
+            await self.run_once()
+        except Exception:
+            log.exception(f"{self.name}: failed, will try again later")
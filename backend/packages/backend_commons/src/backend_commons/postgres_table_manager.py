@@ -1,10 +1,13 @@
+import asyncio
+import hashlib
 from abc import ABC, abstractmethod
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass
-from typing import Any, AsyncGenerator, Iterable
+from typing import Any, AsyncGenerator, Iterable, Mapping, Sequence
 
 import asyncpg
-from k4_logger import log
+from k4_logger import log, span
 
 
 @dataclass
@@ -12,6 +15,146 @@ class IdempotentMigration:
     name: str
     query_or_queries: str | list[str]
 
+    @property
+    def queries(self) -> list[str]:
+        if isinstance(self.query_or_queries, str):
+            return [self.query_or_queries]
+        return self.query_or_queries
+
+    @property
+    def schema_hash(self) -> str:
+        """
+        Changes whenever the queries do, so an edited migration runs again
+        """
+        return hashlib.sha256("\n;\n".join(self.queries).encode("utf-8")).hexdigest()
+
+
+# every worker takes the same lock, so only one of them migrates at a time. The number
+# is arbitrary
+_SCHEMA_MIGRATIONS_ADVISORY_LOCK_ID = 0x6B34_0001
+_CREATE_SCHEMA_MIGRATIONS_TABLE_QUERY = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    table_manager_name VARCHAR(255) NOT NULL,
+    migration_name VARCHAR(255) NOT NULL,
+    schema_hash CHAR(64) NOT NULL,
+    applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (table_manager_name, migration_name)
+)
+"""
+_CREATE_TABLES_MIGRATION_NAME = "create_table_queries and create_indexes_queries"
+
+# (table_manager_name, migration_name) -> schema_hash
+type AppliedSchemaHashes = Mapping[tuple[str, str], str]
+
+
+async def _get_applied_schema_hashes(
+    connection: "asyncpg.pool.PoolConnectionProxy[asyncpg.Record]",
+) -> AppliedSchemaHashes:
+    if not await connection.fetchval(
+        "SELECT to_regclass('schema_migrations') IS NOT NULL"
+    ):
+        return {}
+    rows = await connection.fetch(
+        "SELECT table_manager_name, migration_name, schema_hash FROM schema_migrations"
+    )
+    return {
+        (row["table_manager_name"], row["migration_name"]): row["schema_hash"]
+        for row in rows
+    }
+
+
+async def run_migrations_and_start_table_managers(
+    connection_pool: "asyncpg.Pool[asyncpg.Record]",
+    table_managers_in_stages: Sequence[Sequence["PostgresTableManager"]],
+) -> None:
+    """
+    Brings the tables of every manager up to date, then starts the managers.
+
+    Every migration applied (and every version of a manager's tables and indexes) is
+    recorded in `schema_migrations` along with a hash of its queries. A worker starting
+    against an up-to-date database doesn't run any DDL, so it takes no locks. Otherwise
+    the workers take turns on an advisory lock, and all but the first find that there's
+    nothing left to do.
+
+    ```
+    await run_migrations_and_start_table_managers(
+        connection_pool,
+        [[users_manager], [messages_manager, sessions_manager]],
+    )
+    ```
+
+    Parameters
+    ----------
+    connection_pool : asyncpg.Pool[asyncpg.Record]
+    table_managers_in_stages : Sequence[Sequence[PostgresTableManager]]
+        The stages are migrated one after the other, and the managers of a stage
+        concurrently. So a manager's tables may only reference tables of earlier stages
+    """
+    table_managers = [
+        table_manager
+        for table_managers_of_stage in table_managers_in_stages
+        for table_manager in table_managers_of_stage
+    ]
+    for table_manager in table_managers:
+        table_manager.postgres_connection_pool = connection_pool
+
+    async with connection_pool.acquire() as connection:
+        applied_schema_hashes = await _get_applied_schema_hashes(connection)
+        if any(
+            table_manager.get_pending_migrations(applied_schema_hashes)
+            for table_manager in table_managers
+        ):
+            await connection.execute(
+                "SELECT pg_advisory_lock($1)", _SCHEMA_MIGRATIONS_ADVISORY_LOCK_ID
+            )
+            try:
+                await connection.execute(_CREATE_SCHEMA_MIGRATIONS_TABLE_QUERY)
+                # another worker may have migrated while we waited for the lock
+                applied_schema_hashes = await _get_applied_schema_hashes(connection)
+                for table_managers_of_stage in table_managers_in_stages:
+                    await asyncio.gather(
+                        *(
+                            table_manager._run_migrations(
+                                table_manager.get_pending_migrations(
+                                    applied_schema_hashes
+                                )
+                            )
+                            for table_manager in table_managers_of_stage
+                        )
+                    )
+            finally:
+                await connection.execute(
+                    "SELECT pg_advisory_unlock($1)", _SCHEMA_MIGRATIONS_ADVISORY_LOCK_ID
+                )
+        else:
+            log.info("Every table is up to date, no migrations to run")
+
+    await asyncio.gather(*(table_manager.start() for table_manager in table_managers))
+
+
+class _SharedConnection:
+    def __init__(
+        self,
+        connection: "asyncpg.pool.PoolConnectionProxy[asyncpg.Record]",
+        connection_pool: "asyncpg.Pool[asyncpg.Record]",
+    ) -> None:
+        self.connection = connection
+        self.connection_pool = connection_pool
+        # a connection can only run one query at a time, so concurrent users of the
+        # shared connection (e.g. in an `asyncio.gather`) get their own connections
+        self.lock = asyncio.Lock()
+        self.is_released = False
+
+    async def release(self) -> None:
+        if not self.is_released:
+            self.is_released = True
+            await self.connection_pool.release(self.connection)
+
+
+_shared_connection: ContextVar[_SharedConnection | None] = ContextVar(
+    "shared_postgres_connection", default=None
+)
+
 
 class PostgresTableManager(ABC):
     """
@@ -26,7 +169,7 @@ class PostgresTableManager(ABC):
     ```
     users_manager = UsersManager("users")
     connection_pool: asyncpg.Pool = await asyncpg.create_pool(...)
-    users_manager.set_connection_pool_and_start(connection_pool)
+    await users_manager.set_connection_pool_and_run_migrations_and_start(connection_pool)
     # now it's usable
     ```
     """
@@ -48,14 +191,45 @@ class PostgresTableManager(ABC):
         if self.postgres_connection_pool:
             return self.postgres_connection_pool
         raise NotImplementedError(
-            "Connection pool was not provided. You must call `set_connection_pool_and_start` after instatiating."
+            "Connection pool was not provided. You must call `set_connection_pool_and_run_migrations_and_start` after instatiating."
         )
 
     @property
     @abstractmethod
     def IDEMPOTENT_MIGRATIONS(self) -> list[IdempotentMigration]: ...
 
-    async def _perform_migrations_if_any(self) -> None:
+    @property
+    def table_manager_name(self) -> str:
+        return self.__class__.__name__
+
+    def _get_migrations(self) -> list[IdempotentMigration]:
+        return [
+            *self.IDEMPOTENT_MIGRATIONS,
+            IdempotentMigration(
+                _CREATE_TABLES_MIGRATION_NAME,
+                [*self.create_table_queries, *self.create_indexes_queries],
+            ),
+        ]
+
+    def get_pending_migrations(
+        self, applied_schema_hashes: AppliedSchemaHashes
+    ) -> list[IdempotentMigration]:
+        """
+        The migrations (including the creation of the tables and indexes) that haven't
+        been applied, or whose queries changed since
+        """
+        return [
+            idempotent_migration
+            for idempotent_migration in self._get_migrations()
+            if applied_schema_hashes.get(
+                (self.table_manager_name, idempotent_migration.name)
+            )
+            != idempotent_migration.schema_hash
+        ]
+
+    async def _run_migrations(
+        self, idempotent_migrations: list[IdempotentMigration]
+    ) -> None:
         """
         Here we run any version-to-version migrations that need to take place.
 
@@ -74,64 +248,137 @@ class PostgresTableManager(ABC):
         forced to understand what I'm doing
         """
 
-        log.info(f"Running {len(self.IDEMPOTENT_MIGRATIONS)} migrations")
+        if not idempotent_migrations:
+            return
+        log.info(
+            f"Running {len(idempotent_migrations)} migrations for {self.table_manager_name}"
+        )
 
         async with self.get_transaction_connection() as connection:
-            for idempotent_migration in self.IDEMPOTENT_MIGRATIONS:
+            for idempotent_migration in idempotent_migrations:
                 log.info(f"Starting migration {idempotent_migration.name}")
-                if isinstance(idempotent_migration.query_or_queries, str):
-                    await connection.execute(idempotent_migration.query_or_queries)
-                else:
-                    for idempotent_query in idempotent_migration.query_or_queries:
-                        await connection.execute(idempotent_query)
+                for idempotent_query in idempotent_migration.queries:
+                    await connection.execute(idempotent_query)
+                await connection.execute(
+                    """
+                    INSERT INTO schema_migrations (table_manager_name, migration_name, schema_hash)
+                    VALUES ($1, $2, $3)
+                    ON CONFLICT (table_manager_name, migration_name) DO UPDATE SET
+                        schema_hash = EXCLUDED.schema_hash,
+                        applied_at = CURRENT_TIMESTAMP
+                    """,
+                    self.table_manager_name,
+                    idempotent_migration.name,
+                    idempotent_migration.schema_hash,
+                )
                 log.info(f"Completed migration {idempotent_migration.name}")
 
-        log.info(f"Finished running {len(self.IDEMPOTENT_MIGRATIONS)} migrations")
+        log.info(
+            f"Finished running {len(idempotent_migrations)} migrations for {self.table_manager_name}"
+        )
 
     async def set_connection_pool_and_run_migrations_and_start(
         self, connection_pool: "asyncpg.Pool[asyncpg.Record]"
     ) -> None:
-        self.postgres_connection_pool = connection_pool
-        await self._perform_migrations_if_any()
-        await self._ensure_table_is_created_in_db()
+        """
+        To start several managers, prefer `run_migrations_and_start_table_managers`
+        """
+        await run_migrations_and_start_table_managers(connection_pool, [[self]])
 
-    async def _ensure_table_is_created_in_db(self) -> None:
-        log.info(
-            (
-                f"Creating the {self.__class__.__name__} table if it doesn't already "
-                "exist. You may see a warning from aiomysql that the table already exists, "
-                "this is expected and harmless."
-            )
+    async def start(self) -> None:
+        """
+        Called once the connection pool is set and the tables are up to date. Override
+        this to e.g. load state from the tables
+        """
+
+    @asynccontextmanager
+    async def share_connection(self) -> AsyncGenerator[None, None]:
+        """
+        Until this exits, every `PostgresTableManager` using the same pool (in this
+        context, e.g. this request) uses one connection, rather than acquiring one from
+        the pool per method call.
+
+        ```
+        async with users_manager.share_connection():
+            user = await users_manager.get_user_by_user_id(user_id)  # acquires
+            chat = await messages_manager.get_chat_in_db(chat_id)  # reuses
+        ```
+        """
+        if self._get_shared_connection() is not None:
+            yield
+            return
+
+        connection_pool = self._get_connection_pool()
+        shared_connection = _SharedConnection(
+            await connection_pool.acquire(), connection_pool
         )
-        async with self.get_transaction_connection() as connection:
-            # TODO should have a script or something for modifying tables elegantly
-            for create_table_query in self.create_table_queries:
-                await connection.execute(create_table_query)
-            for create_index_query in self.create_indexes_queries:
-                await connection.execute(create_index_query)
-        log.info(f"Finished ensuring the {self.__class__.__name__} table is created")
+        token = _shared_connection.set(shared_connection)
+        try:
+            yield
+        finally:
+            await shared_connection.release()
+            try:
+                _shared_connection.reset(token)
+            except ValueError:
+                # exited in a different context than we entered, which is harmless:
+                # the connection is marked as released, so nobody will use it
+                pass
+
+    @staticmethod
+    async def release_shared_connection() -> None:
+        """
+        Gives the shared connection (if any) back to the pool before
+        `share_connection()` exits, e.g. before a long response stream starts. Managers
+        go back to acquiring their own connections.
+        """
+        shared_connection = _shared_connection.get()
+        if shared_connection is not None:
+            await shared_connection.release()
+
+    def _get_shared_connection(self) -> _SharedConnection | None:
+        shared_connection = _shared_connection.get()
+        if (
+            shared_connection is None
+            or shared_connection.is_released
+            or shared_connection.connection_pool is not self.postgres_connection_pool
+        ):
+            return None
+        return shared_connection
 
     @asynccontextmanager
     async def get_connection(
         self,
     ) -> AsyncGenerator["asyncpg.pool.PoolConnectionProxy[asyncpg.Record]", Any]:
         """
-        Acquire a Postgres connection
+        Acquire a Postgres connection, or use the shared one (see `share_connection`)
 
         Better for `SELECT` and other read methods
         """
-        async with self._get_connection_pool().acquire() as connection:
-            yield connection
+        shared_connection = self._get_shared_connection()
+        # entered and exited by the same caller, so unlike in other generators, it can be
+        # the current span across the `yield`
+        with span(f"postgres {self.table_manager_name}") as connection_span:
+            if shared_connection is not None and not shared_connection.lock.locked():
+                connection_span.set_attribute("is_shared_connection", True)
+                async with shared_connection.lock:
+                    yield shared_connection.connection
+            else:
+                connection_span.set_attribute("is_shared_connection", False)
+                async with self._get_connection_pool().acquire() as connection:
+                    connection_span.set_attribute(
+                        "connection_wait_seconds", connection_span.get_elapsed_seconds()
+                    )
+                    yield connection
 
     @asynccontextmanager
     async def get_transaction_connection(
         self,
     ) -> AsyncGenerator["asyncpg.pool.PoolConnectionProxy[asyncpg.Record]", Any]:
         """
-        Acquire a Postgres connection and execute a transaction
+        Acquire a Postgres connection (or use the shared one) and execute a transaction
 
         Better for `INSERT` and other write methods
         """
-        async with self._get_connection_pool().acquire() as connection:
+        async with self.get_connection() as connection:
             async with connection.transaction():
                 yield connection
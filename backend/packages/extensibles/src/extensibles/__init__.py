@@ -1,18 +1,28 @@
 __version__ = "0.0.1"
 from .extensibles import (
+    ExtensiblePluginName,
     hookimpl,
     hookspec,
+    load_external_plugin,
     plugin_manager,
+    replace_plugin,
     replace_plugin_with_external_plugin,
+    unload_external_plugin_modules,
 )
 from .get_complete_chat_for_llm import (
+    ContextForLlm,
     GetCompleteChatDefaultImplementation,
     GetCompleteChatSpec,
+    GetContextSpec,
     ParamsForAlreadyExistingChat,
     get_complete_chat_for_llm,
+    merge_contexts_into_chat,
 )
+from .hook_calls import HookImplMetrics, get_hook_impl_metrics
+from .process_isolation import ProcessIsolatedPlugin
 
 plugin_manager.add_hookspecs(GetCompleteChatSpec)
+plugin_manager.add_hookspecs(GetContextSpec)
 
 
 __all__ = [
@@ -20,7 +30,16 @@ __all__ = [
     "hookspec",
     "plugin_manager",
     "replace_plugin_with_external_plugin",
+    "replace_plugin",
+    "load_external_plugin",
+    "unload_external_plugin_modules",
+    "ExtensiblePluginName",
     "get_complete_chat_for_llm",
     "ParamsForAlreadyExistingChat",
     "GetCompleteChatDefaultImplementation",
+    "HookImplMetrics",
+    "get_hook_impl_metrics",
+    "ProcessIsolatedPlugin",
+    "ContextForLlm",
+    "merge_contexts_into_chat",
 ]
@@ -1,4 +1,7 @@
+import importlib
 import inspect
+import linecache
+import sys
 import uuid
 from importlib import util as importlib_util
 from pathlib import Path
@@ -13,10 +16,18 @@ hookimpl = apluggy.HookimplMarker("k4")
 plugin_manager = apluggy.PluginManager("k4")
 
 
-def replace_plugin_with_external_plugin(
-    existing_plugin_name: Literal["get_complete_chat_for_llm"],
+ExtensiblePluginName = Literal["get_complete_chat_for_llm"]
+
+
+def load_external_plugin(
+    existing_plugin_name: ExtensiblePluginName,
     external_module_path: Path,
-) -> None:
+) -> type:
+    """
+    Imports the extension's module and returns the plugin class in it, without
+    registering it. Raises if there's no such module or plugin, so this doubles as a
+    check that an extension is usable
+    """
     if not external_module_path.exists():
         raise FileNotFoundError(f"Expected module {external_module_path} not found.")
 
@@ -47,9 +58,58 @@ def replace_plugin_with_external_plugin(
     # TODO this logic sucks, improve it
     for _, class_object in reversed(inspect.getmembers(module, inspect.isclass)):
         if class_object.__module__ == module_name:
-            log.info(
-                f"Installing an extension for {existing_plugin_name=} from {external_module_path=}"
-            )
-            plugin_manager.unregister(name=existing_plugin_name)
-            plugin_manager.register(class_object, name=existing_plugin_name)
-            break
+            return class_object
+    raise ImportError(f"No plugin class found in {external_module_path}.")
+
+
+def replace_plugin(existing_plugin_name: ExtensiblePluginName, plugin: object) -> None:
+    plugin_manager.unregister(name=existing_plugin_name)
+    plugin_manager.register(plugin, name=existing_plugin_name)
+
+
+def unload_external_plugin_modules(external_module_path: Path) -> list[str]:
+    """
+    Forgets every module imported from the extension's directory, so that reloading an
+    extension imports its code afresh and the old modules can be garbage collected once
+    nothing (e.g. an in-flight request) uses them anymore. Modules the extension merely
+    imported from elsewhere (e.g. numpy) are left alone, they may be shared.
+
+    Returns the names of the forgotten modules
+    """
+    extension_directory = (
+        external_module_path
+        if external_module_path.is_dir()
+        else external_module_path.parent
+    ).resolve()
+
+    def is_in_extension_directory(path: str | None) -> bool:
+        return path is not None and Path(path).resolve().is_relative_to(
+            extension_directory
+        )
+
+    unloaded_module_names = [
+        module_name
+        for module_name, module in list(sys.modules.items())
+        if is_in_extension_directory(getattr(module, "__file__", None))
+    ]
+    for module_name in unloaded_module_names:
+        del sys.modules[module_name]
+    # an extension that imports its own modules has to have put itself on `sys.path`
+    sys.path[:] = [path for path in sys.path if not is_in_extension_directory(path)]
+    for path in list(sys.path_importer_cache):
+        if is_in_extension_directory(path):
+            del sys.path_importer_cache[path]
+    importlib.invalidate_caches()
+    linecache.checkcache()
+    return unloaded_module_names
+
+
+def replace_plugin_with_external_plugin(
+    existing_plugin_name: ExtensiblePluginName,
+    external_module_path: Path,
+) -> None:
+    plugin_class = load_external_plugin(existing_plugin_name, external_module_path)
+    log.info(
+        f"Installing an extension for {existing_plugin_name=} from {external_module_path=}"
+    )
+    replace_plugin(existing_plugin_name, plugin_class)
@@ -1,12 +1,17 @@
+import asyncio
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Protocol
 
 from backend_commons.messages import MessageInDb
 from extensibles import hookimpl, hookspec, plugin_manager
+from k4_logger import log, span
+from utils.environment import get_extension_deadline_seconds
 
 from k4 import ChatMessage
 
+from .hook_calls import call_hook_impl, get_plugin_name
+
 
 @dataclass
 class ParamsForAlreadyExistingChat:
@@ -40,6 +45,32 @@ class GetCompleteChatSpec:
     ) -> list[ChatMessage]: ...
 
 
+@dataclass
+class ContextForLlm:
+    """
+    What a `get_context_for_llm` implementation (e.g. retrieval, memory, a system
+    prompt) contributes to the chat sent to the LLM
+    """
+
+    system_messages: list[ChatMessage] = field(default_factory=list)
+    """
+    Put at the very start of the chat
+    """
+    messages_before_new_message: list[ChatMessage] = field(default_factory=list)
+    """
+    Put right before the user's new message, e.g. retrieved documents
+    """
+
+
+class GetContextSpec:
+    @hookspec
+    async def get_context_for_llm(  # type: ignore[empty-body]
+        self,
+        new_message_from_user: str,
+        existing_chat_params: ParamsForAlreadyExistingChat | None,
+    ) -> ContextForLlm: ...
+
+
 def convert_messages_in_db_to_chat_messages(
     chat_history: list[MessageInDb],
 ) -> list[ChatMessage]:
@@ -108,14 +139,124 @@ class GetCompleteChatDefaultImplementation(GetCompleteChatImplementationAbstract
             return complete_chat
 
 
-async def get_complete_chat_for_llm(
+async def _get_chat_for_llm_without_context(
     new_message_from_user: str,
     existing_chat_params: ParamsForAlreadyExistingChat | None,
 ) -> list[ChatMessage]:
-    complete_chats: list[  # pyright: ignore[reportUnknownVariableType]
-        list[ChatMessage]
-    ] = await plugin_manager.ahook.get_complete_chat_for_llm(  # pyright: ignore[reportUnknownMemberType]
-        new_message_from_user=new_message_from_user,
-        existing_chat_params=existing_chat_params,
+    """
+    Calls the registered implementation, bounded by `get_extension_deadline_seconds()`.
+    If an extension is too slow or fails, the default implementation answers instead
+    """
+    hook_impls = plugin_manager.hook.get_complete_chat_for_llm.get_hookimpls()
+    default_implementation = GetCompleteChatDefaultImplementation()
+    if not hook_impls:
+        return await default_implementation.get_complete_chat_for_llm(
+            new_message_from_user, existing_chat_params
+        )
+
+    # pluggy calls the most recently registered implementation first, and that's the
+    # one whose result we've always used
+    hook_impl = hook_impls[-1]
+    if isinstance(hook_impl.plugin, GetCompleteChatDefaultImplementation):
+        # no point in timing out the default implementation, it's what we'd fall back to
+        return await call_hook_impl(
+            hook_impl,
+            {
+                "new_message_from_user": new_message_from_user,
+                "existing_chat_params": existing_chat_params,
+            },
+            deadline_seconds=None,
+        )
+
+    try:
+        return await call_hook_impl(
+            hook_impl,
+            {
+                "new_message_from_user": new_message_from_user,
+                "existing_chat_params": existing_chat_params,
+            },
+            deadline_seconds=get_extension_deadline_seconds(),
+        )
+    except Exception:
+        log.warning(
+            f"Falling back to the default implementation instead of {get_plugin_name(hook_impl)=}"
+        )
+    return await default_implementation.get_complete_chat_for_llm(
+        new_message_from_user, existing_chat_params
     )
-    return complete_chats[0]
+
+
+async def get_contexts_for_llm(
+    new_message_from_user: str,
+    existing_chat_params: ParamsForAlreadyExistingChat | None,
+) -> list[ContextForLlm]:
+    """
+    Calls every `get_context_for_llm` implementation concurrently, in the order they
+    were registered. One that's too slow or fails contributes nothing
+    """
+    hook_kwargs = {
+        "new_message_from_user": new_message_from_user,
+        "existing_chat_params": existing_chat_params,
+    }
+    deadline_seconds = get_extension_deadline_seconds()
+    contexts_or_exceptions = await asyncio.gather(
+        *(
+            call_hook_impl(hook_impl, hook_kwargs, deadline_seconds)
+            for hook_impl in plugin_manager.hook.get_context_for_llm.get_hookimpls()
+        ),
+        return_exceptions=True,
+    )
+    # failures were logged already
+    return [
+        context_or_exception
+        for context_or_exception in contexts_or_exceptions
+        if isinstance(context_or_exception, ContextForLlm)
+    ]
+
+
+def merge_contexts_into_chat(
+    chat: list[ChatMessage], contexts: list[ContextForLlm]
+) -> list[ChatMessage]:
+    """
+    `chat`'s last message is the user's new message
+    """
+    merged_chat = [
+        system_message
+        for context in contexts
+        for system_message in context.system_messages
+    ]
+    merged_chat.extend(chat[:-1])
+    merged_chat.extend(
+        message
+        for context in contexts
+        for message in context.messages_before_new_message
+    )
+    merged_chat.extend(chat[-1:])
+    return merged_chat
+
+
+async def get_complete_chat_for_llm(
+    new_message_from_user: str,
+    existing_chat_params: ParamsForAlreadyExistingChat | None,
+) -> list[ChatMessage]:
+    """
+    The chat to send to the LLM: the chat itself, from the `get_complete_chat_for_llm`
+    implementation, plus whatever every `get_context_for_llm` implementation
+    contributes. These are independent, so they all run concurrently, and the slowest
+    one (rather than their sum) is what this adds to a message's latency
+    """
+    with span("get complete chat for llm") as complete_chat_span:
+        if not plugin_manager.hook.get_context_for_llm.get_hookimpls():
+            complete_chat = await _get_chat_for_llm_without_context(
+                new_message_from_user, existing_chat_params
+            )
+        else:
+            chat_without_context, contexts = await asyncio.gather(
+                _get_chat_for_llm_without_context(
+                    new_message_from_user, existing_chat_params
+                ),
+                get_contexts_for_llm(new_message_from_user, existing_chat_params),
+            )
+            complete_chat = merge_contexts_into_chat(chat_without_context, contexts)
+        complete_chat_span.set_attribute("num_messages", len(complete_chat))
+        return complete_chat
@@ -0,0 +1,103 @@
+import asyncio
+import inspect
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, cast
+
+from k4_logger import log, span
+from pluggy import HookImpl
+from pydantic import BaseModel
+from utils import LatencyHistogram, LatencyHistogramSnapshot
+
+SLOW_HOOK_CALL_SECONDS = 1.0
+
+
+class HookImplMetrics(BaseModel):
+    plugin_name: str
+    num_timeouts: int
+    num_failures: int
+    latency: LatencyHistogramSnapshot
+
+
+@dataclass
+class _HookImplStats:
+    latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+    num_timeouts: int = 0
+    num_failures: int = 0
+
+
+# keyed by `get_plugin_name()`, so that replacing an extension starts a fresh histogram
+_hook_impl_stats: dict[str, _HookImplStats] = {}
+
+
+def get_plugin_name(hook_impl: HookImpl) -> str:
+    """
+    Every extension is registered under the name of the hook it replaces, so this is
+    what tells them apart: the plugin's class, or the `extension_name` of a plugin that
+    stands in for an extension (e.g. `ProcessIsolatedPlugin`)
+    """
+    plugin = hook_impl.plugin
+    if inspect.isclass(plugin):
+        # in-process extensions are registered as their class, not as an instance
+        return f"{hook_impl.plugin_name}:{plugin.__qualname__}"
+    extension_name = getattr(plugin, "extension_name", None)
+    if isinstance(extension_name, str):
+        return f"{hook_impl.plugin_name}:{extension_name}"
+    return f"{hook_impl.plugin_name}:{type(plugin).__qualname__}"
+
+
+def get_hook_impl_metrics() -> list[HookImplMetrics]:
+    return [
+        HookImplMetrics(
+            plugin_name=plugin_name,
+            num_timeouts=stats.num_timeouts,
+            num_failures=stats.num_failures,
+            latency=stats.latency.snapshot(),
+        )
+        for plugin_name, stats in _hook_impl_stats.items()
+    ]
+
+
+async def call_hook_impl[_ResultType](
+    hook_impl: HookImpl,
+    hook_kwargs: dict[str, Any],
+    deadline_seconds: float | None,
+) -> _ResultType:
+    """
+    Calls one async hook implementation directly (rather than through
+    `plugin_manager.ahook`), so that it can be timed, and bounded by
+    `deadline_seconds`. Slow calls are logged with the plugin's name. Timeouts and
+    failures are counted and re-raised, it's up to the caller how to recover
+    """
+    plugin_name = get_plugin_name(hook_impl)
+    stats = _hook_impl_stats.setdefault(plugin_name, _HookImplStats())
+    start_time = time.perf_counter()
+    try:
+        with span(f"plugin {plugin_name}", hook=hook_impl.function.__name__):
+            return await asyncio.wait_for(
+                cast(
+                    Awaitable[_ResultType],
+                    hook_impl.function(
+                        **{
+                            argname: hook_kwargs[argname]
+                            for argname in hook_impl.argnames
+                        }
+                    ),
+                ),
+                timeout=deadline_seconds,
+            )
+    except TimeoutError:
+        stats.num_timeouts += 1
+        log.warning(f"{plugin_name=} didn't finish within {deadline_seconds=}")
+        raise
+    except Exception:
+        stats.num_failures += 1
+        log.exception(f"{plugin_name=} failed")
+        raise
+    finally:
+        elapsed_seconds = time.perf_counter() - start_time
+        stats.latency.observe(elapsed_seconds)
+        if elapsed_seconds > SLOW_HOOK_CALL_SECONDS:
+            log.warning(
+                f"Slow call to {plugin_name=}: took {elapsed_seconds:.3f} seconds"
+            )
@@ -0,0 +1,311 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from multiprocessing.queues import SimpleQueue
+from pathlib import Path
+
+from backend_commons.messages import MessageInDb
+from k4_logger import log
+from pydantic import TypeAdapter
+
+from k4 import ChatMessage
+
+from .extensibles import ExtensiblePluginName, hookimpl, load_external_plugin
+from .get_complete_chat_for_llm import ParamsForAlreadyExistingChat
+
+_chat_messages_adapter = TypeAdapter(list[ChatMessage])
+_messages_in_db_adapter = TypeAdapter(list[MessageInDb])
+
+# only ever set in the worker processes
+_worker_plugin: object | None = None
+
+
+def _initialize_worker(
+    existing_plugin_name: ExtensiblePluginName,
+    external_module_path: Path,
+    worker_pids: "SimpleQueue[int]",
+) -> None:
+    global _worker_plugin
+    # first thing, so that even a worker stuck loading the extension can be stopped
+    worker_pids.put(os.getpid())
+    _worker_plugin = load_external_plugin(existing_plugin_name, external_module_path)()
+
+
+def _check_worker_is_ready() -> bool:
+    return _worker_plugin is not None
+
+
+def _get_complete_chat_for_llm_in_worker(
+    new_message_from_user: str,
+    chat_id: int | None,
+    serialized_chat_history: bytes | None,
+) -> bytes:
+    """
+    Runs in a worker process. Everything crossing the process boundary is JSON, so
+    that the extension never sees anything of ours that can't be pickled (e.g. the
+    connection pool behind `get_messages_of_chat`)
+    """
+    assert _worker_plugin is not None
+
+    existing_chat_params = None
+    if chat_id is not None and serialized_chat_history is not None:
+        chat_history = _messages_in_db_adapter.validate_json(serialized_chat_history)
+
+        async def get_messages_of_chat(
+            chat_id: int, limit: int | None = None
+        ) -> list[MessageInDb]:
+            return chat_history[-limit:] if limit else chat_history
+
+        existing_chat_params = ParamsForAlreadyExistingChat(
+            chat_id=chat_id, get_messages_of_chat=get_messages_of_chat
+        )
+
+    complete_chat = asyncio.run(
+        _worker_plugin.get_complete_chat_for_llm(  # type: ignore[attr-defined]
+            new_message_from_user=new_message_from_user,
+            existing_chat_params=existing_chat_params,
+        )
+    )
+    return _chat_messages_adapter.dump_json(complete_chat)
+
+
+def _handle_executor_future_done(
+    executor_future: "asyncio.Future[bytes]", timeout_handle: asyncio.TimerHandle
+) -> None:
+    timeout_handle.cancel()
+    # nobody awaits the future after our caller gave up on it, so retrieve the exception
+    # here to keep asyncio from complaining about it
+    if not executor_future.cancelled():
+        executor_future.exception()
+
+
+class ProcessIsolatedPlugin:
+    """
+    Stands in for an extension's plugin, and runs the extension in a pool of worker
+    processes instead of on the event loop. Meant for extensions doing CPU-heavy work
+    (retrieval, ranking, tokenization...), which would otherwise stall every other
+    request on this worker.
+
+    The worker can't call back into our DB, so the chat's history is fetched here and
+    sent along with the new message.
+
+    ```
+    plugin = ProcessIsolatedPlugin("get_complete_chat_for_llm", path_to_extension)
+    await plugin.start()  # raises if the extension can't be loaded
+    replace_plugin("get_complete_chat_for_llm", plugin)
+    ...
+    await plugin.stop()
+    ```
+    """
+
+    def __init__(
+        self,
+        existing_plugin_name: ExtensiblePluginName,
+        external_module_path: Path,
+        num_worker_processes: int = 2,
+        call_timeout_seconds: float = 30.0,
+    ) -> None:
+        self.existing_plugin_name = existing_plugin_name
+        self.external_module_path = external_module_path
+        self.num_worker_processes = num_worker_processes
+        self.call_timeout_seconds = call_timeout_seconds
+        self._process_pool: ProcessPoolExecutor | None = None
+        # every worker of `_process_pool` reports its pid here when it starts
+        self._worker_pids: "SimpleQueue[int] | None" = None
+        self._process_pool_started: asyncio.Task[None] | None = None
+        self._num_calls_in_flight = 0
+        self._no_calls_in_flight = asyncio.Event()
+        self._no_calls_in_flight.set()
+
+    @property
+    def extension_name(self) -> str:
+        """
+        How the extension is told apart from others, e.g. in `get_hook_impl_metrics()`
+        """
+        return f"{type(self).__qualname__}({self.external_module_path.name})"
+
+    def _create_process_pool(
+        self,
+    ) -> tuple[ProcessPoolExecutor, "SimpleQueue[int]"]:
+        # forking a process with a running event loop (and its threads) is asking for
+        # trouble
+        mp_context = multiprocessing.get_context("spawn")
+        worker_pids: "SimpleQueue[int]" = mp_context.SimpleQueue()
+        process_pool = ProcessPoolExecutor(
+            max_workers=self.num_worker_processes,
+            mp_context=mp_context,
+            initializer=_initialize_worker,
+            initargs=(
+                self.existing_plugin_name,
+                self.external_module_path,
+                worker_pids,
+            ),
+        )
+        return process_pool, worker_pids
+
+    async def start(self) -> None:
+        """
+        Starts every worker and waits until each has loaded the extension
+        """
+        self._start_process_pool()
+        assert self._process_pool_started is not None
+        await self._process_pool_started
+
+    def _start_process_pool(self) -> None:
+        process_pool, self._worker_pids = self._create_process_pool()
+        self._process_pool = process_pool
+        self._process_pool_started = asyncio.create_task(
+            self._wait_until_workers_are_ready(process_pool)
+        )
+
+    async def _wait_until_workers_are_ready(
+        self, process_pool: ProcessPoolExecutor
+    ) -> None:
+        # workers are spawned lazily, and importing the extension can take a while.
+        # Calls shouldn't be timed out for that
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.gather(
+                *(
+                    loop.run_in_executor(process_pool, _check_worker_is_ready)
+                    for _ in range(self.num_worker_processes)
+                )
+            )
+        except BaseException:
+            if process_pool is self._process_pool:
+                self.close()
+            raise
+
+    async def stop(self) -> None:
+        """
+        Lets the calls in flight finish (or time out), then stops the workers. For when
+        the extension is replaced: the calls that started on it finish on it
+        """
+        try:
+            await asyncio.wait_for(
+                self._no_calls_in_flight.wait(), timeout=self.call_timeout_seconds
+            )
+        except TimeoutError:
+            pass
+        self.close()
+
+    def close(self) -> None:
+        """
+        Stops the workers right away. Calls in flight fail
+        """
+        if self._process_pool is None:
+            return
+        process_pool = self._process_pool
+        worker_pids = self._worker_pids
+        self._process_pool = None
+        self._worker_pids = None
+        process_pool.shutdown(wait=False, cancel_futures=True)
+        if worker_pids is None:
+            return
+        # `shutdown` doesn't stop a worker that's stuck in the extension
+        while not worker_pids.empty():
+            try:
+                os.kill(worker_pids.get(), signal.SIGTERM)
+            except ProcessLookupError:
+                # it had exited already
+                pass
+        worker_pids.close()
+
+    def _restart_process_pool(self, failed_process_pool: ProcessPoolExecutor) -> None:
+        if failed_process_pool is not self._process_pool:
+            # a concurrent call already restarted it
+            return
+        log.warning(
+            f"Restarting the worker processes of the extension at {self.external_module_path=}"
+        )
+        self.close()
+        self._start_process_pool()
+
+    def _stop_timed_out_call(
+        self,
+        executor_future: "asyncio.Future[bytes]",
+        process_pool: ProcessPoolExecutor,
+    ) -> None:
+        if not executor_future.done():
+            # calls running in the other workers fail too, and fall back to the default
+            # implementation
+            log.warning(
+                f"A call to the extension at {self.external_module_path=} timed out after {self.call_timeout_seconds=}"
+            )
+            self._restart_process_pool(process_pool)
+
+    @hookimpl
+    async def get_complete_chat_for_llm(
+        self,
+        new_message_from_user: str,
+        existing_chat_params: ParamsForAlreadyExistingChat | None,
+    ) -> list[ChatMessage]:
+        self._num_calls_in_flight += 1
+        self._no_calls_in_flight.clear()
+        try:
+            return await self._get_complete_chat_for_llm(
+                new_message_from_user, existing_chat_params
+            )
+        finally:
+            self._num_calls_in_flight -= 1
+            if self._num_calls_in_flight == 0:
+                self._no_calls_in_flight.set()
+
+    async def _get_complete_chat_for_llm(
+        self,
+        new_message_from_user: str,
+        existing_chat_params: ParamsForAlreadyExistingChat | None,
+    ) -> list[ChatMessage]:
+        chat_id = None
+        serialized_chat_history = None
+        if existing_chat_params:
+            chat_id = existing_chat_params.chat_id
+            serialized_chat_history = _messages_in_db_adapter.dump_json(
+                await existing_chat_params.get_messages_of_chat(chat_id, None)
+            )
+
+        # the pool is restarted whenever a call times out, including while we await, so
+        # it's only read once there's nothing left to await before submitting to it
+        while True:
+            process_pool = self._process_pool
+            process_pool_started = self._process_pool_started
+            if process_pool is None or process_pool_started is None:
+                raise RuntimeError(f"{self.external_module_path} was not started")
+            # shielded, since other calls may be waiting on it too
+            await asyncio.shield(process_pool_started)
+            if process_pool is self._process_pool:
+                break
+
+        loop = asyncio.get_running_loop()
+        executor_future = loop.run_in_executor(
+            process_pool,
+            _get_complete_chat_for_llm_in_worker,
+            new_message_from_user,
+            chat_id,
+            serialized_chat_history,
+        )
+        # a timed out worker is still busy with the call, and there's no way to interrupt
+        # just that one, so the whole pool is restarted. This has to happen even if our
+        # caller gave up on the call first (e.g. `get_complete_chat_for_llm`'s deadline)
+        timeout_handle = loop.call_later(
+            self.call_timeout_seconds,
+            self._stop_timed_out_call,
+            executor_future,
+            process_pool,
+        )
+        executor_future.add_done_callback(
+            partial(_handle_executor_future_done, timeout_handle=timeout_handle)
+        )
+        try:
+            serialized_complete_chat = await asyncio.wait_for(
+                asyncio.shield(executor_future), timeout=self.call_timeout_seconds
+            )
+        except BrokenProcessPool:
+            # a worker died, e.g. the extension segfaulted. The pool is unusable now
+            self._restart_process_pool(process_pool)
+            raise
+        return _chat_messages_adapter.validate_json(serialized_complete_chat)
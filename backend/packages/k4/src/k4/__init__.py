@@ -1,4 +1,4 @@
 __version__ = "0.0.1"
-from .k4 import K4, ChatMessage
+from .k4 import K4, ChatMessage, LlmUsage
 
-__all__ = ["K4", "ChatMessage"]
+__all__ = ["K4", "ChatMessage", "LlmUsage"]
@@ -1,10 +1,32 @@
-from functools import lru_cache
-from typing import AsyncGenerator, Literal, NamedTuple, NotRequired, TypedDict
+import asyncio
+from functools import lru_cache, partial
+from typing import (
+    AsyncGenerator,
+    AsyncIterator,
+    Literal,
+    NamedTuple,
+    NotRequired,
+    Sequence,
+    TypedDict,
+)
+
+from k4.llm_provider_management import (
+    K4LlmProvider,
+    LlmProviderManager,
+    LlmRequestLimits,
+)
+from k4.llm_request_hedging import stream_from_first_responder
+from k4.llm_request_scheduling import LlmRequestScheduler
+from k4_logger import detached_span
+from pydantic import BaseModel
+
+# litellm takes seconds to import, so it's imported where it's used rather than up here.
+# That way importing k4 (e.g. to collect tests, or to start the API) stays fast
 
-import litellm
-from k4.llm_provider_management import K4LlmProvider, LlmProviderManager
-from litellm.types.utils import (
-    ModelResponseStream,  # pyright: ignore[reportMissingTypeStubs]
+# providers that send a final chunk with the usage if you ask for it with
+# `stream_options`. For everyone else, we count tokens ourselves
+LLM_PROVIDERS_REPORTING_STREAM_USAGE = frozenset(
+    (K4LlmProvider.OPENAI, K4LlmProvider.ANTHROPIC, K4LlmProvider.OPENROUTER)
 )
 
 
@@ -14,6 +36,22 @@ class ChatMessage(TypedDict):
     unmodified_content: NotRequired[str]
 
 
+class LlmUsage(BaseModel):
+    """
+    Filled in by `K4.ask_stream` once the stream is complete. Until then, `model` is
+    empty
+    """
+
+    model: str = ""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    estimated_cost_usd: float = 0.0
+    is_counted_locally: bool = False
+    """
+    `True` if the provider didn't report usage, so we counted the tokens ourselves
+    """
+
+
 class ChatValidityInformation(NamedTuple):
     will_ask_succeed: bool
     failure_detail: str = ""
@@ -24,11 +62,15 @@ def get_max_tokens_cached(model: str) -> int | None:
     """
     `None` indicates the model has an unlimited context window, I guess?
     """
+    import litellm
+
     return litellm.get_max_tokens(model)  # type: ignore[attr-defined]
 
 
 @lru_cache(maxsize=20)
 def get_llm_provider_by_model_name(model: str) -> K4LlmProvider:
+    import litellm
+
     for llm_provider in K4LlmProvider:
         models_of_provider = litellm.models_by_provider.get(llm_provider.value)  # pyright: ignore[reportUnknownVariableType, reportUnknownMemberType]
         assert isinstance(models_of_provider, list)
@@ -40,33 +82,65 @@ def get_llm_provider_by_model_name(model: str) -> K4LlmProvider:
 class K4:
     def __init__(self) -> None:
         self.llm_provider_manager = LlmProviderManager()
+        self.llm_request_scheduler = LlmRequestScheduler(
+            get_limits=self.llm_provider_manager.get_request_limits
+        )
+
+    def set_llm_request_limits(
+        self,
+        llm_provider: K4LlmProvider,
+        model: str | None,
+        limits: LlmRequestLimits,
+    ) -> None:
+        self.llm_provider_manager.set_request_limits(
+            llm_provider=llm_provider, model=model, limits=limits
+        )
+        self.llm_request_scheduler.refresh_limits(
+            llm_provider=llm_provider, model=model
+        )
 
     def will_ask_succeed_with_detail(
         self,
         complete_chat: list[ChatMessage],
         llm_provider: K4LlmProvider,
         model: str,
+        fallback_models: Sequence[str] = (),
     ) -> ChatValidityInformation:
-        llm_provider_is_setup = self.llm_provider_manager.is_provider_configured(
-            llm_provider=llm_provider
-        )
-        if not llm_provider_is_setup:
-            return ChatValidityInformation(
-                will_ask_succeed=False,
-                failure_detail=f"{llm_provider=} has not been set up.",
-            )
+        import litellm
+
+        llm_providers_and_models = [(llm_provider, model)]
+        for fallback_model in fallback_models:
+            try:
+                llm_providers_and_models.append(
+                    (get_llm_provider_by_model_name(fallback_model), fallback_model)
+                )
+            except ValueError:
+                return ChatValidityInformation(
+                    will_ask_succeed=False,
+                    failure_detail=f"Unknown fallback model {fallback_model=}",
+                )
 
-        max_tokens = get_max_tokens_cached(model)
-        if max_tokens:
-            num_tokens = litellm.token_counter(  # type: ignore[attr-defined]
-                model=model, messages=list(complete_chat)
+        for candidate_llm_provider, candidate_model in llm_providers_and_models:
+            llm_provider_is_setup = self.llm_provider_manager.is_provider_configured(
+                llm_provider=candidate_llm_provider
             )
-            if num_tokens > max_tokens:
+            if not llm_provider_is_setup:
                 return ChatValidityInformation(
                     will_ask_succeed=False,
-                    failure_detail=f"Chat exceeds maximum allowed context window for this model: {num_tokens=} {max_tokens=}",
+                    failure_detail=f"{candidate_llm_provider=} has not been set up.",
                 )
 
+            max_tokens = get_max_tokens_cached(candidate_model)
+            if max_tokens:
+                num_tokens = litellm.token_counter(  # type: ignore[attr-defined]
+                    model=candidate_model, messages=list(complete_chat)
+                )
+                if num_tokens > max_tokens:
+                    return ChatValidityInformation(
+                        will_ask_succeed=False,
+                        failure_detail=f"Chat exceeds maximum allowed context window for {candidate_model=}: {num_tokens=} {max_tokens=}",
+                    )
+
         if self.llm_provider_manager.is_provider_configured(K4LlmProvider.OPENAI):
             flagged_values = (
                 result.flagged
@@ -88,7 +162,77 @@ class K4:
         self,
         messages: list[ChatMessage],
         model: str,
+        user_id: int | None = None,
+        fallback_models: Sequence[str] = (),
+        hedge_after_seconds: float | None = None,
+        usage: LlmUsage | None = None,
     ) -> AsyncGenerator[str | None, None]:
+        """
+        Streams the response to `messages`. Requests wait in the `LlmRequestScheduler`'s
+        queue if they would exceed the provider's limits.
+
+        Parameters
+        ----------
+        user_id : int | None, optional
+            Who the request is on behalf of, so that queueing is fair across users
+        fallback_models : Sequence[str], optional
+            Equivalent models, in order of preference, e.g. the same model through a
+            different provider. The next one is tried if the ones before it fail before
+            their first token
+        hedge_after_seconds : float | None, optional
+            If no first token has arrived after this long, also start a request to the
+            next fallback model and stream from whichever responds first. `None` means
+            fallback models are only used on failure
+        usage : LlmUsage | None, optional
+            If provided, it's filled in with the tokens used and the estimated cost once
+            the stream is complete
+        """
+        with detached_span(
+            "ask llm", model=model, num_fallback_models=len(fallback_models)
+        ) as ask_span:
+            stream: AsyncIterator[str | None]
+            if not fallback_models:
+                stream = self._ask_stream_with_model(
+                    messages=messages, model=model, user_id=user_id, usage=usage
+                )
+            else:
+                stream = stream_from_first_responder(
+                    open_streams=[
+                        partial(
+                            self._ask_stream_with_model,
+                            messages=messages,
+                            model=candidate_model,
+                            user_id=user_id,
+                            usage=usage,
+                        )
+                        for candidate_model in (model, *fallback_models)
+                    ],
+                    hedge_after_seconds=hedge_after_seconds,
+                )
+            num_chunks = 0
+            async for content in stream:
+                if content:
+                    if num_chunks == 0:
+                        ask_span.set_attribute(
+                            "time_to_first_token_seconds",
+                            ask_span.get_elapsed_seconds(),
+                        )
+                    num_chunks += 1
+                yield content
+            ask_span.set_attribute("num_chunks", num_chunks)
+
+    async def _ask_stream_with_model(
+        self,
+        messages: list[ChatMessage],
+        model: str,
+        user_id: int | None,
+        usage: LlmUsage | None,
+    ) -> AsyncGenerator[str | None, None]:
+        import litellm
+        from litellm.types.utils import (
+            ModelResponseStream,  # pyright: ignore[reportMissingTypeStubs]
+        )
+
         class ExtraArgs(TypedDict, total=False):
             """
             This class is needed for Pylance type checking to be happy :(
@@ -119,21 +263,101 @@ class K4:
                 )
             return extra_args_for_ollama_or_huggingface
 
-        async_generator_completion = await litellm.acompletion(  # pyright: ignore[reportUnknownMemberType]
+        llm_provider = get_llm_provider_by_model_name(model)
+
+        async def open_stream() -> AsyncIterator[object]:
+            async_generator_completion = await litellm.acompletion(  # pyright: ignore[reportUnknownMemberType]
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True}
+                if llm_provider in LLM_PROVIDERS_REPORTING_STREAM_USAGE
+                else None,
+                **_get_extra_args_for_ollama_or_huggingface(model),
+            )
+            assert isinstance(async_generator_completion, litellm.CustomStreamWrapper)  # type: ignore[attr-defined]
+            return async_generator_completion  # type: ignore[no-any-return]
+
+        with detached_span(f"llm {model}", llm_provider=llm_provider.name) as llm_span:
+            completion_contents: list[str] = []
+            reported_usage: object | None = None
+            async with self.llm_request_scheduler.reserve(
+                llm_provider=llm_provider,
+                model=model,
+                user_id=user_id,
+                count_tokens=lambda: litellm.token_counter(  # type: ignore[attr-defined]
+                    model=model, messages=list(messages)
+                ),
+            ):
+                llm_span.set_attribute(
+                    "queue_wait_seconds", llm_span.get_elapsed_seconds()
+                )
+                async for chunk in self.llm_request_scheduler.open_stream_with_retries(
+                    llm_provider=llm_provider, model=model, open_stream=open_stream
+                ):
+                    if not isinstance(chunk, ModelResponseStream):
+                        raise Exception("Unexpected response type", chunk)
+                    chunk_usage = getattr(chunk, "usage", None)
+                    if chunk_usage is not None:
+                        reported_usage = chunk_usage
+                        if not chunk.choices:
+                            # the usage can come in a final chunk of its own
+                            continue
+                    if len(chunk.choices) != 1:
+                        raise Exception(
+                            "Unexpected number of choices in the chunk", chunk
+                        )
+                    if not isinstance(chunk.choices[0].delta.content, str | None):  # pyright: ignore[reportUnknownMemberType]
+                        raise Exception("Unexpected content type", chunk)
+                    if chunk.choices[0].delta.content:
+                        if not completion_contents:
+                            llm_span.set_attribute(
+                                "time_to_first_token_seconds",
+                                llm_span.get_elapsed_seconds(),
+                            )
+                        completion_contents.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+
+            if usage is not None:
+                # token counting and fetching the cost map can both block for a bit
+                await asyncio.to_thread(
+                    self._fill_in_usage,
+                    usage=usage,
+                    model=model,
+                    messages=messages,
+                    completion="".join(completion_contents),
+                    reported_usage=reported_usage,
+                )
+
+    def _fill_in_usage(
+        self,
+        usage: LlmUsage,
+        model: str,
+        messages: list[ChatMessage],
+        completion: str,
+        reported_usage: object | None,
+    ) -> None:
+        import litellm
+
+        prompt_tokens = getattr(reported_usage, "prompt_tokens", None)
+        completion_tokens = getattr(reported_usage, "completion_tokens", None)
+        if not isinstance(prompt_tokens, int) or not isinstance(completion_tokens, int):
+            usage.is_counted_locally = True
+            prompt_tokens = litellm.token_counter(  # type: ignore[attr-defined]
+                model=model, messages=list(messages)
+            )
+            completion_tokens = litellm.token_counter(  # type: ignore[attr-defined]
+                model=model, text=completion
+            )
+        assert isinstance(prompt_tokens, int) and isinstance(completion_tokens, int)
+        usage.prompt_tokens = prompt_tokens
+        usage.completion_tokens = completion_tokens
+        usage.estimated_cost_usd = self.llm_provider_manager.estimate_cost_usd(
             model=model,
-            messages=messages,
-            stream=True,
-            **_get_extra_args_for_ollama_or_huggingface(model),
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
         )
-        assert isinstance(async_generator_completion, litellm.CustomStreamWrapper)  # type: ignore[attr-defined]
-        async for chunk in async_generator_completion:
-            if not isinstance(chunk, ModelResponseStream):
-                raise Exception("Unexpected response type", chunk)
-            if len(chunk.choices) != 1:
-                raise Exception("Unexpected number of choices in the chunk", chunk)
-            if not isinstance(chunk.choices[0].delta.content, str | None):  # pyright: ignore[reportUnknownMemberType]
-                raise Exception("Unexpected content type", chunk)
-            yield chunk.choices[0].delta.content
+        usage.model = model
 
     # async def ask(
     #     self, messages: list[ChatMessage], llm_provider: K4LlmProvider, model: str
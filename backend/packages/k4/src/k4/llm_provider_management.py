@@ -2,10 +2,8 @@ import os
 from collections import defaultdict
 from enum import StrEnum
 
-from litellm import get_model_cost_map  # type: ignore[attr-defined]
-from litellm import model_cost_map_url
-from pydantic import BaseModel, SecretStr
-from utils import TypedDiskCache, time_expiring_lru_cache
+from pydantic import BaseModel, Field, SecretStr
+from utils import ttl_cache
 from utils.file_io import get_k4_data_directory
 
 
@@ -27,6 +25,16 @@ class K4LlmProvider(StrEnum):
     GEMINI = "gemini"
 
 
+class LlmRequestLimits(BaseModel):
+    """
+    Limits enforced by `LlmRequestScheduler`, either for a whole provider or for one of
+    its models. `None` means unlimited.
+    """
+
+    max_concurrent_requests: int | None = Field(default=None, ge=1)
+    max_tokens_per_minute: int | None = Field(default=None, ge=1)
+
+
 class LlmProviderInfo(BaseModel):
     llm_provider_name: K4LlmProvider
     metadata: LlmProviderMetadata
@@ -69,19 +77,27 @@ LLM_PROVIDER_INFO_BY_LLM_PROVIDER_DEFAULT: dict[K4LlmProvider, LlmProviderInfo]
 
 class LlmProviderManager:
     def __init__(self) -> None:
+        # diskcache is only imported once a `LlmProviderManager` is created
+        from utils.disk_cache import TypedDiskCache
+
         self.providers_cache = TypedDiskCache[K4LlmProvider, LlmProviderInfo](
             directory=get_k4_data_directory().joinpath("providers")
         )
 
-        for llm_provider in LLM_PROVIDER_INFO_BY_LLM_PROVIDER_DEFAULT.keys():
-            if llm_provider not in self.providers_cache:
-                self.providers_cache[llm_provider] = (
-                    LLM_PROVIDER_INFO_BY_LLM_PROVIDER_DEFAULT[llm_provider]
-                )
+        self.providers_cache.set_many(
+            (llm_provider, llm_provider_info)
+            for llm_provider, llm_provider_info in LLM_PROVIDER_INFO_BY_LLM_PROVIDER_DEFAULT.items()
+            if llm_provider not in self.providers_cache
+        )
 
         for llm_provider in self.providers_cache:
             self._set_env_var_from_provider_config(llm_provider=llm_provider)
 
+        # keyed by (provider, model), where a `None` model means "the whole provider"
+        self.request_limits_cache = TypedDiskCache[
+            tuple[K4LlmProvider, str | None], LlmRequestLimits
+        ](directory=get_k4_data_directory().joinpath("llm_request_limits"))
+
     def _set_env_var_from_provider_config(self, llm_provider: K4LlmProvider) -> None:
         config = self.providers_cache[llm_provider].config
         provider_environment_variable_name = self.providers_cache[
@@ -117,15 +133,54 @@ class LlmProviderManager:
             return config
         raise KeyError(f"LLM Provider {llm_provider=} is not configured.")
 
+    def get_request_limits(
+        self, llm_provider: K4LlmProvider, model: str | None
+    ) -> LlmRequestLimits:
+        return self.request_limits_cache.get(  # type: ignore[no-any-return]
+            (llm_provider, model), LlmRequestLimits()
+        )
+
+    def set_request_limits(
+        self,
+        llm_provider: K4LlmProvider,
+        model: str | None,
+        limits: LlmRequestLimits,
+    ) -> None:
+        self.request_limits_cache[(llm_provider, model)] = limits
+
     @staticmethod
-    @time_expiring_lru_cache(max_age_seconds=60 * 10, max_size=1)
+    # it's fetched over the network, so once it expires it's refreshed in the background
+    # while callers keep getting the previous one
+    @ttl_cache(
+        max_age_seconds=60 * 10,
+        max_size=1,
+        stale_while_revalidate_seconds=60 * 60 * 24,
+    )
     def get_model_metadata_by_model_name() -> dict:  # type: ignore[type-arg]
+        from litellm import get_model_cost_map  # type: ignore[attr-defined]
+        from litellm import model_cost_map_url
+
         # we don't have a guarantee for the litellm json's structure, iirc. though I may
         # have added it upstream in a test file lol
         model_metadata_by_model_name = get_model_cost_map(url=model_cost_map_url)
         assert isinstance(model_metadata_by_model_name, dict)
         return model_metadata_by_model_name
 
+    def estimate_cost_usd(
+        self, model: str, prompt_tokens: int, completion_tokens: int
+    ) -> float:
+        """
+        Priced with litellm's cost map. Models missing from the map are free, as far as
+        we know
+        """
+        model_metadata = (
+            LlmProviderManager.get_model_metadata_by_model_name().get(model) or {}
+        )
+        assert isinstance(model_metadata, dict)
+        return prompt_tokens * float(
+            model_metadata.get("input_cost_per_token") or 0
+        ) + completion_tokens * float(model_metadata.get("output_cost_per_token") or 0)
+
     def get_available_models(self) -> dict[str, list[str]]:
         # TODO invalidate the cache when the providers list is updated. This is fine for
         # now though
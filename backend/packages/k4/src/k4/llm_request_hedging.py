@@ -0,0 +1,124 @@
+import asyncio
+from typing import AsyncGenerator, Callable, Sequence
+
+from k4_logger import log
+
+
+async def _get_first_chunk[_ChunkType](
+    stream: AsyncGenerator[_ChunkType, None],
+) -> tuple[_ChunkType] | None:
+    """
+    `None` iff the stream is empty
+    """
+    try:
+        return (await anext(stream),)
+    except StopAsyncIteration:
+        return None
+
+
+async def _cancel_and_close[_ChunkType](
+    task: "asyncio.Task[tuple[_ChunkType] | None]",
+    stream: AsyncGenerator[_ChunkType, None],
+) -> None:
+    task.cancel()
+    # the task has to be finished before the generator can be closed, otherwise
+    # `aclose()` complains that the generator is already running
+    await asyncio.gather(task, return_exceptions=True)
+    await stream.aclose()
+
+
+async def stream_from_first_responder[_ChunkType](
+    open_streams: Sequence[Callable[[], AsyncGenerator[_ChunkType, None]]],
+    hedge_after_seconds: float | None,
+) -> AsyncGenerator[_ChunkType, None]:
+    """
+    Streams from whichever of `open_streams` produces a first chunk first.
+
+    The streams are started in order. The next one is started when every started stream
+    has failed before producing a chunk (fallback), or when none of them has produced a
+    chunk within `hedge_after_seconds` (hedging). Once a stream produces a chunk we
+    commit to it, and every other started stream is cancelled.
+
+    Parameters
+    ----------
+    open_streams : Sequence[Callable[[], AsyncGenerator[_ChunkType, None]]]
+        In order of preference. Presumably these all stream equivalent responses
+    hedge_after_seconds : float | None
+        `None` disables hedging, so the next stream is started only on failure
+    """
+    if not open_streams:
+        raise ValueError("Need at least one stream to choose from")
+
+    pending_streams: dict[
+        asyncio.Task[tuple[_ChunkType] | None], AsyncGenerator[_ChunkType, None]
+    ] = {}
+    num_started_streams = 0
+
+    def start_next_stream() -> None:
+        nonlocal num_started_streams
+        stream = open_streams[num_started_streams]()
+        pending_streams[asyncio.create_task(_get_first_chunk(stream))] = stream
+        num_started_streams += 1
+
+    winning_stream: AsyncGenerator[_ChunkType, None] | None = None
+    first_chunk: tuple[_ChunkType] | None = None
+    last_exception: BaseException | None = None
+    try:
+        start_next_stream()
+        while pending_streams and winning_stream is None:
+            can_start_another_stream = num_started_streams < len(open_streams)
+            done_tasks, _ = await asyncio.wait(
+                pending_streams,
+                timeout=hedge_after_seconds if can_start_another_stream else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done_tasks:
+                log.info(
+                    f"No first chunk after {hedge_after_seconds=}, hedging with stream #{num_started_streams}"
+                )
+                start_next_stream()
+                continue
+
+            for done_task in done_tasks:
+                stream = pending_streams.pop(done_task)
+                exception = done_task.exception()
+                if exception is not None:
+                    log.warning(
+                        f"A stream failed before its first chunk: {exception!r}"
+                    )
+                    last_exception = exception
+                    await stream.aclose()
+                elif winning_stream is None:
+                    winning_stream = stream
+                    first_chunk = done_task.result()
+                else:
+                    # two streams finished in the same tick. Too late for this one
+                    await stream.aclose()
+
+            if (
+                winning_stream is None
+                and not pending_streams
+                and num_started_streams < len(open_streams)
+            ):
+                start_next_stream()
+    finally:
+        await asyncio.gather(
+            *(
+                _cancel_and_close(task, stream)
+                for task, stream in pending_streams.items()
+            )
+        )
+        pending_streams.clear()
+
+    if winning_stream is None:
+        assert last_exception is not None
+        raise last_exception
+
+    try:
+        if first_chunk is None:
+            return
+        yield first_chunk[0]
+        async for chunk in winning_stream:
+            yield chunk
+    finally:
+        await winning_stream.aclose()
@@ -0,0 +1,279 @@
+import asyncio
+import random
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable
+
+from k4.llm_provider_management import K4LlmProvider, LlmRequestLimits
+from k4_logger import log
+from pydantic import BaseModel
+from utils import LatencyHistogram, LatencyHistogramSnapshot, TokenBucket
+
+# keyed by (provider, model), where a `None` model means "the whole provider"
+type LimiterKey = tuple[K4LlmProvider, str | None]
+# `None` is for requests that aren't made on behalf of a particular user
+type UserKey = int | None
+
+
+class LlmRequestRetryPolicy(BaseModel):
+    max_attempts: int = 3
+    base_delay_seconds: float = 0.5
+    max_delay_seconds: float = 8.0
+
+    def get_delay_seconds(self, attempt: int) -> float:
+        # "full jitter", so that a burst of 429s doesn't come back as a burst of retries
+        # https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(
+            0, min(self.max_delay_seconds, self.base_delay_seconds * 2**attempt)
+        )
+
+
+class LlmRequestQueueMetrics(BaseModel):
+    llm_provider: K4LlmProvider
+    model: str | None
+    limits: LlmRequestLimits
+    num_in_flight: int
+    num_queued: int
+    num_retries: int
+    wait_time: LatencyHistogramSnapshot
+
+
+def is_retryable_llm_error(exception: Exception) -> bool:
+    """
+    litellm maps provider errors onto exceptions that carry the HTTP `status_code`. We
+    retry rate limits (429) and server errors (5xx)
+    """
+    status_code = getattr(exception, "status_code", None)
+    return isinstance(status_code, int) and (status_code == 429 or status_code >= 500)
+
+
+class FairSemaphore:
+    """
+    Like `asyncio.Semaphore`, except that waiters are woken round-robin across users
+    instead of first-come-first-served. One user queueing up 50 requests can't make
+    everyone else wait behind all 50 of them.
+    """
+
+    def __init__(self, max_concurrent: int | None) -> None:
+        self.max_concurrent = max_concurrent
+        self.num_in_flight = 0
+        self._waiters_by_user: OrderedDict[UserKey, deque[asyncio.Future[None]]] = (
+            OrderedDict()
+        )
+
+    @property
+    def num_waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters_by_user.values())
+
+    def _has_free_slot(self) -> bool:
+        return self.max_concurrent is None or self.num_in_flight < self.max_concurrent
+
+    async def acquire(self, user_key: UserKey) -> None:
+        if self._has_free_slot() and not self._waiters_by_user:
+            self.num_in_flight += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters_by_user.setdefault(user_key, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # we were handed a slot right as we were cancelled, so pass it along
+                self.release()
+            else:
+                waiters = self._waiters_by_user.get(user_key)
+                if waiters is not None and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._waiters_by_user[user_key]
+            raise
+
+    def release(self) -> None:
+        self.num_in_flight -= 1
+        self.wake_waiters()
+
+    def wake_waiters(self) -> None:
+        while self._has_free_slot() and self._waiters_by_user:
+            user_key, waiters = self._waiters_by_user.popitem(last=False)
+            waiter = waiters.popleft()
+            if waiters:
+                # this user goes to the back of the line
+                self._waiters_by_user[user_key] = waiters
+            if waiter.done():
+                continue
+            waiter.set_result(None)
+            self.num_in_flight += 1
+
+
+class _LimiterState:
+    def __init__(self, limits: LlmRequestLimits) -> None:
+        self.limits = limits
+        self.semaphore = FairSemaphore(limits.max_concurrent_requests)
+        self.token_bucket = self._create_token_bucket(limits)
+        # whoever holds this is next in line for tokens, which keeps it FIFO
+        self.token_bucket_lock = asyncio.Lock()
+        self.wait_time_histogram = LatencyHistogram()
+        self.num_retries = 0
+
+    @staticmethod
+    def _create_token_bucket(limits: LlmRequestLimits) -> TokenBucket | None:
+        if limits.max_tokens_per_minute is None:
+            return None
+        return TokenBucket(
+            capacity=limits.max_tokens_per_minute,
+            refill_rate_per_second=limits.max_tokens_per_minute / 60,
+        )
+
+    def update_limits(self, limits: LlmRequestLimits) -> None:
+        self.limits = limits
+        self.semaphore.max_concurrent = limits.max_concurrent_requests
+        self.semaphore.wake_waiters()
+        self.token_bucket = self._create_token_bucket(limits)
+
+    async def wait_for_tokens(self, num_tokens: int) -> None:
+        if self.token_bucket is None:
+            return
+        async with self.token_bucket_lock:
+            while self.token_bucket is not None:
+                # a single request that's bigger than the entire budget would otherwise
+                # wait forever
+                seconds_to_wait = self.token_bucket.try_consume(
+                    min(num_tokens, self.token_bucket.capacity)
+                )
+                if not seconds_to_wait:
+                    return
+                await asyncio.sleep(seconds_to_wait)
+
+
+class LlmRequestScheduler:
+    """
+    Keeps us under each provider's (and each model's) concurrency and tokens-per-minute
+    limits, by queueing whatever doesn't fit. The queues are fair across users.
+
+    ```
+    async with scheduler.reserve(K4LlmProvider.OPENAI, "gpt-4o", user_id, count_tokens):
+        async for chunk in scheduler.open_stream_with_retries(
+            K4LlmProvider.OPENAI, "gpt-4o", open_stream
+        ):
+            ...
+    ```
+    """
+
+    def __init__(
+        self,
+        get_limits: Callable[[K4LlmProvider, str | None], LlmRequestLimits],
+        retry_policy: LlmRequestRetryPolicy = LlmRequestRetryPolicy(),
+    ) -> None:
+        self.get_limits = get_limits
+        self.retry_policy = retry_policy
+        self._limiter_states: dict[LimiterKey, _LimiterState] = {}
+
+    def _get_limiter_state(self, limiter_key: LimiterKey) -> _LimiterState:
+        if limiter_key not in self._limiter_states:
+            self._limiter_states[limiter_key] = _LimiterState(
+                self.get_limits(*limiter_key)
+            )
+        return self._limiter_states[limiter_key]
+
+    def refresh_limits(self, llm_provider: K4LlmProvider, model: str | None) -> None:
+        """
+        Call this after the limits returned by `get_limits` have changed
+        """
+        limiter_state = self._limiter_states.get((llm_provider, model))
+        if limiter_state:
+            limiter_state.update_limits(self.get_limits(llm_provider, model))
+
+    @asynccontextmanager
+    async def reserve(
+        self,
+        llm_provider: K4LlmProvider,
+        model: str,
+        user_id: int | None,
+        count_tokens: Callable[[], int],
+    ) -> AsyncGenerator[None, None]:
+        """
+        Waits until the request fits within the provider's and the model's limits, and
+        holds on to a concurrency slot until the context manager exits.
+
+        Parameters
+        ----------
+        count_tokens : Callable[[], int]
+            Returns the number of prompt tokens of the request. Only called if there's a
+            tokens-per-minute limit, since counting tokens isn't free
+        """
+        # always provider first, then model, so two requests can't deadlock each other
+        limiter_states = [
+            self._get_limiter_state((llm_provider, None)),
+            self._get_limiter_state((llm_provider, model)),
+        ]
+        queued_at = time.monotonic()
+        acquired_limiter_states: list[_LimiterState] = []
+        try:
+            for limiter_state in limiter_states:
+                await limiter_state.semaphore.acquire(user_id)
+                acquired_limiter_states.append(limiter_state)
+            if any(limiter_state.token_bucket for limiter_state in limiter_states):
+                num_tokens = count_tokens()
+                for limiter_state in limiter_states:
+                    await limiter_state.wait_for_tokens(num_tokens)
+            seconds_waited = time.monotonic() - queued_at
+            for limiter_state in limiter_states:
+                limiter_state.wait_time_histogram.observe(seconds_waited)
+            yield
+        finally:
+            for limiter_state in acquired_limiter_states:
+                limiter_state.semaphore.release()
+
+    async def open_stream_with_retries[_ChunkType](
+        self,
+        llm_provider: K4LlmProvider,
+        model: str,
+        open_stream: Callable[[], Awaitable[AsyncIterator[_ChunkType]]],
+    ) -> AsyncGenerator[_ChunkType, None]:
+        """
+        Opens the stream and waits for its first chunk, retrying 429s and 5xx errors
+        with jittered exponential backoff. Once the first chunk has arrived we're
+        committed: errors after that are raised as-is, since the caller may have already
+        forwarded chunks to the user.
+        """
+        attempt = 0
+        while True:
+            try:
+                stream = await open_stream()
+                first_chunk = await anext(stream)
+                break
+            except StopAsyncIteration:
+                return
+            except Exception as exception:
+                attempt += 1
+                if attempt >= self.retry_policy.max_attempts or not (
+                    is_retryable_llm_error(exception)
+                ):
+                    raise
+                delay_seconds = self.retry_policy.get_delay_seconds(attempt)
+                log.warning(
+                    f"Retrying request to {llm_provider=} {model=} in {delay_seconds:.2f}s ({attempt=}): {exception!r}"
+                )
+                self._get_limiter_state((llm_provider, None)).num_retries += 1
+                self._get_limiter_state((llm_provider, model)).num_retries += 1
+                await asyncio.sleep(delay_seconds)
+
+        yield first_chunk
+        async for chunk in stream:
+            yield chunk
+
+    def get_metrics(self) -> list[LlmRequestQueueMetrics]:
+        return [
+            LlmRequestQueueMetrics(
+                llm_provider=llm_provider,
+                model=model,
+                limits=limiter_state.limits,
+                num_in_flight=limiter_state.semaphore.num_in_flight,
+                num_queued=limiter_state.semaphore.num_waiting,
+                num_retries=limiter_state.num_retries,
+                wait_time=limiter_state.wait_time_histogram.snapshot(),
+            )
+            for (llm_provider, model), limiter_state in self._limiter_states.items()
+        ]
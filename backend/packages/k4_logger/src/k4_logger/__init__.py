@@ -1,3 +1,28 @@
-from .k4_logger import log
+from .k4_logger import in_memory_traces, log
+from .lazy_formatting import lazy
+from .request_ids import get_request_id, reset_request_id, set_request_id
+from .tracing import (
+    FinishedSpan,
+    Span,
+    Trace,
+    detached_span,
+    get_current_span,
+    span,
+    trace,
+)
 
-__all__ = ["log"]
+__all__ = [
+    "log",
+    "lazy",
+    "get_request_id",
+    "set_request_id",
+    "reset_request_id",
+    "trace",
+    "span",
+    "detached_span",
+    "get_current_span",
+    "Span",
+    "FinishedSpan",
+    "Trace",
+    "in_memory_traces",
+]
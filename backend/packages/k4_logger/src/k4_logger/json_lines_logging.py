@@ -0,0 +1,100 @@
+import atexit
+import datetime
+import json
+import logging
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, TextIO
+
+from .request_ids import RequestIdFilter
+
+# anything else in a record's `__dict__` was passed with `extra=...`
+_LOG_RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {
+    "message",
+    "asctime",
+    "request_id",
+}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    One JSON object per record, on one line, with whatever was passed in `extra=...` as
+    well
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, Any] = {
+            "timestamp": datetime.datetime.fromtimestamp(
+                record.created, datetime.UTC
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            entry["request_id"] = request_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRIBUTES:
+                entry.setdefault(key, value)
+        return json.dumps(entry, default=str)
+
+
+class UnformattedQueueHandler(QueueHandler):
+    """
+    Puts records in a queue as they are. `QueueHandler.prepare` formats the message
+    first (so that the record can be pickled), which is exactly the work we want off the
+    event loop. Our queue never leaves the process, so the listener's thread formats
+    them instead
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps `sample_rate` of the records below WARNING, at random, and every other record
+    """
+
+    def __init__(self, sample_rate: float) -> None:
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.sample_rate
+
+
+def start_logging_json_lines(
+    stream: TextIO = sys.stdout, level: int = logging.INFO, sample_rate: float = 1.0
+) -> QueueListener:
+    """
+    Makes the root logger put records in a queue, for a background thread to format and
+    write to `stream` as JSON lines. Logging a record then costs little more than
+    putting it in the queue, whatever the stream.
+
+    The listener is stopped (and the queue flushed) at exit
+    """
+    log_records: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    queue_handler = UnformattedQueueHandler(log_records)
+    # sampled first, so that dropped records cost nothing else
+    if sample_rate < 1:
+        queue_handler.addFilter(SamplingFilter(sample_rate))
+    queue_handler.addFilter(RequestIdFilter())
+
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(JsonLinesFormatter())
+    listener = QueueListener(log_records, stream_handler, respect_handler_level=True)
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.handlers = [queue_handler]
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
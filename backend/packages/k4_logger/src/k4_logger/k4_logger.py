@@ -1,9 +1,44 @@
 import logging
 
-from rich.logging import RichHandler
-
-FORMAT = "%(message)s"
-logging.basicConfig(
-    level="INFO", format=FORMAT, datefmt="%Y-%m-%d %H:%M:%S", handlers=[RichHandler()]
+from utils.environment import (
+    get_log_format,
+    get_log_sample_rate,
+    get_num_traces_kept_in_memory,
+    get_traces_file_path,
 )
+
+from .json_lines_logging import start_logging_json_lines
+from .tracing import InMemoryTraceExporter, NdjsonFileTraceExporter, add_trace_exporter
+
+
+def _configure_logging() -> None:
+    if get_log_format() == "json":
+        start_logging_json_lines(sample_rate=get_log_sample_rate())
+        return
+    # rich is slow to import, and only needed to pretty-print logs in a terminal
+    from rich.logging import RichHandler
+
+    FORMAT = "%(message)s"
+    logging.basicConfig(
+        level="INFO",
+        format=FORMAT,
+        datefmt="%Y-%m-%d %H:%M:%S",
+        handlers=[RichHandler()],
+    )
+
+
+def _configure_tracing() -> InMemoryTraceExporter | None:
+    traces_file_path = get_traces_file_path()
+    if traces_file_path is not None:
+        add_trace_exporter(NdjsonFileTraceExporter(traces_file_path))
+    num_traces_kept_in_memory = get_num_traces_kept_in_memory()
+    if num_traces_kept_in_memory <= 0:
+        return None
+    in_memory_traces = InMemoryTraceExporter(num_traces_kept_in_memory)
+    add_trace_exporter(in_memory_traces)
+    return in_memory_traces
+
+
+_configure_logging()
 log = logging.getLogger("k4")
+in_memory_traces = _configure_tracing()
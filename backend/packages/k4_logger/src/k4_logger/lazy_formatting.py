@@ -0,0 +1,22 @@
+from typing import Callable
+
+
+class lazy:
+    """
+    Defers an expensive part of a log message until the record is formatted, which
+    doesn't happen at all if the record is dropped (level, sampling...), and happens on
+    a background thread when logging JSON lines
+
+    ```
+    log.info("Creating a user. %s", lazy(new_user_details.model_dump_json))
+    ```
+
+    The function runs later, so it shouldn't depend on anything that may change in the
+    meantime
+    """
+
+    def __init__(self, compute: Callable[[], object]) -> None:
+        self.compute = compute
+
+    def __str__(self) -> str:
+        return str(self.compute())
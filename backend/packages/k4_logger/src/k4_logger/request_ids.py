@@ -0,0 +1,31 @@
+import logging
+from contextvars import ContextVar, Token
+
+_request_id: ContextVar[str | None] = ContextVar("request_id", default=None)
+
+
+def get_request_id() -> str | None:
+    return _request_id.get()
+
+
+def set_request_id(request_id: str | None) -> Token[str | None]:
+    """
+    Every record logged from this context (including the tasks it creates) carries
+    `request_id`. Pass the returned token to `reset_request_id` when the request is done
+    """
+    return _request_id.set(request_id)
+
+
+def reset_request_id(token: Token[str | None]) -> None:
+    _request_id.reset(token)
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Sets `record.request_id`. It has to run where the record is logged, since the
+    request id is in that context, not in the thread the record is written from
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        return True
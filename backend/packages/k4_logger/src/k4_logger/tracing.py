@@ -0,0 +1,349 @@
+import atexit
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import AbstractContextManager, contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Generator, Iterable, Literal, Protocol
+
+type SpanAttributeValue = str | int | float | bool | None
+
+
+@dataclass
+class FinishedSpan:
+    trace_id: str
+    span_id: str
+    parent_span_id: str | None
+    name: str
+    started_at: float
+    """
+    Seconds since the epoch
+    """
+    duration_seconds: float
+    status: Literal["ok", "error", "cancelled"]
+    attributes: dict[str, SpanAttributeValue]
+
+
+@dataclass
+class Trace:
+    trace_id: str
+    name: str
+    """
+    The root span's
+    """
+    started_at: float
+    duration_seconds: float
+    spans: list[FinishedSpan]
+    """
+    In the order they started
+    """
+
+
+class TraceExporter(Protocol):
+    def export(self, finished_spans: list[FinishedSpan]) -> None:
+        """
+        Called on the event loop, so it mustn't block
+        """
+        ...
+
+
+@dataclass
+class _TraceInProgress:
+    trace_id: str
+    num_open_spans: int = 0
+    finished_spans: list[FinishedSpan] = field(default_factory=list)
+
+
+class Span:
+    """
+    Use `trace` or `span` to get one
+    """
+
+    def __init__(
+        self,
+        name: str,
+        trace_in_progress: _TraceInProgress | None,
+        parent_span_id: str | None,
+        attributes: dict[str, SpanAttributeValue],
+    ) -> None:
+        self.name = name
+        # outside of a trace, a span only costs its creation
+        self.span_id = uuid.uuid4().hex[:16] if trace_in_progress is not None else ""
+        self.parent_span_id = parent_span_id
+        self.attributes = attributes
+        self._trace_in_progress = trace_in_progress
+        self._started_at = time.time()
+        self._started_at_perf_counter = time.perf_counter()
+
+    @property
+    def is_recording(self) -> bool:
+        """
+        `False` outside of a trace, in which case the span is thrown away
+        """
+        return self._trace_in_progress is not None
+
+    def get_elapsed_seconds(self) -> float:
+        return time.perf_counter() - self._started_at_perf_counter
+
+    def set_attribute(self, key: str, value: SpanAttributeValue) -> None:
+        if self.is_recording:
+            self.attributes[key] = value
+
+    def _finish(self, status: Literal["ok", "error", "cancelled"]) -> None:
+        trace_in_progress = self._trace_in_progress
+        if trace_in_progress is None:
+            return
+        trace_in_progress.finished_spans.append(
+            FinishedSpan(
+                trace_id=trace_in_progress.trace_id,
+                span_id=self.span_id,
+                parent_span_id=self.parent_span_id,
+                name=self.name,
+                started_at=self._started_at,
+                duration_seconds=self.get_elapsed_seconds(),
+                status=status,
+                attributes=self.attributes,
+            )
+        )
+        trace_in_progress.num_open_spans -= 1
+        # spans can outlive their parent (e.g. in a task the request started), so the
+        # trace is exported whenever none of its spans are open, possibly in several parts
+        if trace_in_progress.num_open_spans == 0:
+            finished_spans = trace_in_progress.finished_spans
+            trace_in_progress.finished_spans = []
+            for trace_exporter in _trace_exporters:
+                trace_exporter.export(finished_spans)
+
+
+_current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+_trace_exporters: list[TraceExporter] = []
+
+
+def add_trace_exporter(trace_exporter: TraceExporter) -> None:
+    _trace_exporters.append(trace_exporter)
+
+
+def get_current_span() -> Span | None:
+    return _current_span.get()
+
+
+@contextmanager
+def _start_span(
+    name: str,
+    trace_in_progress: _TraceInProgress | None,
+    parent_span_id: str | None,
+    attributes: dict[str, SpanAttributeValue],
+    is_current: bool = True,
+) -> Generator[Span, None, None]:
+    new_span = Span(name, trace_in_progress, parent_span_id, attributes)
+    if trace_in_progress is None:
+        yield new_span
+        return
+    trace_in_progress.num_open_spans += 1
+    current_span_token = _current_span.set(new_span) if is_current else None
+    status: Literal["ok", "error", "cancelled"] = "ok"
+    try:
+        yield new_span
+    except GeneratorExit:
+        status = "cancelled"
+        raise
+    except Exception as exception:
+        status = "error"
+        new_span.set_attribute("exception", repr(exception))
+        raise
+    except BaseException:
+        # e.g. `asyncio.CancelledError`
+        status = "cancelled"
+        raise
+    finally:
+        if current_span_token is not None:
+            try:
+                _current_span.reset(current_span_token)
+            except ValueError:
+                # exited from another context than the one it was entered in (e.g. a
+                # generator closed by asyncio's finalizer), which isn't ours to change
+                pass
+        new_span._finish(status)
+
+
+def trace(name: str, **attributes: SpanAttributeValue) -> AbstractContextManager[Span]:
+    """
+    Starts a new trace, whose root span is `name`. Every `span` opened in its context
+    (including the tasks created in it) is part of it.
+
+    ```
+    with trace("POST /message", user_id=user_id):
+        with span("load chat history") as history_span:
+            ...
+            history_span.set_attribute("num_messages", len(messages))
+    ```
+
+    Nothing is recorded if there's nowhere to export traces to
+    """
+    trace_in_progress = (
+        _TraceInProgress(trace_id=uuid.uuid4().hex) if _trace_exporters else None
+    )
+    return _start_span(name, trace_in_progress, None, attributes)
+
+
+def span(name: str, **attributes: SpanAttributeValue) -> AbstractContextManager[Span]:
+    """
+    Times a stage of the current trace, as a child of the current span, and becomes the
+    current span until it's exited. Outside of a trace, nothing is recorded, and it costs
+    next to nothing.
+
+    Don't hold one across a `yield`: a generator runs in its consumer's context, so the
+    consumer's spans would become its children. Use `detached_span` there
+    """
+    return _start_child_span(name, attributes, is_current=True)
+
+
+def detached_span(
+    name: str, **attributes: SpanAttributeValue
+) -> AbstractContextManager[Span]:
+    """
+    Like `span`, but never becomes the current span, so it can time a generator across
+    its `yield`s. Spans opened within it are its siblings rather than its children
+    """
+    return _start_child_span(name, attributes, is_current=False)
+
+
+def _start_child_span(
+    name: str, attributes: dict[str, SpanAttributeValue], is_current: bool
+) -> AbstractContextManager[Span]:
+    parent_span = _current_span.get()
+    if parent_span is None:
+        return _start_span(name, None, None, attributes)
+    return _start_span(
+        name,
+        parent_span._trace_in_progress,
+        parent_span.span_id,
+        attributes,
+        is_current=is_current,
+    )
+
+
+def group_spans_into_traces(finished_spans: Iterable[FinishedSpan]) -> list[Trace]:
+    """
+    Returns
+    -------
+    list[Trace]
+        In the order their first span arrived. Traces whose root span isn't there are
+        left out
+    """
+    finished_spans_by_trace_id: dict[str, list[FinishedSpan]] = {}
+    for finished_span in finished_spans:
+        finished_spans_by_trace_id.setdefault(finished_span.trace_id, []).append(
+            finished_span
+        )
+    traces: list[Trace] = []
+    for trace_id, spans_of_trace in finished_spans_by_trace_id.items():
+        root_span = next(
+            (
+                finished_span
+                for finished_span in spans_of_trace
+                if finished_span.parent_span_id is None
+            ),
+            None,
+        )
+        if root_span is None:
+            continue
+        traces.append(
+            Trace(
+                trace_id=trace_id,
+                name=root_span.name,
+                started_at=root_span.started_at,
+                duration_seconds=max(
+                    finished_span.started_at
+                    + finished_span.duration_seconds
+                    - root_span.started_at
+                    for finished_span in spans_of_trace
+                ),
+                spans=sorted(
+                    spans_of_trace, key=lambda finished_span: finished_span.started_at
+                ),
+            )
+        )
+    return traces
+
+
+class InMemoryTraceExporter:
+    """
+    Keeps the spans of the last `max_num_traces` traces. Not thread-safe: read them on
+    the event loop, where spans are finished
+    """
+
+    def __init__(self, max_num_traces: int = 200) -> None:
+        self.max_num_traces = max_num_traces
+        self._finished_spans_by_trace_id: OrderedDict[str, list[FinishedSpan]] = (
+            OrderedDict()
+        )
+
+    def export(self, finished_spans: list[FinishedSpan]) -> None:
+        for finished_span in finished_spans:
+            self._finished_spans_by_trace_id.setdefault(
+                finished_span.trace_id, []
+            ).append(finished_span)
+        while len(self._finished_spans_by_trace_id) > self.max_num_traces:
+            self._finished_spans_by_trace_id.popitem(last=False)
+
+    def get_traces(self) -> list[Trace]:
+        """
+        Most recent first
+        """
+        return group_spans_into_traces(
+            finished_span
+            for spans_of_trace in reversed(self._finished_spans_by_trace_id.values())
+            for finished_span in spans_of_trace
+        )
+
+
+class NdjsonFileTraceExporter:
+    """
+    Appends every span to `path`, as one JSON object per line. The file is written on a
+    background thread
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._finished_spans: queue.SimpleQueue[list[FinishedSpan] | None] = (
+            queue.SimpleQueue()
+        )
+        self._writer_thread = threading.Thread(
+            target=self._write_forever, name="ndjson_trace_exporter", daemon=True
+        )
+        self._writer_thread.start()
+        atexit.register(self.stop)
+
+    def export(self, finished_spans: list[FinishedSpan]) -> None:
+        self._finished_spans.put(finished_spans)
+
+    def stop(self) -> None:
+        """
+        Writes whatever is left, then stops the writer thread
+        """
+        if self._writer_thread.is_alive():
+            self._finished_spans.put(None)
+            self._writer_thread.join()
+
+    def _write_forever(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a") as ndjson_file:
+            while True:
+                finished_spans = self._finished_spans.get()
+                while finished_spans is not None:
+                    for finished_span in finished_spans:
+                        ndjson_file.write(json.dumps(asdict(finished_span)) + "\n")
+                    try:
+                        finished_spans = self._finished_spans.get_nowait()
+                    except queue.Empty:
+                        break
+                # once per batch of spans, rather than once per span
+                ndjson_file.flush()
+                if finished_spans is None:
+                    return
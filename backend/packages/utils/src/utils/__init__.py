@@ -1,5 +1,5 @@
 __version__ = "0.0.1"
-from .data_structures import TypedDiskCache, biter
+from .data_structures import TokenBucket, biter
 from .environment import (
     K4Environment,
     get_environment,
@@ -7,8 +7,24 @@ from .environment import (
     is_production_environment,
 )
 from .file_io import get_repo_root_directory
-from .openai_tools import convert_python_function_to_openai_tool_json
-from .utils import time_expiring_lru_cache
+from .metrics import LatencyHistogram, LatencyHistogramSnapshot
+from .ttl_cache import TtlCacheStats, ttl_cache
+
+
+def __getattr__(name: str) -> object:
+    # `TypedDiskCache` pulls in diskcache, and `convert_python_function_to_openai_tool_json`
+    # pulls in docstring_parser. Most importers of `utils` need neither, so they're
+    # only imported when asked for
+    if name == "TypedDiskCache":
+        from .disk_cache import TypedDiskCache
+
+        return TypedDiskCache
+    if name == "convert_python_function_to_openai_tool_json":
+        from .openai_tools import convert_python_function_to_openai_tool_json
+
+        return convert_python_function_to_openai_tool_json
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 __all__ = [
     "get_repo_root_directory",
@@ -17,7 +33,11 @@ __all__ = [
     "get_environment",
     "is_development_environment",
     "is_production_environment",
-    "time_expiring_lru_cache",
+    "ttl_cache",
+    "TtlCacheStats",
     "convert_python_function_to_openai_tool_json",
     "TypedDiskCache",
+    "TokenBucket",
+    "LatencyHistogram",
+    "LatencyHistogramSnapshot",
 ]
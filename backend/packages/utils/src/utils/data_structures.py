@@ -1,7 +1,27 @@
-from pathlib import Path
-from typing import Any, Callable, Generator, Iterable, Iterator, TypeVar
-
-import diskcache
+import asyncio
+import itertools
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Generator,
+    Iterable,
+    Iterator,
+    TypeVar,
+)
 
 _ReturnType = TypeVar("_ReturnType")
 
@@ -65,105 +85,200 @@ class biter[_T]:
 
         return accumulated_value
 
+    def chunked(self, chunk_size: int) -> "biter[tuple[_T, ...]]":
+        """
+        Groups the values in tuples of `chunk_size`, e.g. to insert them in batches. The
+        last one may be shorter
 
-class TypedDiskCache[_KeyType, _ValueType](diskcache.Cache):
-    """
-    A wrapper around `diskcache.Cache` to facilitate some type-safety, IDE suggestions, etc.
-    """
+        ```
+        list(biter(range(5)).chunked(2))
+        # [(0, 1), (2, 3), (4,)]
+        ```
+        """
+        if chunk_size < 1:
+            raise ValueError(f"{chunk_size=} must be at least 1")
+        return biter(itertools.batched(self, chunk_size))
 
-    # it doesn't like that **settings isn't typed. Can't blame mypy tbh
-    def __init__(  # type: ignore[no-untyped-def]
+    async def map_async(
         self,
-        directory: Path,
-        timeout: int = 60,
-        disk: type[diskcache.Disk] = diskcache.Disk,
-        **settings,
-    ) -> None:
+        transform: Callable[[_T], Awaitable[_ReturnType]],
+        max_concurrency: int = 8,
+        ordered: bool = True,
+    ) -> AsyncGenerator[_ReturnType, None]:
         """
-        Initialize (a typed) cache instance.
-
-        Parameters
-        ----------
-        directory : Path
-            The directory in which the cache (sqlite db) will be written. This should be
-            a unique identifier for this cache, i.e., when the application is restarted,
-            the directory name will be what enables persistence.
-
-            To lessen the probability of committing an API key to a public repository,
-            the cache is saved to `{directory}/.typed_diskcache/`, and
-            `.typed_diskcache/*` is part of this repo's `.gitignore`.
-        timeout : int, optional
-            SQLite connection timeout, by default 60
-        disk : type[diskcache.Disk], optional
-            Disk type or subclass for serialization, by default Disk
-        **settings : any of:
-
-            DEFAULT_SETTINGS = {
-                'statistics': 0,  # False
-                'tag_index': 0,  # False
-                'eviction_policy': 'least-recently-stored',
-                'size_limit': 2**30,  # 1gb
-                'cull_limit': 10,
-                'sqlite_auto_vacuum': 1,  # FULL
-                'sqlite_cache_size': 2**13,  # 8,192 pages
-                'sqlite_journal_mode': 'wal',
-                'sqlite_mmap_size': 2**26,  # 64mb
-                'sqlite_synchronous': 1,  # NORMAL
-                'disk_min_file_size': 2**15,  # 32kb
-                'disk_pickle_protocol': pickle.HIGHEST_PROTOCOL,
-            }
+        Awaits `transform(value)` for every value, with at most `max_concurrency` of them
+        in flight. Values are only taken from the iterable as there's room, so it can be
+        endless.
 
-        """
-        super().__init__(
-            directory=str(directory.joinpath(".typed_diskcache")),
-            timeout=timeout,
-            disk=disk,
-            **settings,
-        )
+        If `ordered`, the results come in the order of the values, otherwise as soon as
+        they're ready. If a `transform` raises, or the caller stops iterating, the ones
+        in flight are cancelled
 
-    def __getitem__(self, key: _KeyType) -> _ValueType:
-        return super().__getitem__(key)  # type: ignore[no-any-return]
+        ```
+        async for chat in biter(chat_ids).map_async(get_chat, max_concurrency=4):
+            ...
+        ```
+        """
+        if max_concurrency < 1:
+            raise ValueError(f"{max_concurrency=} must be at least 1")
+        values = iter(self)
+        tasks_in_flight: deque[asyncio.Future[_ReturnType]] = deque()
+
+        def start_tasks() -> None:
+            for value in itertools.islice(
+                values, max_concurrency - len(tasks_in_flight)
+            ):
+                tasks_in_flight.append(asyncio.ensure_future(transform(value)))
+
+        try:
+            start_tasks()
+            while tasks_in_flight:
+                if ordered:
+                    done_task = tasks_in_flight.popleft()
+                    result = await done_task
+                else:
+                    done_tasks, _ = await asyncio.wait(
+                        tasks_in_flight, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    done_task = done_tasks.pop()
+                    tasks_in_flight.remove(done_task)
+                    result = done_task.result()
+                start_tasks()
+                yield result
+        finally:
+            for task in tasks_in_flight:
+                task.cancel()
+            await asyncio.gather(*tasks_in_flight, return_exceptions=True)
+
+    def parallel_map(
+        self,
+        transform: Callable[[_T], _ReturnType],
+        max_workers: int | None = None,
+        use_processes: bool = False,
+        ordered: bool = True,
+        executor: Executor | None = None,
+    ) -> "biter[_ReturnType]":
+        """
+        Like `map`, but `transform` runs in a pool of threads (for I/O, or code that
+        releases the GIL), or of processes if `use_processes` (for CPU-bound work, in
+        which case `transform` and the values have to be picklable). Nothing runs until
+        the result is iterated.
 
-    def __setitem__(self, key: _KeyType, value: _ValueType) -> None:
-        return super().__setitem__(key, value)
+        At most twice as many values as there are workers are submitted at a time, so it
+        can go over an endless iterable without holding all of it. If `ordered`, the
+        results come in the order of the values, otherwise as soon as they're ready.
 
-    def keys(self) -> Generator[_KeyType, None, None]:
-        return self.iterkeys()
+        The pool (of `max_workers`, by default one per CPU) is created for the iteration
+        and shut down after it, unless an `executor` is passed in
 
-    def items(self) -> Generator[tuple[_KeyType, _ValueType], None, None]:
-        """
-        For some reason the interface of diskcache.Cache is different than `dict`'s...
-        so gotta implement these myself lol
+        ```
+        for embedding in biter(documents).parallel_map(embed, use_processes=True):
+            ...
+        ```
         """
-        for key in self.keys():
-            yield key, self[key]
 
-    def values(self) -> Generator[_ValueType, None, None]:
-        for _, value in self.items():
-            yield value
+        # `os.process_cpu_count()` would respect CPU affinity, but only exists from 3.13
+        num_workers = max_workers or os.cpu_count() or 1
+
+        def parallel_map_values_generator() -> Generator[_ReturnType, Any, None]:
+            own_executor: Executor | None = None
+            if executor is None:
+                own_executor = (
+                    ProcessPoolExecutor(
+                        max_workers=num_workers,
+                        # forking a process with threads (e.g. an event loop's) is asking
+                        # for trouble
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                    if use_processes
+                    else ThreadPoolExecutor(max_workers=num_workers)
+                )
+            submit_to = executor or own_executor
+            assert submit_to is not None
+
+            values = iter(self)
+            futures_in_flight: deque[Future[_ReturnType]] = deque()
+
+            def submit_values() -> None:
+                for value in itertools.islice(
+                    values, 2 * num_workers - len(futures_in_flight)
+                ):
+                    futures_in_flight.append(submit_to.submit(transform, value))
+
+            try:
+                submit_values()
+                while futures_in_flight:
+                    if ordered:
+                        result = futures_in_flight.popleft().result()
+                    else:
+                        done_futures, _ = wait(
+                            futures_in_flight, return_when=FIRST_COMPLETED
+                        )
+                        done_future = done_futures.pop()
+                        futures_in_flight.remove(done_future)
+                        result = done_future.result()
+                    submit_values()
+                    yield result
+            finally:
+                for future in futures_in_flight:
+                    future.cancel()
+                if own_executor is not None:
+                    own_executor.shutdown(wait=True, cancel_futures=True)
+
+        return biter(parallel_map_values_generator())
+
+
+class TokenBucket:
+    """
+    Holds at most `capacity` tokens, and is continuously refilled at
+    `refill_rate_per_second`. Not thread-safe, but it doesn't need to be on an event
+    loop.
+    """
 
-    def create_dict(self) -> dict[_KeyType, _ValueType]:
-        return {key: value for key, value in self.items()}
+    def __init__(self, capacity: float, refill_rate_per_second: float) -> None:
+        self.capacity = capacity
+        self.refill_rate_per_second = refill_rate_per_second
+        self.available_tokens = capacity
+        self._last_refilled_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available_tokens = min(
+            self.capacity,
+            self.available_tokens
+            + (now - self._last_refilled_at) * self.refill_rate_per_second,
+        )
+        self._last_refilled_at = now
 
-    def __str__(self) -> str:
+    def try_consume(self, num_tokens: float = 1) -> float:
         """
-        _summary_
+        Consumes `num_tokens` if they're available.
 
         Returns
         -------
-        _type_
-            _description_
+        float
+            `0` if the tokens were consumed. Otherwise nothing is consumed, and this is
+            the number of seconds until `num_tokens` will be available
         """
-        if len(self) == 0:
-            return f"{type(self).__name__}(<empty>)"
-
-        key_to_values_str = "\n\t".join(
-            f"{key} => {value}" for key, value in self.items()
-        )
-        return f"{type(self).__name__}(\n\t{key_to_values_str}\n)"  # lmao
+        self._refill()
+        if self.available_tokens >= num_tokens:
+            self.available_tokens -= num_tokens
+            return 0
+        if self.refill_rate_per_second <= 0:
+            return float("inf")
+        return (num_tokens - self.available_tokens) / self.refill_rate_per_second
+
+    def refund(self, num_tokens: float = 1) -> None:
+        """
+        Gives back tokens that were consumed for nothing, e.g. by a request turned away
+        further down the line
+        """
+        self._refill()
+        self.available_tokens = min(self.capacity, self.available_tokens + num_tokens)
 
-    def __repr__(self) -> str:
+    def is_full(self) -> bool:
         """
-        Just returns str(self). I'm ignoring that eval(repr(self)) should work.
+        A full bucket is no different from a new one, so it can be forgotten
         """
-        return str(self)
+        self._refill()
+        return self.available_tokens >= self.capacity
@@ -0,0 +1,238 @@
+import time
+from pathlib import Path
+from typing import Any, Callable, Generator, Iterable, NamedTuple
+
+import diskcache
+
+_MISSING = object()
+
+
+class DiskCacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    """
+    Items removed to stay under `size_limit` (removing expired items doesn't count).
+    Only counted by this process, since it was started
+    """
+
+
+class DiskCacheSizeReport(NamedTuple):
+    num_items: int
+    volume_bytes: int
+    """
+    Estimated size of the cache on disk, including the values stored in files
+    """
+    size_limit_bytes: int
+
+
+class TypedDiskCache[_KeyType, _ValueType](diskcache.Cache):
+    """
+    A wrapper around `diskcache.Cache` to facilitate some type-safety, IDE suggestions, etc.
+    """
+
+    # it doesn't like that **settings isn't typed. Can't blame mypy tbh
+    def __init__(  # type: ignore[no-untyped-def]
+        self,
+        directory: Path,
+        timeout: int = 60,
+        disk: type[diskcache.Disk] = diskcache.Disk,
+        **settings,
+    ) -> None:
+        """
+        Initialize (a typed) cache instance.
+
+        Parameters
+        ----------
+        directory : Path
+            The directory in which the cache (sqlite db) will be written. This should be
+            a unique identifier for this cache, i.e., when the application is restarted,
+            the directory name will be what enables persistence.
+
+            To lessen the probability of committing an API key to a public repository,
+            the cache is saved to `{directory}/.typed_diskcache/`, and
+            `.typed_diskcache/*` is part of this repo's `.gitignore`.
+        timeout : int, optional
+            SQLite connection timeout, by default 60
+        disk : type[diskcache.Disk], optional
+            Disk type or subclass for serialization, by default Disk
+        **settings : any of:
+
+            DEFAULT_SETTINGS = {
+                'statistics': 0,  # False
+                'tag_index': 0,  # False
+                'eviction_policy': 'least-recently-stored',
+                'size_limit': 2**30,  # 1gb
+                'cull_limit': 10,
+                'sqlite_auto_vacuum': 1,  # FULL
+                'sqlite_cache_size': 2**13,  # 8,192 pages
+                'sqlite_journal_mode': 'wal',
+                'sqlite_mmap_size': 2**26,  # 64mb
+                'sqlite_synchronous': 1,  # NORMAL
+                'disk_min_file_size': 2**15,  # 32kb
+                'disk_pickle_protocol': pickle.HIGHEST_PROTOCOL,
+            }
+
+        """
+        super().__init__(
+            directory=str(directory.joinpath(".typed_diskcache")),
+            timeout=timeout,
+            disk=disk,
+            **settings,
+        )
+        self._num_evictions = 0
+
+    def __getitem__(self, key: _KeyType) -> _ValueType:
+        return super().__getitem__(key)  # type: ignore[no-any-return]
+
+    def __setitem__(self, key: _KeyType, value: _ValueType) -> None:
+        return super().__setitem__(key, value)
+
+    def keys(self) -> Generator[_KeyType, None, None]:
+        return self.iterkeys()
+
+    def items(self) -> Generator[tuple[_KeyType, _ValueType], None, None]:
+        """
+        Every unexpired item, in insertion order. The rows are read in batches of
+        `batch_size` keys and values, rather than one query per key.
+
+        Unlike `self[key]`, this doesn't count as an access, neither for the eviction
+        policy nor for the statistics
+        """
+        return self._iter_items()
+
+    def _iter_items(
+        self, batch_size: int = 1000
+    ) -> Generator[tuple[_KeyType, _ValueType], None, None]:
+        # diskcache has no public way to read rows in bulk, hence its private `_sql`
+        last_rowid = 0
+        while True:
+            rows = self._sql(  # type: ignore[attr-defined]
+                "SELECT rowid, key, raw, expire_time, mode, filename, value FROM Cache"
+                " WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            now = time.time()
+            for rowid, db_key, raw, expire_time, mode, filename, db_value in rows:
+                last_rowid = rowid
+                if expire_time is not None and expire_time < now:
+                    continue
+                try:
+                    value = self.disk.fetch(mode, filename, db_value, False)
+                except OSError:
+                    # the file was removed by a concurrent delete/eviction
+                    continue
+                yield self.disk.get(db_key, raw), value
+
+    def values(self) -> Generator[_ValueType, None, None]:
+        for _, value in self.items():
+            yield value
+
+    def get_many(self, keys: Iterable[_KeyType]) -> dict[_KeyType, _ValueType]:
+        """
+        The values of the `keys` that are in the cache, read in a single transaction
+
+        Returns
+        -------
+        dict[_KeyType, _ValueType]
+            Missing (or expired) keys are left out
+        """
+        values_by_key: dict[_KeyType, _ValueType] = {}
+        with self.transact(retry=True):
+            for key in keys:
+                value = self.get(key, default=_MISSING)
+                if value is not _MISSING:
+                    values_by_key[key] = value
+        return values_by_key
+
+    def set_many(
+        self,
+        items: Iterable[tuple[_KeyType, _ValueType]],
+        expire: float | None = None,
+    ) -> None:
+        """
+        Sets every item in a single transaction, so with a single commit (and fsync)
+        rather than one per item
+
+        Parameters
+        ----------
+        expire : float | None, optional
+            Seconds until the items expire, by default None (never)
+        """
+        with self.transact(retry=True):
+            for key, value in items:
+                self.set(key, value, expire=expire)
+
+    def get_stats(self) -> DiskCacheStats:
+        """
+        Hits and misses are only counted if the cache was created with
+        `statistics=True`. They're shared by every process using the cache
+        """
+        # `stats` also sets whether to count them, so keep that as it was
+        hits, misses = self.stats(enable=bool(self.statistics))
+        return DiskCacheStats(hits=hits, misses=misses, evictions=self._num_evictions)
+
+    def get_size_report(self) -> DiskCacheSizeReport:
+        return DiskCacheSizeReport(
+            num_items=len(self),
+            volume_bytes=self.volume(),
+            size_limit_bytes=self.size_limit,
+        )
+
+    def _cull(
+        self,
+        now: float,
+        sql: Callable[..., Any],
+        cleanup: Callable[[str | None], None],
+        limit: int | None = None,
+    ) -> None:
+        """
+        diskcache evicts items while setting others, and calls `cleanup` once per evicted
+        item, so wrap it to count them. It removes expired items first, then, if the
+        cache is still too big, the items its eviction policy picks. Only those count
+        """
+        is_evicting_by_policy = False
+
+        def note_eviction_by_policy_and_sql(statement: str, *args: Any) -> Any:
+            nonlocal is_evicting_by_policy
+            # only the expired items are selected by their `expire_time`
+            if "expire_time IS NOT NULL" not in statement:
+                is_evicting_by_policy = True
+            return sql(statement, *args)
+
+        def count_eviction_and_cleanup(filename: str | None) -> None:
+            if is_evicting_by_policy:
+                self._num_evictions += 1
+            cleanup(filename)
+
+        super()._cull(  # type: ignore[misc]
+            now, note_eviction_by_policy_and_sql, count_eviction_and_cleanup, limit
+        )
+
+    def create_dict(self) -> dict[_KeyType, _ValueType]:
+        return {key: value for key, value in self.items()}
+
+    def __str__(self) -> str:
+        """
+        _summary_
+
+        Returns
+        -------
+        _type_
+            _description_
+        """
+        if len(self) == 0:
+            return f"{type(self).__name__}(<empty>)"
+
+        key_to_values_str = "\n\t".join(
+            f"{key} => {value}" for key, value in self.items()
+        )
+        return f"{type(self).__name__}(\n\t{key_to_values_str}\n)"  # lmao
+
+    def __repr__(self) -> str:
+        """
+        Just returns str(self). I'm ignoring that eval(repr(self)) should work.
+        """
+        return str(self)
@@ -1,6 +1,8 @@
 import os
 from enum import Enum
 from functools import cache
+from pathlib import Path
+from typing import Literal
 
 
 @cache
@@ -26,3 +28,104 @@ def is_development_environment() -> bool:
 
 def is_production_environment() -> bool:
     return get_environment() == K4Environment.PRODUCTION
+
+
+@cache
+def is_message_group_commit_enabled() -> bool:
+    """
+    If enabled, concurrent message inserts are batched into one statement/transaction
+    """
+    return os.getenv("K4_MESSAGE_GROUP_COMMIT") == "true"
+
+
+@cache
+def get_extension_deadline_seconds() -> float | None:
+    """
+    How long an extension's hook may take before we give up on it and use the default
+    implementation instead. `K4_EXTENSION_DEADLINE_SECONDS=none` disables the deadline
+    """
+    deadline_seconds = os.getenv("K4_EXTENSION_DEADLINE_SECONDS", "10")
+    if deadline_seconds.lower() == "none":
+        return None
+    return float(deadline_seconds)
+
+
+@cache
+def is_startup_profiling_enabled() -> bool:
+    """
+    If enabled, how long each phase of startup took is logged once startup is done
+    """
+    return os.getenv("K4_STARTUP_PROFILE") == "true"
+
+
+@cache
+def is_sliding_session_expiry_enabled() -> bool:
+    """
+    If enabled, a session expires once it's unused for as long as a session lasts,
+    rather than that long after logging in
+    """
+    return os.getenv("K4_SLIDING_SESSION_EXPIRY") == "true"
+
+
+@cache
+def get_chat_requests_per_minute() -> float | None:
+    """
+    How many messages a user may send per minute (in bursts of up to that many).
+    `K4_CHAT_REQUESTS_PER_MINUTE=none` disables the limit
+    """
+    requests_per_minute = os.getenv("K4_CHAT_REQUESTS_PER_MINUTE", "20")
+    if requests_per_minute.lower() == "none":
+        return None
+    return float(requests_per_minute)
+
+
+@cache
+def are_rate_limits_shared_across_workers() -> bool:
+    """
+    If enabled, rate limits are also counted in Postgres, so that they hold across
+    workers. Otherwise each worker counts on its own
+    """
+    return os.getenv("K4_SHARED_RATE_LIMITS") == "true"
+
+
+@cache
+def get_log_format() -> Literal["rich", "json"]:
+    """
+    `K4_LOG_FORMAT=json` writes logs as JSON lines, on a background thread.
+    `K4_LOG_FORMAT=rich` pretty-prints them, for a terminal. By default JSON lines in
+    production, and Rich in development
+    """
+    match os.getenv("K4_LOG_FORMAT"):
+        case "json":
+            return "json"
+        case "rich":
+            return "rich"
+    return "json" if is_production_environment() else "rich"
+
+
+@cache
+def get_log_sample_rate() -> float:
+    """
+    The share of log records below WARNING that are kept (between 0 and 1), when logging
+    JSON lines. `K4_LOG_SAMPLE_RATE`, by default 1 (every record)
+    """
+    return float(os.getenv("K4_LOG_SAMPLE_RATE", "1"))
+
+
+@cache
+def get_traces_file_path() -> Path | None:
+    """
+    If `K4_TRACES_FILE` is set, the spans of every request are appended to that file, one
+    JSON object per line
+    """
+    traces_file_path = os.getenv("K4_TRACES_FILE")
+    return Path(traces_file_path) if traces_file_path else None
+
+
+@cache
+def get_num_traces_kept_in_memory() -> int:
+    """
+    How many of the latest traces admins can look at with `GET /traces`.
+    `K4_TRACES_IN_MEMORY`, by default 200. 0 disables it
+    """
+    return int(os.getenv("K4_TRACES_IN_MEMORY", "200"))
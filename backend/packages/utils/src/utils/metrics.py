@@ -0,0 +1,99 @@
+import bisect
+import math
+from dataclasses import dataclass
+
+DEFAULT_LATENCY_BUCKET_UPPER_BOUNDS_SECONDS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+@dataclass
+class LatencyHistogramSnapshot:
+    count: int
+    sum_seconds: float
+    max_seconds: float
+    p50_seconds: float
+    p99_seconds: float
+    bucket_counts: dict[str, int]
+    """
+    Not cumulative. Keyed by the bucket's upper bound, e.g. `"le_0.25"`, with the last
+    bucket being `"le_inf"`
+    """
+
+
+class LatencyHistogram:
+    """
+    A fixed-bucket histogram of durations, Prometheus-style. Cheap enough to `observe()`
+    on every request.
+
+    ```
+    histogram = LatencyHistogram()
+    histogram.observe(0.12)
+    histogram.snapshot().p99_seconds
+    ```
+    """
+
+    def __init__(
+        self,
+        bucket_upper_bounds_seconds: tuple[float, ...] = (
+            DEFAULT_LATENCY_BUCKET_UPPER_BOUNDS_SECONDS
+        ),
+    ) -> None:
+        self.bucket_upper_bounds_seconds = tuple(sorted(bucket_upper_bounds_seconds))
+        # the extra bucket at the end is for everything above the largest upper bound
+        self._bucket_counts = [0] * (len(self.bucket_upper_bounds_seconds) + 1)
+        self._count = 0
+        self._sum_seconds = 0.0
+        self._max_seconds = 0.0
+
+    def observe(self, seconds: float) -> None:
+        bucket_idx = bisect.bisect_left(self.bucket_upper_bounds_seconds, seconds)
+        self._bucket_counts[bucket_idx] += 1
+        self._count += 1
+        self._sum_seconds += seconds
+        self._max_seconds = max(self._max_seconds, seconds)
+
+    def get_approximate_quantile(self, quantile: float) -> float:
+        """
+        Returns the upper bound of the bucket containing the `quantile`. Overestimates,
+        but never by more than one bucket. The overflow bucket reports the max observed
+        value.
+        """
+        if self._count == 0:
+            return 0.0
+        target_count = math.ceil(quantile * self._count)
+        cumulative_count = 0
+        for bucket_idx, bucket_count in enumerate(self._bucket_counts):
+            cumulative_count += bucket_count
+            if cumulative_count >= target_count:
+                if bucket_idx == len(self.bucket_upper_bounds_seconds):
+                    return self._max_seconds
+                return min(
+                    self.bucket_upper_bounds_seconds[bucket_idx], self._max_seconds
+                )
+        return self._max_seconds
+
+    def snapshot(self) -> LatencyHistogramSnapshot:
+        bucket_names = [
+            f"le_{upper_bound}" for upper_bound in self.bucket_upper_bounds_seconds
+        ] + ["le_inf"]
+        return LatencyHistogramSnapshot(
+            count=self._count,
+            sum_seconds=self._sum_seconds,
+            max_seconds=self._max_seconds,
+            p50_seconds=self.get_approximate_quantile(0.5),
+            p99_seconds=self.get_approximate_quantile(0.99),
+            bucket_counts=dict(zip(bucket_names, self._bucket_counts, strict=True)),
+        )
@@ -0,0 +1,64 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class StartupProfile:
+    """
+    How long each phase of startup took, e.g. imports and migrations. Phases may run
+    concurrently, so their durations don't necessarily add up to the total.
+
+    ```
+    with startup_profile.phase("migrations"):
+        await run_migrations()
+    log.info(startup_profile.get_report())
+    ```
+    """
+
+    def __init__(self) -> None:
+        self.seconds_by_phase: dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, phase_name: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(phase_name, time.perf_counter() - start_time)
+
+    def record_phase(self, phase_name: str, seconds: float) -> None:
+        self.seconds_by_phase[phase_name] = seconds
+
+    def get_report(self) -> str:
+        longest_phase_name_length = max(
+            (len(phase_name) for phase_name in self.seconds_by_phase), default=0
+        )
+        return "\n".join(
+            ["Startup profile:"]
+            + [
+                f"  {phase_name:<{longest_phase_name_length}}  {seconds:8.3f}s"
+                for phase_name, seconds in self.seconds_by_phase.items()
+            ]
+        )
+
+
+def get_seconds_since_process_start() -> float | None:
+    """
+    Includes the interpreter's own startup and every import. Only works on Linux (it
+    reads `/proc`), `None` elsewhere
+    """
+    try:
+        with open("/proc/self/stat") as stat_file:
+            stat = stat_file.read()
+        with open("/proc/uptime") as uptime_file:
+            uptime_seconds = float(uptime_file.read().split()[0])
+    except OSError:
+        return None
+    # the 2nd field is the executable's name in parentheses, which may contain spaces.
+    # The process's start time (in clock ticks since boot) is the 22nd field
+    start_time_ticks = int(stat.rsplit(")", 1)[1].split()[19])
+    return uptime_seconds - start_time_ticks / os.sysconf("SC_CLK_TCK")
+
+
+startup_profile = StartupProfile()
@@ -0,0 +1,283 @@
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Hashable, NamedTuple, cast
+
+logger = logging.getLogger(__name__)
+
+_KWARGS_MARK = object()
+
+
+class TtlCacheStats(NamedTuple):
+    hits: int
+    stale_hits: int
+    """
+    Served an expired value, while it was refreshed in the background
+    """
+    misses: int
+    evictions: int
+    size: int
+
+
+@dataclass
+class _CacheEntry:
+    value: Any
+    expires_at: float
+    stale_until: float
+
+
+def _make_key(args: tuple[Any, ...], kwargs: dict[str, Any]) -> Hashable:
+    if not kwargs:
+        return args
+    return (*args, _KWARGS_MARK, *sorted(kwargs.items()))
+
+
+class TtlCachedFunction[**P, R]:
+    """
+    See `ttl_cache`
+    """
+
+    def __init__(
+        self,
+        function: Callable[P, R],
+        max_age_seconds: float,
+        stale_while_revalidate_seconds: float,
+        max_size: int,
+    ) -> None:
+        functools.update_wrapper(self, function)
+        self.function = function
+        self.max_age_seconds = max_age_seconds
+        self.stale_while_revalidate_seconds = stale_while_revalidate_seconds
+        self.max_size = max_size
+        self._is_async = inspect.iscoroutinefunction(function)
+        self._entries: OrderedDict[Hashable, _CacheEntry] = OrderedDict()
+        # the sync flavor can be called from several threads
+        self._lock = threading.Lock()
+        self._sync_refreshes: dict[Hashable, concurrent.futures.Future[Any]] = {}
+        self._async_refreshes: dict[Hashable, asyncio.Task[Any]] = {}
+        self._num_hits = 0
+        self._num_stale_hits = 0
+        self._num_misses = 0
+        self._num_evictions = 0
+
+    def __call__(self, *args: P.args, **kwargs: P.kwargs) -> R:
+        key = _make_key(args, kwargs)
+        if self._is_async:
+            return cast(R, self._call_async(key, args, kwargs))
+        return cast(R, self._call_sync(key, args, kwargs))
+
+    def get_stats(self) -> TtlCacheStats:
+        return TtlCacheStats(
+            hits=self._num_hits,
+            stale_hits=self._num_stale_hits,
+            misses=self._num_misses,
+            evictions=self._num_evictions,
+            size=len(self._entries),
+        )
+
+    def clear(self) -> None:
+        """
+        Forgets every value. Refreshes in flight still store theirs
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def _look_up(self, key: Hashable) -> tuple[_CacheEntry | None, bool]:
+        """
+        Returns
+        -------
+        tuple[_CacheEntry | None, bool]
+            The entry if it can be served, and whether it should be refreshed
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now >= entry.stale_until:
+                self._entries.pop(key, None)
+                self._num_misses += 1
+                return None, False
+            self._entries.move_to_end(key)
+            if now < entry.expires_at:
+                self._num_hits += 1
+                return entry, False
+            self._num_stale_hits += 1
+            return entry, True
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = _CacheEntry(
+                value=value,
+                expires_at=now + self.max_age_seconds,
+                stale_until=(
+                    now + self.max_age_seconds + self.stale_while_revalidate_seconds
+                ),
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._num_evictions += 1
+
+    def _call_sync(
+        self, key: Hashable, args: tuple[Any, ...], kwargs: dict[str, Any]
+    ) -> Any:
+        entry, should_refresh = self._look_up(key)
+        if entry is not None:
+            if should_refresh:
+                refresh, is_new_refresh = self._join_sync_refresh(key)
+                if is_new_refresh:
+                    threading.Thread(
+                        target=self._refresh_sync,
+                        args=(refresh, key, args, kwargs, True),
+                        name=f"refresh_{self.function.__name__}",
+                        daemon=True,
+                    ).start()
+            return entry.value
+        refresh, is_new_refresh = self._join_sync_refresh(key)
+        if is_new_refresh:
+            self._refresh_sync(refresh, key, args, kwargs, False)
+        return refresh.result()
+
+    def _join_sync_refresh(
+        self, key: Hashable
+    ) -> tuple[concurrent.futures.Future[Any], bool]:
+        with self._lock:
+            refresh = self._sync_refreshes.get(key)
+            if refresh is not None:
+                return refresh, False
+            refresh = self._sync_refreshes[key] = concurrent.futures.Future()
+            return refresh, True
+
+    def _refresh_sync(
+        self,
+        refresh: concurrent.futures.Future[Any],
+        key: Hashable,
+        args: tuple[Any, ...],
+        kwargs: dict[str, Any],
+        is_in_background: bool,
+    ) -> None:
+        try:
+            value = self.function(*args, **kwargs)
+        except BaseException as exception:
+            if is_in_background:
+                logger.warning(
+                    f"Refreshing {self.function.__name__} failed, serving the stale value",
+                    exc_info=True,
+                )
+            refresh.set_exception(exception)
+        else:
+            # stored first, so that nobody misses between the refresh ending and the value
+            # being there
+            self._store(key, value)
+            refresh.set_result(value)
+        finally:
+            with self._lock:
+                self._sync_refreshes.pop(key, None)
+
+    async def _call_async(
+        self, key: Hashable, args: tuple[Any, ...], kwargs: dict[str, Any]
+    ) -> Any:
+        entry, should_refresh = self._look_up(key)
+        if entry is not None:
+            if should_refresh:
+                self._join_async_refresh(key, args, kwargs, is_in_background=True)
+            return entry.value
+        # shielded, so that a caller giving up doesn't cancel it for the others
+        return await asyncio.shield(
+            self._join_async_refresh(key, args, kwargs, is_in_background=False)
+        )
+
+    def _join_async_refresh(
+        self,
+        key: Hashable,
+        args: tuple[Any, ...],
+        kwargs: dict[str, Any],
+        is_in_background: bool,
+    ) -> "asyncio.Task[Any]":
+        refresh = self._async_refreshes.get(key)
+        # a refresh left over from a closed event loop can't be awaited from this one
+        if refresh is None or refresh.get_loop() is not asyncio.get_running_loop():
+            refresh = asyncio.create_task(
+                self._refresh_async(key, args, kwargs, is_in_background),
+                name=f"refresh_{self.function.__name__}",
+            )
+            self._async_refreshes[key] = refresh
+            refresh.add_done_callback(
+                functools.partial(self._forget_async_refresh, key)
+            )
+        return refresh
+
+    async def _refresh_async(
+        self,
+        key: Hashable,
+        args: tuple[Any, ...],
+        kwargs: dict[str, Any],
+        is_in_background: bool,
+    ) -> Any:
+        try:
+            value = await cast(Awaitable[Any], self.function(*args, **kwargs))
+        except Exception:
+            if is_in_background:
+                logger.warning(
+                    f"Refreshing {self.function.__name__} failed, serving the stale value",
+                    exc_info=True,
+                )
+            raise
+        self._store(key, value)
+        return value
+
+    def _forget_async_refresh(
+        self, key: Hashable, refresh: "asyncio.Task[Any]"
+    ) -> None:
+        if self._async_refreshes.get(key) is refresh:
+            del self._async_refreshes[key]
+        # nobody awaits a background refresh, so retrieve its exception here to keep
+        # asyncio from complaining about it
+        if not refresh.cancelled():
+            refresh.exception()
+
+
+def ttl_cache[**P, R](
+    max_age_seconds: float,
+    max_size: int = 128,
+    stale_while_revalidate_seconds: float = 0.0,
+) -> Callable[[Callable[P, R]], TtlCachedFunction[P, R]]:
+    """
+    Caches the return values of a function (sync or `async`) by its arguments, for
+    `max_age_seconds` after each value was computed.
+
+    - Concurrent calls with the same arguments that miss share a single call to the
+    function (per event loop for an `async` function), rather than stampeding it
+    - For `stale_while_revalidate_seconds` after a value expires, calls still get it
+    right away, while one refresh happens in the background (on a thread for a sync
+    function, as a task for an `async` one). If the refresh fails, the stale value keeps
+    being served until then
+    - The least recently used values are evicted past `max_size`
+    - Exceptions aren't cached
+
+    ```
+    @ttl_cache(max_age_seconds=60, stale_while_revalidate_seconds=600)
+    async def get_exchange_rates(currency: str) -> dict[str, float]:
+        ...
+
+    get_exchange_rates.get_stats()
+    ```
+
+    Works for functions and `staticmethod`s, not for methods, since `self` isn't bound
+    """
+
+    def decorator(function: Callable[P, R]) -> TtlCachedFunction[P, R]:
+        return TtlCachedFunction(
+            function,
+            max_age_seconds=max_age_seconds,
+            stale_while_revalidate_seconds=stale_while_revalidate_seconds,
+            max_size=max_size,
+        )
+
+    return decorator
@@ -2,17 +2,29 @@ from typing import Literal
 
 import uvicorn
 from api import (
+    RequestIdMiddleware,
+    TracingMiddleware,
     auth_router,
+    chat_websocket_router,
     chats_router,
     extensions_router,
     lifespan,
     providers_router,
     setup_router,
+    traces_router,
+    usage_router,
     users_router,
 )
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from utils.environment import is_development_environment, is_running_in_docker_container
+from fastapi.middleware.gzip import GZipMiddleware
+from utils.environment import (
+    get_log_format,
+    is_development_environment,
+    is_running_in_docker_container,
+)
+from utils.startup_profiling import get_seconds_since_process_start, startup_profile
+from uvicorn.config import LOGGING_CONFIG
 
 app = FastAPI(lifespan=lifespan)
 app.add_middleware(
@@ -26,13 +38,30 @@ app.add_middleware(
     allow_methods=["GET", "POST", "DELETE"],
     allow_headers=["*"],
 )
+# `text/event-stream` responses are never compressed (nor buffered), so the chat streams
+# still arrive chunk by chunk
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+# times the whole request, compression included
+app.add_middleware(TracingMiddleware)
+# the outermost, so that everything logged while handling a request has its id
+app.add_middleware(RequestIdMiddleware)
 
 app.include_router(auth_router)
 app.include_router(setup_router)
 app.include_router(users_router)
 app.include_router(chats_router)
+app.include_router(chat_websocket_router)
 app.include_router(extensions_router)
 app.include_router(providers_router)
+app.include_router(usage_router)
+app.include_router(traces_router)
+
+seconds_since_process_start = get_seconds_since_process_start()
+if seconds_since_process_start is not None:
+    startup_profile.record_phase(
+        "process start until the app is created (mostly imports)",
+        seconds_since_process_start,
+    )
 
 
 @app.get("/")
@@ -46,6 +75,9 @@ def main() -> None:
         host="0.0.0.0" if is_running_in_docker_container() else "localhost",
         port=8000,
         reload=is_development_environment() and not is_running_in_docker_container(),
+        # uvicorn's own logging config writes straight to the terminal. Without it, its
+        # logs go through ours, as JSON lines
+        log_config=None if get_log_format() == "json" else LOGGING_CONFIG,
     )
 
 
@@ -0,0 +1,148 @@
+import asyncio
+from typing import AsyncGenerator
+
+import pytest
+from api.chat_generation import (
+    ChatGeneration,
+    ChatGenerations,
+    EventsNoLongerBufferedError,
+    parse_event_id,
+)
+from api.chats import LlmStreamingChunk
+from pydantic import BaseModel
+
+
+async def generate_chunks(num_chunks: int) -> AsyncGenerator[BaseModel, None]:
+    for chunk_index in range(num_chunks):
+        await asyncio.sleep(0.001)
+        yield LlmStreamingChunk(chat_id=1, chunk=str(chunk_index))
+
+
+def test_resuming_replays_from_after_the_last_event_then_continues_live() -> None:
+    async def read_resume_and_read() -> tuple[list[str], list[str]]:
+        chat_generations = ChatGenerations()
+        chat_generation = chat_generations.start(1, 1, generate_chunks(5))
+        first_event_ids = []
+        # the connection drops after two events
+        async for event_id, _ in chat_generation.follow():
+            first_event_ids.append(event_id)
+            if len(first_event_ids) == 2:
+                break
+
+        generation_id, event_index = parse_event_id(first_event_ids[-1])
+        resumed_chat_generation = chat_generations.get(generation_id)
+        assert resumed_chat_generation is chat_generation
+        resumed_chunks = [
+            LlmStreamingChunk.model_validate_json(serialized_event).chunk
+            async for _, serialized_event in chat_generation.follow(event_index)
+        ]
+        await chat_generations.stop()
+        return first_event_ids, resumed_chunks
+
+    first_event_ids, resumed_chunks = asyncio.run(read_resume_and_read())
+    assert [parse_event_id(event_id)[1] for event_id in first_event_ids] == [0, 1]
+    assert resumed_chunks == ["2", "3", "4"]
+
+
+def test_events_that_fell_out_of_the_buffer_cannot_be_replayed() -> None:
+    async def generate_then_read() -> None:
+        chat_generations = ChatGenerations(max_buffered_events=2)
+        chat_generation = chat_generations.start(1, 1, generate_chunks(5))
+        await chat_generations.stop()
+        assert chat_generation.is_buffered(2)
+        assert not chat_generation.is_buffered(1)
+        with pytest.raises(EventsNoLongerBufferedError):
+            async for _ in chat_generation.follow():
+                pass
+
+    asyncio.run(generate_then_read())
+
+
+def test_readers_of_a_full_buffer_get_the_events_appended_while_they_wait() -> None:
+    async def read_while_appending() -> tuple[list[str], list[str]]:
+        chat_generation = ChatGeneration(1, 1, max_buffered_events=3)
+        for chunk_index in range(3):
+            chat_generation.append(LlmStreamingChunk(chat_id=1, chunk=str(chunk_index)))
+        events = chat_generation.follow()
+        read_events = [await anext(events)]
+        # the buffer shifts while the reader is suspended
+        chat_generation.append(LlmStreamingChunk(chat_id=1, chunk="3"))
+        chat_generation.finish()
+        read_events += [event async for event in events]
+        return (
+            [event_id.split(":")[1] for event_id, _ in read_events],
+            [
+                LlmStreamingChunk.model_validate_json(serialized_event).chunk
+                for _, serialized_event in read_events
+            ],
+        )
+
+    assert asyncio.run(read_while_appending()) == (
+        ["0", "1", "2", "3"],
+        ["0", "1", "2", "3"],
+    )
+
+
+def test_readers_that_fall_out_of_a_full_buffer_while_waiting_are_told() -> None:
+    async def read_while_appending() -> None:
+        chat_generation = ChatGeneration(1, 1, max_buffered_events=3)
+        for chunk_index in range(3):
+            chat_generation.append(LlmStreamingChunk(chat_id=1, chunk=str(chunk_index)))
+        events = chat_generation.follow()
+        await anext(events)
+        # event 1 is dropped before the reader gets to it
+        for chunk_index in range(3, 5):
+            chat_generation.append(LlmStreamingChunk(chat_id=1, chunk=str(chunk_index)))
+        with pytest.raises(EventsNoLongerBufferedError):
+            await anext(events)
+
+    asyncio.run(read_while_appending())
+
+
+def test_subscribers_get_every_generation_of_the_chat() -> None:
+    async def subscribe_and_generate() -> tuple[list[str], list[str]]:
+        chat_generations = ChatGenerations()
+        subscriber_chunks: tuple[list[str], list[str]] = ([], [])
+
+        async def subscribe(chunks: list[str]) -> None:
+            async for _, serialized_event in chat_generations.subscribe(chat_id=1):
+                chunks.append(
+                    LlmStreamingChunk.model_validate_json(serialized_event).chunk
+                )
+                if len(chunks) == 5:
+                    return
+
+        subscriptions = [
+            asyncio.create_task(subscribe(chunks)) for chunks in subscriber_chunks
+        ]
+        await asyncio.sleep(0.01)
+        chat_generations.start(1, 1, generate_chunks(3))
+        # not a generation of the chat subscribed to
+        chat_generations.start(2, 1, generate_chunks(3))
+        await asyncio.sleep(0.05)
+        chat_generations.start(1, 1, generate_chunks(2))
+        await asyncio.wait_for(asyncio.gather(*subscriptions), timeout=1)
+        await chat_generations.stop()
+        return subscriber_chunks
+
+    assert asyncio.run(subscribe_and_generate()) == (
+        ["0", "1", "2", "0", "1"],
+        ["0", "1", "2", "0", "1"],
+    )
+
+
+def test_subscribers_that_fall_behind_are_dropped() -> None:
+    async def subscribe_slowly() -> None:
+        chat_generations = ChatGenerations(max_queued_generations_per_subscriber=1)
+        subscription = chat_generations.subscribe(chat_id=1)
+        first_event = asyncio.ensure_future(anext(subscription))
+        await asyncio.sleep(0.01)
+        for _ in range(3):
+            chat_generations.start(1, 1, generate_chunks(1))
+        await chat_generations.stop()
+        await first_event
+        with pytest.raises(EventsNoLongerBufferedError):
+            async for _ in subscription:
+                pass
+
+    asyncio.run(subscribe_slowly())
@@ -0,0 +1,266 @@
+import asyncio
+import datetime
+import importlib
+import json
+import uuid
+
+import pytest
+from api.chat_generation import ChatGeneration
+from api.chat_websocket import ChatStreamRequest, _stream_chat, chat_websocket_router
+from api.chats import (
+    CreateNewChatRequestBody,
+    LlmStreamingChunk,
+    LlmStreamingEnd,
+    LlmStreamingStart,
+)
+from api.session_management import SessionInDb
+from api.user_management import NonAdminUser
+from fastapi import FastAPI, HTTPException, WebSocketDisconnect, status
+from fastapi.requests import HTTPConnection
+from fastapi.testclient import TestClient
+from k4.llm_provider_management import K4LlmProvider
+
+from k4 import ChatMessage
+
+# the package re-exports a router, not the module
+chat_websocket_module = importlib.import_module("api.chat_websocket")
+
+
+def test_unexpected_failures_end_the_request_with_an_error_frame(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    async def check_chat_rate_limit(user_id: int, endpoint: str) -> None:
+        raise ConnectionError("the database went away")
+
+    monkeypatch.setattr(
+        chat_websocket_module, "check_chat_rate_limit", check_chat_rate_limit
+    )
+    sent_frames: list[tuple[str | None, str]] = []
+
+    async def send_frame(event_id: str | None, serialized_event: str) -> None:
+        sent_frames.append((event_id, serialized_event))
+
+    asyncio.run(
+        _stream_chat(
+            ChatStreamRequest(
+                request_id="1",
+                message="hello",
+                llm_provider=K4LlmProvider.OPENAI,
+                llm_model_name="gpt-4o",
+            ),
+            user_id=1,
+            send_frame=send_frame,
+        )
+    )
+    [(event_id, serialized_event)] = sent_frames
+    assert event_id is None
+    assert json.loads(serialized_event) == {
+        "chunk_type": "error",
+        "status_code": 500,
+        "detail": "Unexpectedly failed to get a response.",
+    }
+
+
+class FakeSessions:
+    """
+    One session, which is active as long as `is_active`
+    """
+
+    def __init__(self, expires_in: datetime.timedelta) -> None:
+        now = datetime.datetime.now(datetime.UTC)
+        self.session = SessionInDb(
+            session_id=uuid.uuid4(),
+            user_id=1,
+            created_at=now,
+            last_seen_at=now,
+            expires_at=now + expires_in,
+            user_agent="test",
+            ip_address="127.0.0.1",
+            is_active=True,
+        )
+        self.num_lookups = 0
+
+    async def get_unexpired_session(self, session_id: uuid.UUID) -> SessionInDb:
+        self.num_lookups += 1
+        if (
+            not self.session.is_active
+            or self.session.expires_at <= datetime.datetime.now(datetime.UTC)
+        ):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED, detail="Not logged in."
+            )
+        return self.session
+
+    async def get_current_session(self, request: HTTPConnection) -> SessionInDb:
+        return await self.get_unexpired_session(self.session.session_id)
+
+
+async def get_user_by_user_id(user_id: int) -> NonAdminUser:
+    return NonAdminUser.model_validate(
+        {
+            "user_id": user_id,
+            "user_email": "u@example.com",
+            "hashed_user_password": "hashed",
+            "human_name": "Human",
+            "ai_name": "K4",
+            "is_user_email_verified": True,
+            "is_user_deactivated": False,
+        }
+    )
+
+
+def _make_client(
+    monkeypatch: pytest.MonkeyPatch,
+    fake_sessions: FakeSessions,
+    session_recheck_interval_seconds: float = 60.0,
+) -> TestClient:
+    """
+    A client of just the route, whose responses are always "Hello"
+    """
+
+    async def check_chat_rate_limit(user_id: int, endpoint: str) -> None:
+        pass
+
+    async def wait_until_k4_is_warmed_up() -> None:
+        pass
+
+    async def create_chat_and_get_complete_chat_for_llm(
+        create_new_chat_request_body: CreateNewChatRequestBody, user_id: int
+    ) -> tuple[int, list[ChatMessage]]:
+        return 7, []
+
+    async def start_k4_response(
+        user_id: int,
+        chat_id: int,
+        complete_chat: list[ChatMessage],
+        create_new_chat_request_body: CreateNewChatRequestBody,
+    ) -> ChatGeneration:
+        chat_generation = ChatGeneration(chat_id, user_id)
+        chat_generation.append(LlmStreamingStart(chat_id=chat_id))
+        chat_generation.append(LlmStreamingChunk(chat_id=chat_id, chunk="Hello"))
+        chat_generation.append(LlmStreamingEnd(chat_id=chat_id))
+        chat_generation.finish()
+        return chat_generation
+
+    for name, fake in [
+        ("get_current_session", fake_sessions.get_current_session),
+        ("check_chat_rate_limit", check_chat_rate_limit),
+        ("wait_until_k4_is_warmed_up", wait_until_k4_is_warmed_up),
+        (
+            "create_chat_and_get_complete_chat_for_llm",
+            create_chat_and_get_complete_chat_for_llm,
+        ),
+        ("start_k4_response", start_k4_response),
+        ("SESSION_RECHECK_INTERVAL_SECONDS", session_recheck_interval_seconds),
+    ]:
+        monkeypatch.setattr(chat_websocket_module, name, fake)
+    monkeypatch.setattr(
+        chat_websocket_module.users_manager, "get_user_by_user_id", get_user_by_user_id
+    )
+    monkeypatch.setattr(
+        chat_websocket_module.sessions_manager,
+        "get_unexpired_session",
+        fake_sessions.get_unexpired_session,
+    )
+    app = FastAPI()
+    app.include_router(chat_websocket_router)
+    return TestClient(app)
+
+
+_REQUEST = {
+    "message": "hello",
+    "llm_provider": K4LlmProvider.OPENAI.value,
+    "llm_model_name": "gpt-4o",
+}
+
+
+def test_each_request_gets_its_frames(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = _make_client(monkeypatch, FakeSessions(datetime.timedelta(days=1)))
+    with client.websocket_connect("/chat_stream") as websocket:
+        websocket.send_text(json.dumps({**_REQUEST, "request_id": "a"}))
+        frames = [json.loads(websocket.receive_text()) for _ in range(3)]
+    assert [frame["request_id"] for frame in frames] == ["a", "a", "a"]
+    assert [frame["event_id"].split(":")[1] for frame in frames] == ["0", "1", "2"]
+    assert [frame["frame"] for frame in frames] == [
+        {"chat_id": 7, "chunk_type": "msg_start"},
+        {"chat_id": 7, "chunk_type": "text", "chunk": "Hello"},
+        {"chat_id": 7, "chunk_type": "msg_end"},
+    ]
+
+
+def test_invalid_requests_get_an_error_frame(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = _make_client(monkeypatch, FakeSessions(datetime.timedelta(days=1)))
+    with client.websocket_connect("/chat_stream") as websocket:
+        websocket.send_text(json.dumps({"request_id": "a"}))
+        frame = json.loads(websocket.receive_text())
+        assert frame["request_id"] is None
+        assert frame["frame"]["status_code"] == 422
+        # the connection is still usable
+        websocket.send_text(json.dumps({**_REQUEST, "request_id": "b"}))
+        assert json.loads(websocket.receive_text())["request_id"] == "b"
+
+
+def test_connecting_without_a_session_is_refused(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    fake_sessions = FakeSessions(datetime.timedelta(days=1))
+    fake_sessions.session.is_active = False
+    client = _make_client(monkeypatch, fake_sessions)
+    with pytest.raises(WebSocketDisconnect) as disconnect:
+        with client.websocket_connect("/chat_stream"):
+            pass
+    assert disconnect.value.code == status.WS_1008_POLICY_VIOLATION
+
+
+def test_the_session_is_only_looked_up_again_once_the_interval_passes(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    fake_sessions = FakeSessions(datetime.timedelta(days=1))
+    client = _make_client(monkeypatch, fake_sessions)
+    with client.websocket_connect("/chat_stream") as websocket:
+        for request_id in ["a", "b", "c"]:
+            websocket.send_text(json.dumps({**_REQUEST, "request_id": request_id}))
+            for _ in range(3):
+                websocket.receive_text()
+    # only when connecting
+    assert fake_sessions.num_lookups == 1
+
+
+def test_the_connection_is_closed_once_the_session_ends(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    fake_sessions = FakeSessions(datetime.timedelta(days=1))
+    client = _make_client(
+        monkeypatch, fake_sessions, session_recheck_interval_seconds=0.0
+    )
+    with client.websocket_connect("/chat_stream") as websocket:
+        websocket.send_text(json.dumps({**_REQUEST, "request_id": "a"}))
+        for _ in range(3):
+            websocket.receive_text()
+        # e.g. the user logged out elsewhere
+        fake_sessions.session.is_active = False
+        websocket.send_text(json.dumps({**_REQUEST, "request_id": "b"}))
+        with pytest.raises(WebSocketDisconnect) as disconnect:
+            websocket.receive_text()
+    assert disconnect.value.code == status.WS_1008_POLICY_VIOLATION
+    assert disconnect.value.reason == "Not logged in."
+
+
+def test_the_connection_is_closed_once_the_session_expires(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    fake_sessions = FakeSessions(datetime.timedelta(days=1))
+    client = _make_client(monkeypatch, fake_sessions)
+    with client.websocket_connect("/chat_stream") as websocket:
+        websocket.send_text(json.dumps({**_REQUEST, "request_id": "a"}))
+        for _ in range(3):
+            websocket.receive_text()
+        # well within the recheck interval, but past `expires_at`
+        fake_sessions.session.expires_at = datetime.datetime.now(
+            datetime.UTC
+        ) - datetime.timedelta(seconds=1)
+        websocket.send_text(json.dumps({**_REQUEST, "request_id": "b"}))
+        with pytest.raises(WebSocketDisconnect) as disconnect:
+            websocket.receive_text()
+    assert disconnect.value.code == status.WS_1008_POLICY_VIOLATION
+    assert fake_sessions.num_lookups == 2
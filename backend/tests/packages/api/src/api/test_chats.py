@@ -0,0 +1,150 @@
+import asyncio
+import datetime
+import importlib
+from typing import Any, AsyncGenerator
+
+import pytest
+from api.chats import (
+    CreateNewChatRequestBody,
+    LlmStreamingChunk,
+    LlmStreamingEnd,
+    LlmStreamingStart,
+    create_chat_and_get_complete_chat_for_llm,
+    generate_k4_response,
+    get_complete_chat_for_llm_of_existing_chat,
+)
+from api.message_management import ChatInDb
+from backend_commons.messages import MessageInDb
+from fastapi import HTTPException
+from k4.llm_provider_management import K4LlmProvider
+from pydantic import BaseModel
+
+from k4 import ChatMessage, LlmUsage
+
+# the package re-exports routers, not the module
+chats_module = importlib.import_module("api.chats")
+
+_REQUEST_BODY = CreateNewChatRequestBody(
+    message="hello", llm_provider=K4LlmProvider.OPENAI, llm_model_name="gpt-4o"
+)
+
+
+def _make_message(message_id: int, user_id: int | None, text: str) -> MessageInDb:
+    return MessageInDb(
+        message_id=message_id,
+        chat_id=7,
+        user_id=user_id,
+        text=text,
+        inserted_at=datetime.datetime.now(datetime.UTC),
+    )
+
+
+class FakeK4:
+    def __init__(self, will_ask_succeed: bool = True) -> None:
+        self.will_ask_succeed = will_ask_succeed
+
+    def will_ask_succeed_with_detail(self, **kwargs: Any) -> tuple[bool, str]:
+        return self.will_ask_succeed, "" if self.will_ask_succeed else "Too long."
+
+    async def ask_stream(
+        self, usage: LlmUsage, **kwargs: Any
+    ) -> AsyncGenerator[str | None, None]:
+        yield "Hel"
+        yield "lo"
+        usage.model = "gpt-4o"
+        usage.completion_tokens = 2
+        yield None
+
+
+def test_generate_k4_response_saves_the_whole_response(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(chats_module, "get_k4", FakeK4)
+    saved_texts: list[str] = []
+    recorded_usages: list[tuple[int, int, LlmUsage]] = []
+
+    async def save_k4_message_to_db(chat_id: int, text: str) -> MessageInDb:
+        saved_texts.append(text)
+        return _make_message(2, None, text)
+
+    def record_usage(message_id: int, user_id: int, llm_usage: LlmUsage) -> None:
+        recorded_usages.append((message_id, user_id, llm_usage))
+
+    monkeypatch.setattr(
+        chats_module.messages_manager, "save_k4_message_to_db", save_k4_message_to_db
+    )
+    monkeypatch.setattr(chats_module.usage_manager, "record_usage", record_usage)
+    user_message = _make_message(1, 1, "hello")
+
+    async def collect_events() -> list[BaseModel]:
+        return [
+            event
+            async for event in generate_k4_response(
+                user_id=1,
+                chat_id=7,
+                user_message=user_message,
+                complete_chat=[],
+                llm_model_name="gpt-4o",
+                fallback_llm_model_names=[],
+                hedge_after_seconds=None,
+            )
+        ]
+
+    assert asyncio.run(collect_events()) == [
+        user_message,
+        LlmStreamingStart(chat_id=7),
+        LlmStreamingChunk(chat_id=7, chunk="Hel"),
+        LlmStreamingChunk(chat_id=7, chunk="lo"),
+        LlmStreamingEnd(chat_id=7),
+    ]
+    assert saved_texts == ["Hello"]
+    [(message_id, user_id, llm_usage)] = recorded_usages
+    assert (message_id, user_id) == (2, 1)
+    assert llm_usage.completion_tokens == 2
+
+
+def test_chats_are_not_created_for_requests_that_would_fail(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(chats_module, "get_k4", lambda: FakeK4(will_ask_succeed=False))
+
+    async def get_complete_chat_for_llm(**kwargs: Any) -> list[ChatMessage]:
+        return [{"role": "user", "content": "hello"}]
+
+    async def create_new_chat(user_id: int, title: str) -> ChatInDb:
+        raise AssertionError("the chat shouldn't be created")
+
+    monkeypatch.setattr(
+        chats_module, "get_complete_chat_for_llm", get_complete_chat_for_llm
+    )
+    monkeypatch.setattr(
+        chats_module.messages_manager, "create_new_chat", create_new_chat
+    )
+    with pytest.raises(HTTPException) as exception:
+        asyncio.run(create_chat_and_get_complete_chat_for_llm(_REQUEST_BODY, 1))
+    assert exception.value.status_code == 400
+    assert exception.value.detail == "Too long."
+
+
+def test_other_users_chats_cannot_be_continued(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    async def get_chat_in_db(chat_id: int) -> ChatInDb:
+        return ChatInDb(
+            chat_id=chat_id,
+            user_id=2,
+            title="",
+            is_archived=False,
+            last_message_timestamp=datetime.datetime.now(datetime.UTC),
+        )
+
+    async def get_complete_chat_for_llm(**kwargs: Any) -> list[ChatMessage]:
+        raise AssertionError("another user's messages shouldn't be loaded")
+
+    monkeypatch.setattr(chats_module.messages_manager, "get_chat_in_db", get_chat_in_db)
+    monkeypatch.setattr(
+        chats_module, "get_complete_chat_for_llm", get_complete_chat_for_llm
+    )
+    with pytest.raises(HTTPException) as exception:
+        asyncio.run(get_complete_chat_for_llm_of_existing_chat(7, _REQUEST_BODY, 1))
+    assert exception.value.status_code == 403
@@ -0,0 +1,12 @@
+from api.conditional_requests import does_etag_match, make_etag
+
+
+def test_etags_are_compared_weakly() -> None:
+    etag = make_etag("user_id=1|1,2024-01-01T00:00:00+00:00,3")
+    assert etag.startswith('W/"')
+    assert does_etag_match(etag, etag)
+    assert does_etag_match(etag.removeprefix("W/"), etag)
+    assert does_etag_match(f'"something else", {etag}', etag)
+    assert does_etag_match("*", etag)
+    assert not does_etag_match(None, etag)
+    assert not does_etag_match(make_etag("user_id=2"), etag)
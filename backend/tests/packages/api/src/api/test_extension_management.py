@@ -1,4 +1,23 @@
-from api.extension_management import is_valid_git_repo_url
+import asyncio
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from api.extension_management import (
+    ExtensionExecutionMode,
+    ExtensionInDb,
+    ExtensionMetadata,
+    ExtensionsManager,
+    GitUrl,
+    is_valid_git_repo_url,
+)
+from backend_commons.messages import MessageInDb
+from extensibles import (
+    GetCompleteChatDefaultImplementation,
+    ParamsForAlreadyExistingChat,
+    get_complete_chat_for_llm,
+    plugin_manager,
+)
 
 
 def test_is_valid_git_repo_url() -> None:
@@ -35,3 +54,94 @@ def test_is_valid_git_repo_url() -> None:
         assert is_valid_git_repo_url(git_repo)
 
     assert not is_valid_git_repo_url("")
+
+
+EXTENSION_CODE = """
+from extensibles import hookimpl
+
+VERSION = "{version}"
+
+
+class Extension:
+    @staticmethod
+    @hookimpl
+    async def get_complete_chat_for_llm(new_message_from_user, existing_chat_params):
+        if existing_chat_params is not None:
+            await existing_chat_params.get_messages_of_chat(existing_chat_params.chat_id)
+        return [{{"role": "user", "content": f"{{VERSION}} {{new_message_from_user}}"}}]
+"""
+
+
+@pytest.fixture
+def extensions_manager() -> Iterator[ExtensionsManager]:
+    plugin_manager.register(
+        GetCompleteChatDefaultImplementation(), name="get_complete_chat_for_llm"
+    )
+    yield ExtensionsManager()
+    plugin_manager.unregister(name="get_complete_chat_for_llm")
+
+
+def test_a_call_in_flight_during_a_reload_finishes_on_the_old_code(
+    extensions_manager: ExtensionsManager,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    extension_path = tmp_path / "get_complete_chat_for_llm.py"
+    extension_path.write_text(EXTENSION_CODE.format(version="old"))
+    extension_in_db = ExtensionInDb.model_validate(
+        {
+            "extension_id": 1,
+            "name": "https://example.com/extension.git",
+            "local_path": extension_path,
+            "metadata": ExtensionMetadata(
+                installed_version="0.0.1",
+                git_repo_url=GitUrl("https://example.com/extension.git"),
+            ).model_dump_json(),
+        }
+    )
+
+    async def get_latest_installed_extension() -> ExtensionInDb:
+        return extension_in_db
+
+    monkeypatch.setattr(
+        extensions_manager,
+        "_get_latest_installed_extension",
+        get_latest_installed_extension,
+    )
+
+    async def call_reload_and_call_again() -> tuple[str, str]:
+        extensions_manager._activate_plugin(
+            await extensions_manager._load_plugin(
+                extension_path, ExtensionExecutionMode.IN_PROCESS
+            ),
+            extension_in_db.extension_id,
+        )
+        call_started = asyncio.Event()
+        may_finish_call = asyncio.Event()
+
+        async def get_messages_of_chat(
+            chat_id: int, limit: int | None = None
+        ) -> list[MessageInDb]:
+            call_started.set()
+            await may_finish_call.wait()
+            return []
+
+        call_in_flight = asyncio.create_task(
+            get_complete_chat_for_llm(
+                "hello",
+                ParamsForAlreadyExistingChat(
+                    chat_id=1, get_messages_of_chat=get_messages_of_chat
+                ),
+            )
+        )
+        await call_started.wait()
+
+        extension_path.write_text(EXTENSION_CODE.format(version="new"))
+        await extensions_manager.reload_extension(extension_in_db.extension_id)
+        may_finish_call.set()
+
+        [old_message] = await call_in_flight
+        [new_message] = await get_complete_chat_for_llm("hello", None)
+        return old_message["content"], new_message["content"]
+
+    assert asyncio.run(call_reload_and_call_again()) == ("old hello", "new hello")
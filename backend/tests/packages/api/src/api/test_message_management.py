@@ -0,0 +1,96 @@
+import asyncio
+import datetime
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator
+
+from api.message_management import MessagesManager, NewMessage
+
+
+class FakeConnection:
+    """
+    Answers the batched insert like Postgres may: in no particular order
+    """
+
+    def __init__(self) -> None:
+        self.num_batches = 0
+
+    async def fetch(
+        self,
+        query: str,
+        chat_ids: list[int],
+        user_ids: list[int | None],
+        texts: list[str],
+    ) -> list[dict[str, Any]]:
+        self.num_batches += 1
+        rows = [
+            {
+                "message_id": 100 + position,
+                "chat_id": chat_id,
+                "user_id": user_id,
+                "text": text,
+                "inserted_at": datetime.datetime.now(datetime.UTC),
+                "position": position,
+            }
+            for position, (chat_id, user_id, text) in enumerate(
+                zip(chat_ids, user_ids, texts), start=1
+            )
+        ]
+        return rows[::-1]
+
+
+class FakeConnectionPool:
+    def __init__(self, connection: FakeConnection) -> None:
+        self.connection = connection
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncGenerator[FakeConnection, None]:
+        yield self.connection
+
+
+def test_batched_saves_get_their_own_messages_back() -> None:
+    fake_connection = FakeConnection()
+    messages_manager = MessagesManager()
+    messages_manager.postgres_connection_pool = FakeConnectionPool(  # type: ignore[assignment]
+        fake_connection
+    )
+
+    async def save_concurrently() -> list[str]:
+        messages_manager.message_writer.start()
+        try:
+            saved_messages = await asyncio.gather(
+                *(
+                    messages_manager.save_client_message_to_db(
+                        chat_id=1, user_id=2, text=f"message {message_index}"
+                    )
+                    for message_index in range(5)
+                )
+            )
+        finally:
+            await messages_manager.message_writer.stop()
+        return [saved_message.text for saved_message in saved_messages]
+
+    assert asyncio.run(save_concurrently()) == [
+        f"message {message_index}" for message_index in range(5)
+    ]
+    assert fake_connection.num_batches == 1
+
+
+def test_messages_saved_in_one_batch_keep_their_order() -> None:
+    fake_connection = FakeConnection()
+    messages_manager = MessagesManager()
+    messages_manager.postgres_connection_pool = FakeConnectionPool(  # type: ignore[assignment]
+        fake_connection
+    )
+    saved_messages = asyncio.run(
+        messages_manager._save_messages_to_db(
+            [
+                NewMessage(chat_id=1, user_id=2, text="question"),
+                NewMessage(chat_id=1, user_id=None, text="answer"),
+            ]
+        )
+    )
+    assert [saved_message.text for saved_message in saved_messages] == [
+        "question",
+        "answer",
+    ]
+    assert saved_messages[0].message_id < saved_messages[1].message_id
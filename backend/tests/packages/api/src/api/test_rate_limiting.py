@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+from api import rate_limiting
+from api.rate_limiting import RateLimitsManager
+
+
+def test_requests_are_limited_per_key() -> None:
+    rate_limits_manager = RateLimitsManager(
+        requests_per_minute=2, use_shared_buckets=False
+    )
+
+    async def send_requests() -> list[float]:
+        return [
+            await rate_limits_manager.try_consume(key)
+            for key in ["1 POST /message"] * 3 + ["2 POST /message"]
+        ]
+
+    first, second, third, other_user = asyncio.run(send_requests())
+    assert first == second == other_user == 0
+    # refilled at 2 per minute
+    assert 0 < third <= 30
+
+
+def test_no_limit() -> None:
+    rate_limits_manager = RateLimitsManager(
+        requests_per_minute=None, use_shared_buckets=True
+    )
+    assert asyncio.run(rate_limits_manager.try_consume("1 POST /message")) == 0
+
+
+def test_requests_turned_away_by_the_shared_bucket_are_refunded(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    rate_limits_manager = RateLimitsManager(
+        requests_per_minute=2, use_shared_buckets=True
+    )
+    shared_retry_after_seconds = [30.0, 30.0, 0.0]
+
+    async def try_consume_shared(key: str, requests_per_minute: float) -> float:
+        return shared_retry_after_seconds.pop(0)
+
+    monkeypatch.setattr(rate_limits_manager, "_try_consume_shared", try_consume_shared)
+
+    async def send_requests() -> list[float]:
+        return [
+            await rate_limits_manager.try_consume("1 POST /message") for _ in range(3)
+        ]
+
+    # the worker's bucket only holds 2, but the 2 requests turned away didn't use it up
+    assert asyncio.run(send_requests()) == [30.0, 30.0, 0.0]
+
+
+def test_full_buckets_are_forgotten(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(rate_limiting, "MIN_NUM_BUCKETS_BEFORE_FORGETTING", 4)
+    rate_limits_manager = RateLimitsManager(
+        requests_per_minute=60, use_shared_buckets=False
+    )
+
+    async def send_requests() -> None:
+        for user_id in range(4):
+            await rate_limits_manager.try_consume(f"{user_id} POST /message")
+        # refilled
+        await asyncio.sleep(1.1)
+        await rate_limits_manager.try_consume("0 POST /message")
+        await rate_limits_manager.try_consume("4 POST /message")
+
+    asyncio.run(send_requests())
+    assert set(rate_limits_manager._token_bucket_by_key) == {
+        "0 POST /message",
+        "4 POST /message",
+    }
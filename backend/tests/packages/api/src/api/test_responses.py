@@ -0,0 +1,22 @@
+import datetime
+import json
+
+from api.message_management import ChatInDb
+from api.responses import PydanticJSONResponse
+
+
+def test_pydantic_json_response() -> None:
+    chats_in_db = [
+        ChatInDb(
+            chat_id=1,
+            user_id=1,
+            title="a chat",
+            last_message_timestamp=datetime.datetime(2025, 1, 1, tzinfo=datetime.UTC),
+            is_archived=False,
+        )
+    ]
+    response = PydanticJSONResponse(chats_in_db)
+    assert response.media_type == "application/json"
+    assert json.loads(bytes(response.body)) == [
+        json.loads(chat_in_db.model_dump_json()) for chat_in_db in chats_in_db
+    ]
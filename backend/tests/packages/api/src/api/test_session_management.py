@@ -0,0 +1,78 @@
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator
+
+import asyncpg  # type: ignore[import-untyped,unused-ignore]
+import pytest
+from api.session_management import SessionsManager
+
+
+class FakeConnection:
+    def __init__(self, is_failing: bool = False) -> None:
+        self.is_failing = is_failing
+        self.executed: list[tuple[str, tuple[Any, ...]]] = []
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncGenerator[None, None]:
+        yield
+
+    async def execute(self, query: str, *args: Any) -> str:
+        if self.is_failing:
+            raise asyncpg.PostgresConnectionError("connection was closed")
+        self.executed.append((query, args))
+        return f"UPDATE {len(args[0])}"
+
+
+class FakeConnectionPool:
+    def __init__(self, connection: FakeConnection) -> None:
+        self.connection = connection
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncGenerator[FakeConnection, None]:
+        yield self.connection
+
+
+def make_sessions_manager(connection: FakeConnection) -> SessionsManager:
+    sessions_manager = SessionsManager()
+    sessions_manager.postgres_connection_pool = FakeConnectionPool(  # type: ignore[assignment]
+        connection
+    )
+    return sessions_manager
+
+
+def test_last_seen_at_is_flushed_in_one_update() -> None:
+    connection = FakeConnection()
+    sessions_manager = make_sessions_manager(connection)
+    session_ids = [uuid.uuid4(), uuid.uuid4()]
+    for session_id in [*session_ids, session_ids[0]]:
+        sessions_manager.record_session_seen(session_id)
+    last_seen_ats = [
+        sessions_manager._last_seen_at_by_session_id[session_id]
+        for session_id in session_ids
+    ]
+
+    asyncio.run(sessions_manager.flush_last_seen_at())
+    [(query, (flushed_session_ids, flushed_last_seen_ats, *_))] = connection.executed
+    assert "UPDATE sessions" in query
+    assert "FROM unnest(" in query
+    assert flushed_session_ids == session_ids
+    assert flushed_last_seen_ats == last_seen_ats
+    assert sessions_manager._last_seen_at_by_session_id == {}
+
+    # nothing new to flush
+    asyncio.run(sessions_manager.flush_last_seen_at())
+    assert len(connection.executed) == 1
+
+
+def test_last_seen_at_is_coalesced_and_kept_when_the_flush_fails() -> None:
+    sessions_manager = make_sessions_manager(FakeConnection(is_failing=True))
+    session_id = uuid.uuid4()
+    sessions_manager.record_session_seen(session_id)
+    sessions_manager.record_session_seen(session_id)
+    last_seen_at = sessions_manager._last_seen_at_by_session_id[session_id]
+    assert len(sessions_manager._last_seen_at_by_session_id) == 1
+
+    with pytest.raises(asyncpg.PostgresConnectionError):
+        asyncio.run(sessions_manager.flush_last_seen_at())
+    assert sessions_manager._last_seen_at_by_session_id == {session_id: last_seen_at}
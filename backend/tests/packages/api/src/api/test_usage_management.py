@@ -0,0 +1,155 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator
+
+import asyncpg  # type: ignore[import-untyped,unused-ignore]
+from api.usage_management import UsageManager, UserUsage
+
+from k4 import LlmUsage
+
+
+class FakeConnection:
+    def __init__(
+        self,
+        fetched_rows: list[dict[str, Any]] | None = None,
+        deleted_message_ids: set[int] | None = None,
+    ) -> None:
+        self.fetched_rows = fetched_rows or []
+        self.deleted_message_ids = deleted_message_ids or set()
+        self.executed: list[tuple[str, list[tuple[Any, ...]]]] = []
+        """
+        Only what was committed
+        """
+        self.num_transactions = 0
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncGenerator[None, None]:
+        self.num_transactions += 1
+        num_executed_before = len(self.executed)
+        try:
+            yield
+        except BaseException:
+            del self.executed[num_executed_before:]
+            raise
+
+    async def executemany(self, query: str, args: list[tuple[Any, ...]]) -> None:
+        if query.startswith("INSERT INTO llm_usage ") and any(
+            message_id in self.deleted_message_ids for message_id, *_ in args
+        ):
+            raise asyncpg.ForeignKeyViolationError(
+                'insert or update on table "llm_usage" violates foreign key constraint'
+            )
+        self.executed.append((query, args))
+
+    async def fetch(self, query: str) -> list[dict[str, Any]]:
+        return self.fetched_rows
+
+
+class FakeConnectionPool:
+    def __init__(self, connection: FakeConnection) -> None:
+        self.connection = connection
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncGenerator[FakeConnection, None]:
+        yield self.connection
+
+
+def make_usage_manager(connection: FakeConnection) -> UsageManager:
+    usage_manager = UsageManager()
+    usage_manager.postgres_connection_pool = FakeConnectionPool(  # type: ignore[assignment]
+        connection
+    )
+    return usage_manager
+
+
+def test_usage_is_written_with_its_rollups_in_one_transaction() -> None:
+    connection = FakeConnection()
+    usage_manager = make_usage_manager(connection)
+
+    async def record_usage() -> None:
+        usage_manager.usage_writer.start()
+        for message_id, user_id, model in [
+            (1, 2, "gpt-4o"),
+            (2, 1, "claude-sonnet-4"),
+            (3, 2, "gpt-4o"),
+        ]:
+            usage_manager.record_usage(
+                message_id=message_id,
+                user_id=user_id,
+                llm_usage=LlmUsage(
+                    model=model,
+                    prompt_tokens=100,
+                    completion_tokens=10,
+                    estimated_cost_usd=0.5,
+                ),
+            )
+        await usage_manager.usage_writer.stop()
+
+    asyncio.run(record_usage())
+    assert connection.num_transactions == 1
+    [(_, usage_rows), (_, rollup_rows)] = connection.executed
+    assert [usage_row[:3] for usage_row in usage_rows] == [
+        (1, 2, "gpt-4o"),
+        (2, 1, "claude-sonnet-4"),
+        (3, 2, "gpt-4o"),
+    ]
+    # one upsert per user and model, in a consistent order
+    assert rollup_rows == [
+        (1, "claude-sonnet-4", 1, 100, 10, 0.5),
+        (2, "gpt-4o", 2, 200, 20, 1.0),
+    ]
+
+
+def test_usage_of_deleted_messages_doesnt_lose_the_rest_of_the_batch() -> None:
+    connection = FakeConnection(deleted_message_ids={2})
+    usage_manager = make_usage_manager(connection)
+
+    async def record_usage() -> None:
+        usage_manager.usage_writer.start()
+        for message_id in [1, 2, 3]:
+            usage_manager.record_usage(
+                message_id=message_id,
+                user_id=message_id,
+                llm_usage=LlmUsage(model="gpt-4o", prompt_tokens=100),
+            )
+        await usage_manager.usage_writer.stop()
+
+    asyncio.run(record_usage())
+    written_usage_rows = [
+        usage_row[:2]
+        for query, rows in connection.executed
+        if query.startswith("INSERT INTO llm_usage ")
+        for usage_row in rows
+    ]
+    written_rollup_rows = [
+        rollup_row[:3]
+        for query, rows in connection.executed
+        if "llm_usage_rollups" in query
+        for rollup_row in rows
+    ]
+    assert written_usage_rows == [(1, 1), (3, 3)]
+    assert written_rollup_rows == [(1, "gpt-4o", 1), (3, "gpt-4o", 1)]
+
+
+def test_usage_by_user() -> None:
+    connection = FakeConnection(
+        fetched_rows=[
+            {
+                "user_id": 2,
+                "num_messages": 2,
+                "prompt_tokens": 200,
+                "completion_tokens": 20,
+                "estimated_cost_usd": 1.0,
+            }
+        ]
+    )
+    usage_manager = make_usage_manager(connection)
+    assert asyncio.run(usage_manager.get_usage_by_user()) == [
+        UserUsage(
+            user_id=2,
+            num_messages=2,
+            prompt_tokens=200,
+            completion_tokens=20,
+            estimated_cost_usd=1.0,
+        )
+    ]
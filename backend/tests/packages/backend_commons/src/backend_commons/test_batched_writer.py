@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from backend_commons import BatchedWriter
+
+
+def test_concurrent_writes_are_batched() -> None:
+    written_batches: list[list[int]] = []
+
+    async def write_batch(items: list[int]) -> list[int]:
+        written_batches.append(items)
+        await asyncio.sleep(0.01)
+        return [item * 10 for item in items]
+
+    async def write_concurrently() -> list[int]:
+        writer = BatchedWriter[int, int]("test", write_batch=write_batch)
+        writer.start()
+        results = await asyncio.gather(*(writer.write(item) for item in range(5)))
+        await writer.stop()
+        return results
+
+    assert asyncio.run(write_concurrently()) == [0, 10, 20, 30, 40]
+    assert written_batches == [[0, 1, 2, 3, 4]]
+
+
+def test_stop_writes_everything_still_queued() -> None:
+    written_items: list[int] = []
+
+    async def write_batch(items: list[int]) -> list[None]:
+        written_items.extend(items)
+        return [None] * len(items)
+
+    async def write_and_stop() -> None:
+        writer = BatchedWriter[int, None]("test", write_batch=write_batch)
+        # queued before the writer is even started
+        for item in range(3):
+            writer.write_nowait(item)
+        writer.start()
+        await writer.stop()
+
+    asyncio.run(write_and_stop())
+    assert written_items == [0, 1, 2]
+
+
+def test_failures_are_raised_to_the_writers() -> None:
+    async def write_batch(items: list[int]) -> list[None]:
+        raise ValueError("oh no")
+
+    async def write() -> None:
+        writer = BatchedWriter[int, None]("test", write_batch=write_batch)
+        writer.start()
+        try:
+            await writer.write(1)
+        finally:
+            await writer.stop()
+
+    with pytest.raises(ValueError):
+        asyncio.run(write())
+
+
+def test_one_failing_item_only_fails_its_own_write() -> None:
+    written_batches: list[list[int]] = []
+
+    async def write_batch(items: list[int]) -> list[int]:
+        await asyncio.sleep(0.01)
+        if 13 in items:
+            # nothing in the batch is written
+            raise ValueError("unlucky")
+        written_batches.append(items)
+        return [item * 10 for item in items]
+
+    async def write_concurrently() -> list[int | BaseException]:
+        writer = BatchedWriter[int, int]("test", write_batch=write_batch)
+        writer.start()
+        results = await asyncio.gather(
+            *(writer.write(item) for item in [1, 13, 2]), return_exceptions=True
+        )
+        await writer.stop()
+        return results
+
+    [first_result, failed_result, last_result] = asyncio.run(write_concurrently())
+    assert (first_result, last_result) == (10, 20)
+    assert isinstance(failed_result, ValueError)
+    assert written_batches == [[1], [2]]
@@ -0,0 +1,18 @@
+import datetime
+from typing import Any
+
+from backend_commons.messages import MessageInDb, messages_in_db_from_rows
+
+
+def test_messages_in_db_from_rows() -> None:
+    rows: list[dict[str, Any]] = [
+        {
+            "message_id": message_id,
+            "chat_id": 1,
+            "user_id": None if message_id % 2 else 1,
+            "text": "hi",
+            "inserted_at": datetime.datetime(2025, 1, 1, tzinfo=datetime.UTC),
+        }
+        for message_id in range(3)
+    ]
+    assert messages_in_db_from_rows(iter(rows)) == [MessageInDb(**row) for row in rows]
@@ -0,0 +1,39 @@
+import asyncio
+
+from backend_commons import PeriodicTask
+
+
+def test_runs_periodically_despite_failures() -> None:
+    num_runs = 0
+
+    async def run_once() -> None:
+        nonlocal num_runs
+        num_runs += 1
+        if num_runs == 1:
+            raise ConnectionError("the first run fails")
+
+    async def run_for_a_while() -> None:
+        periodic_task = PeriodicTask("test", run_once=run_once, interval_seconds=0.01)
+        periodic_task.start()
+        await asyncio.sleep(0.1)
+        await periodic_task.stop()
+        assert not periodic_task.is_running
+
+    asyncio.run(run_for_a_while())
+    assert num_runs > 2
+
+
+def test_stop_can_run_once_more() -> None:
+    num_runs = 0
+
+    async def run_once() -> None:
+        nonlocal num_runs
+        num_runs += 1
+
+    async def start_and_stop() -> None:
+        periodic_task = PeriodicTask("test", run_once=run_once, interval_seconds=60)
+        periodic_task.start()
+        await periodic_task.stop(run_once_more=True)
+
+    asyncio.run(start_and_stop())
+    assert num_runs == 1
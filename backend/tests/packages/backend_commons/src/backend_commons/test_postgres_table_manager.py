@@ -0,0 +1,54 @@
+from typing import Iterable
+
+from backend_commons import IdempotentMigration, PostgresTableManager
+
+
+class FakeManager(PostgresTableManager):
+    def __init__(self, create_table_query: str) -> None:
+        super().__init__()
+        self.create_table_query = create_table_query
+
+    @property
+    def create_table_queries(self) -> Iterable[str]:
+        return [self.create_table_query]
+
+    @property
+    def create_indexes_queries(self) -> Iterable[str]:
+        return ["CREATE INDEX IF NOT EXISTS idx_fakes_name ON fakes(name)"]
+
+    @property
+    def IDEMPOTENT_MIGRATIONS(self) -> list[IdempotentMigration]:
+        return [
+            IdempotentMigration(
+                "add_name", "ALTER TABLE fakes ADD COLUMN IF NOT EXISTS name TEXT"
+            )
+        ]
+
+
+def test_everything_is_pending_on_a_fresh_database() -> None:
+    fake_manager = FakeManager("CREATE TABLE IF NOT EXISTS fakes (fake_id INT)")
+    assert len(fake_manager.get_pending_migrations({})) == 2
+
+
+def test_only_changed_migrations_are_pending() -> None:
+    fake_manager = FakeManager("CREATE TABLE IF NOT EXISTS fakes (fake_id INT)")
+    applied_schema_hashes = {
+        (fake_manager.table_manager_name, idempotent_migration.name): (
+            idempotent_migration.schema_hash
+        )
+        for idempotent_migration in fake_manager.get_pending_migrations({})
+    }
+    assert fake_manager.get_pending_migrations(applied_schema_hashes) == []
+
+    fake_manager.create_table_query = (
+        "CREATE TABLE IF NOT EXISTS fakes (fake_id INT, is_fake BOOLEAN)"
+    )
+    pending_migrations = fake_manager.get_pending_migrations(applied_schema_hashes)
+    assert [
+        idempotent_migration.queries for idempotent_migration in pending_migrations
+    ] == [
+        [
+            "CREATE TABLE IF NOT EXISTS fakes (fake_id INT, is_fake BOOLEAN)",
+            "CREATE INDEX IF NOT EXISTS idx_fakes_name ON fakes(name)",
+        ]
+    ]
@@ -0,0 +1,51 @@
+import importlib
+import sys
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from extensibles.extensibles import unload_external_plugin_modules
+
+
+@pytest.fixture
+def extension_directory(tmp_path: Path) -> Iterator[Path]:
+    extension_directory = tmp_path / "extension"
+    package_directory = extension_directory / "k4_test_extension"
+    package_directory.mkdir(parents=True)
+    (package_directory / "__init__.py").write_text("")
+    (package_directory / "helpers.py").write_text("import json\nVERSION = 1\n")
+    sys.path.append(str(extension_directory))
+    yield extension_directory
+    sys.path[:] = [path for path in sys.path if path != str(extension_directory)]
+    for module_name in ["k4_test_extension", "k4_test_extension.helpers"]:
+        sys.modules.pop(module_name, None)
+
+
+def test_only_the_extensions_own_modules_are_forgotten(
+    extension_directory: Path,
+) -> None:
+    helpers = importlib.import_module("k4_test_extension.helpers")
+    assert helpers.VERSION == 1
+
+    unloaded_module_names = unload_external_plugin_modules(extension_directory)
+
+    assert sorted(unloaded_module_names) == [
+        "k4_test_extension",
+        "k4_test_extension.helpers",
+    ]
+    assert "k4_test_extension.helpers" not in sys.modules
+    assert str(extension_directory) not in sys.path
+    # imported by the extension, but not part of it
+    assert "json" in sys.modules
+
+
+def test_forgotten_modules_are_imported_afresh(extension_directory: Path) -> None:
+    importlib.import_module("k4_test_extension.helpers")
+    (extension_directory / "k4_test_extension" / "helpers.py").write_text(
+        "VERSION = 2\n"
+    )
+
+    unload_external_plugin_modules(extension_directory / "k4_test_extension")
+    sys.path.append(str(extension_directory))
+
+    assert importlib.import_module("k4_test_extension.helpers").VERSION == 2
@@ -0,0 +1,182 @@
+import asyncio
+import importlib
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from extensibles import (
+    ContextForLlm,
+    GetCompleteChatDefaultImplementation,
+    ProcessIsolatedPlugin,
+    get_complete_chat_for_llm,
+    get_hook_impl_metrics,
+    hookimpl,
+    plugin_manager,
+)
+from extensibles.get_complete_chat_for_llm import ParamsForAlreadyExistingChat
+from extensibles.hook_calls import get_plugin_name
+
+from k4 import ChatMessage
+
+# the package re-exports a function with the same name as the module
+get_complete_chat_for_llm_module = importlib.import_module(
+    "extensibles.get_complete_chat_for_llm"
+)
+
+
+class HangingImplementation:
+    @hookimpl
+    async def get_complete_chat_for_llm(
+        self,
+        new_message_from_user: str,
+        existing_chat_params: ParamsForAlreadyExistingChat | None,
+    ) -> list[ChatMessage]:
+        await asyncio.sleep(10)
+        return []
+
+
+class FailingImplementation:
+    @hookimpl
+    async def get_complete_chat_for_llm(
+        self,
+        new_message_from_user: str,
+        existing_chat_params: ParamsForAlreadyExistingChat | None,
+    ) -> list[ChatMessage]:
+        raise RuntimeError("this extension is broken")
+
+
+@pytest.fixture
+def registered_plugin_name() -> Iterator[str]:
+    plugin_name = "get_complete_chat_for_llm"
+    plugin_manager.register(GetCompleteChatDefaultImplementation(), name=plugin_name)
+    yield plugin_name
+    plugin_manager.unregister(name=plugin_name)
+
+
+def replace_plugin(plugin_name: str, plugin: object) -> None:
+    plugin_manager.unregister(name=plugin_name)
+    plugin_manager.register(plugin, name=plugin_name)
+
+
+def test_hanging_extension_falls_back_to_default(
+    registered_plugin_name: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(
+        get_complete_chat_for_llm_module, "get_extension_deadline_seconds", lambda: 0.01
+    )
+    replace_plugin(registered_plugin_name, HangingImplementation())
+    complete_chat = asyncio.run(get_complete_chat_for_llm("hello", None))
+    assert complete_chat == [ChatMessage(role="user", content="hello")]
+
+    metrics = next(
+        metrics
+        for metrics in get_hook_impl_metrics()
+        if metrics.plugin_name.endswith("HangingImplementation")
+    )
+    assert metrics.num_timeouts == 1
+    assert metrics.latency.count == 1
+
+
+def test_failing_extension_falls_back_to_default(registered_plugin_name: str) -> None:
+    replace_plugin(registered_plugin_name, FailingImplementation())
+    complete_chat = asyncio.run(get_complete_chat_for_llm("hello", None))
+    assert complete_chat == [ChatMessage(role="user", content="hello")]
+
+    metrics = next(
+        metrics
+        for metrics in get_hook_impl_metrics()
+        if metrics.plugin_name.endswith("FailingImplementation")
+    )
+    assert metrics.num_failures == 1
+
+
+class SlowContextImplementation:
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    @hookimpl
+    async def get_context_for_llm(
+        self,
+        new_message_from_user: str,
+        existing_chat_params: ParamsForAlreadyExistingChat | None,
+    ) -> ContextForLlm:
+        await asyncio.sleep(0.1)
+        return ContextForLlm(
+            system_messages=[ChatMessage(role="system", content=f"{self.name} prompt")],
+            messages_before_new_message=[
+                ChatMessage(role="user", content=f"{self.name} context")
+            ],
+        )
+
+
+def test_contexts_are_gathered_concurrently_and_merged(
+    registered_plugin_name: str,
+) -> None:
+    context_plugin_names = ["memory", "retrieval"]
+    for context_plugin_name in context_plugin_names:
+        plugin_manager.register(
+            SlowContextImplementation(context_plugin_name), name=context_plugin_name
+        )
+    try:
+        start_time = time.perf_counter()
+        complete_chat = asyncio.run(get_complete_chat_for_llm("hello", None))
+        elapsed_seconds = time.perf_counter() - start_time
+    finally:
+        for context_plugin_name in context_plugin_names:
+            plugin_manager.unregister(name=context_plugin_name)
+
+    assert elapsed_seconds < 0.2
+    assert complete_chat == [
+        ChatMessage(role="system", content="memory prompt"),
+        ChatMessage(role="system", content="retrieval prompt"),
+        ChatMessage(role="user", content="memory context"),
+        ChatMessage(role="user", content="retrieval context"),
+        ChatMessage(role="user", content="hello"),
+    ]
+
+
+class ClassRegisteredImplementation:
+    """
+    Registered as the class itself, the way in-process extensions are
+    """
+
+    @staticmethod
+    @hookimpl
+    async def get_complete_chat_for_llm(
+        new_message_from_user: str,
+        existing_chat_params: ParamsForAlreadyExistingChat | None,
+    ) -> list[ChatMessage]:
+        raise RuntimeError("this extension is broken too")
+
+
+def test_extensions_registered_as_classes_are_told_apart(
+    registered_plugin_name: str,
+) -> None:
+    replace_plugin(registered_plugin_name, ClassRegisteredImplementation)
+    complete_chat = asyncio.run(get_complete_chat_for_llm("hello", None))
+    assert complete_chat == [ChatMessage(role="user", content="hello")]
+
+    metrics = next(
+        metrics
+        for metrics in get_hook_impl_metrics()
+        if metrics.plugin_name
+        == f"{registered_plugin_name}:ClassRegisteredImplementation"
+    )
+    assert metrics.num_failures == 1
+
+
+def test_process_isolated_extensions_are_named_after_their_path(
+    registered_plugin_name: str,
+) -> None:
+    replace_plugin(
+        registered_plugin_name,
+        ProcessIsolatedPlugin(
+            "get_complete_chat_for_llm", Path("/extensions/k4-memory-extension")
+        ),
+    )
+    [hook_impl] = plugin_manager.hook.get_complete_chat_for_llm.get_hookimpls()
+    assert (
+        get_plugin_name(hook_impl)
+        == f"{registered_plugin_name}:ProcessIsolatedPlugin(k4-memory-extension)"
+    )
@@ -0,0 +1,168 @@
+import asyncio
+import textwrap
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import pytest
+from backend_commons.messages import MessageInDb
+from extensibles import ParamsForAlreadyExistingChat, ProcessIsolatedPlugin
+
+from k4 import ChatMessage
+
+EXTENSION_CODE = """
+import asyncio
+import os
+import time
+
+
+class Extension:
+    async def get_complete_chat_for_llm(self, new_message_from_user, existing_chat_params):
+        match new_message_from_user:
+            case "hang":
+                time.sleep(60)
+            case "crash":
+                os._exit(1)
+            case "slow":
+                await asyncio.sleep(0.5)
+            case "not json":
+                return [{"role": "user", "content": object()}]
+        chat_history = []
+        if existing_chat_params is not None:
+            chat_history = await existing_chat_params.get_messages_of_chat(
+                existing_chat_params.chat_id
+            )
+        return [
+            {"role": "system", "content": f"{len(chat_history)} messages before"},
+            {"role": "user", "content": new_message_from_user.upper()},
+        ]
+"""
+
+
+@pytest.fixture
+def extension_path(tmp_path: Path) -> Path:
+    extension_path = tmp_path / "get_complete_chat_for_llm.py"
+    extension_path.write_text(textwrap.dedent(EXTENSION_CODE))
+    return extension_path
+
+
+def test_the_extension_runs_in_a_worker_process(extension_path: Path) -> None:
+    async def start_and_ask() -> list[ChatMessage]:
+        plugin = ProcessIsolatedPlugin(
+            "get_complete_chat_for_llm", extension_path, num_worker_processes=1
+        )
+        await plugin.start()
+        try:
+            return await plugin.get_complete_chat_for_llm(
+                new_message_from_user="hello", existing_chat_params=None
+            )
+        finally:
+            await plugin.stop()
+
+    assert asyncio.run(start_and_ask()) == [
+        ChatMessage(role="system", content="0 messages before"),
+        ChatMessage(role="user", content="HELLO"),
+    ]
+
+
+async def ask_after(
+    plugin: ProcessIsolatedPlugin, failing_message: str
+) -> tuple[BaseException | None, list[ChatMessage]]:
+    """
+    Asks with `failing_message`, then again with a message that works
+    """
+    await plugin.start()
+    try:
+        try:
+            await plugin.get_complete_chat_for_llm(
+                new_message_from_user=failing_message, existing_chat_params=None
+            )
+        except Exception as exception:
+            failure: BaseException | None = exception
+        else:
+            failure = None
+        complete_chat = await plugin.get_complete_chat_for_llm(
+            new_message_from_user="hello", existing_chat_params=None
+        )
+    finally:
+        plugin.close()
+    return failure, complete_chat
+
+
+def test_a_hanging_worker_is_replaced(extension_path: Path) -> None:
+    plugin = ProcessIsolatedPlugin(
+        "get_complete_chat_for_llm",
+        extension_path,
+        num_worker_processes=1,
+        call_timeout_seconds=1,
+    )
+    failure, complete_chat = asyncio.run(ask_after(plugin, "hang"))
+    assert isinstance(failure, TimeoutError)
+    assert complete_chat[-1] == ChatMessage(role="user", content="HELLO")
+
+
+def test_a_crashed_worker_is_replaced(extension_path: Path) -> None:
+    plugin = ProcessIsolatedPlugin(
+        "get_complete_chat_for_llm", extension_path, num_worker_processes=1
+    )
+    failure, complete_chat = asyncio.run(ask_after(plugin, "crash"))
+    assert isinstance(failure, BrokenProcessPool)
+    assert complete_chat[-1] == ChatMessage(role="user", content="HELLO")
+
+
+def test_a_response_that_isnt_json_fails_the_call_only(extension_path: Path) -> None:
+    plugin = ProcessIsolatedPlugin(
+        "get_complete_chat_for_llm", extension_path, num_worker_processes=1
+    )
+    failure, complete_chat = asyncio.run(ask_after(plugin, "not json"))
+    assert failure is not None
+    assert not isinstance(failure, BrokenProcessPool)
+    assert complete_chat[-1] == ChatMessage(role="user", content="HELLO")
+
+
+def test_stopping_lets_the_calls_in_flight_finish(extension_path: Path) -> None:
+    async def ask_and_stop() -> list[ChatMessage]:
+        plugin = ProcessIsolatedPlugin(
+            "get_complete_chat_for_llm", extension_path, num_worker_processes=1
+        )
+        await plugin.start()
+        call_in_flight = asyncio.create_task(
+            plugin.get_complete_chat_for_llm(
+                new_message_from_user="slow", existing_chat_params=None
+            )
+        )
+        # let the call reach the worker
+        await asyncio.sleep(0.1)
+        await plugin.stop()
+        return await call_in_flight
+
+    assert asyncio.run(ask_and_stop())[-1] == ChatMessage(role="user", content="SLOW")
+
+
+def test_calls_use_the_pool_that_replaced_a_timed_out_one(extension_path: Path) -> None:
+    async def restart_while_loading_the_chat() -> list[ChatMessage]:
+        plugin = ProcessIsolatedPlugin(
+            "get_complete_chat_for_llm", extension_path, num_worker_processes=1
+        )
+        await plugin.start()
+
+        async def get_messages_of_chat(
+            chat_id: int, limit: int | None = None
+        ) -> list[MessageInDb]:
+            # as if another call timed out meanwhile
+            assert plugin._process_pool is not None
+            plugin._restart_process_pool(plugin._process_pool)
+            return []
+
+        try:
+            return await plugin.get_complete_chat_for_llm(
+                new_message_from_user="hello",
+                existing_chat_params=ParamsForAlreadyExistingChat(
+                    chat_id=1, get_messages_of_chat=get_messages_of_chat
+                ),
+            )
+        finally:
+            await plugin.stop()
+
+    assert asyncio.run(restart_while_loading_the_chat())[-1] == ChatMessage(
+        role="user", content="HELLO"
+    )
@@ -1,6 +1,11 @@
+from pathlib import Path
+
+import pytest
+from k4 import llm_provider_management
 from k4.llm_provider_management import (
     LLM_PROVIDER_INFO_BY_LLM_PROVIDER_DEFAULT,
     K4LlmProvider,
+    LlmProviderManager,
 )
 from litellm import models_by_provider
 
@@ -13,3 +18,41 @@ def test_K4LlmProvider() -> None:
 def test_llm_provider_info_dict_has_entry_for_each_K4LlmProvider() -> None:
     for llm_provider in K4LlmProvider:
         assert llm_provider in LLM_PROVIDER_INFO_BY_LLM_PROVIDER_DEFAULT
+
+
+def test_cost_is_estimated_from_the_cost_map(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(
+        llm_provider_management, "get_k4_data_directory", lambda: tmp_path
+    )
+    monkeypatch.setattr(
+        LlmProviderManager,
+        "get_model_metadata_by_model_name",
+        staticmethod(
+            lambda: {
+                "gpt-4o": {
+                    "input_cost_per_token": 2.5e-06,
+                    "output_cost_per_token": 1e-05,
+                },
+                "free-model": {"input_cost_per_token": None},
+            }
+        ),
+    )
+    llm_provider_manager = LlmProviderManager()
+
+    assert llm_provider_manager.estimate_cost_usd(
+        "gpt-4o", prompt_tokens=1000, completion_tokens=100
+    ) == pytest.approx(0.0035)
+    assert (
+        llm_provider_manager.estimate_cost_usd(
+            "free-model", prompt_tokens=1000, completion_tokens=100
+        )
+        == 0
+    )
+    assert (
+        llm_provider_manager.estimate_cost_usd(
+            "not-in-the-map", prompt_tokens=1000, completion_tokens=100
+        )
+        == 0
+    )
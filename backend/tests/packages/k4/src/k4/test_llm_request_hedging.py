@@ -0,0 +1,91 @@
+import asyncio
+from typing import AsyncGenerator, Callable
+
+import pytest
+from k4.llm_request_hedging import stream_from_first_responder
+
+
+def create_fake_stream(
+    name: str,
+    seconds_before_first_chunk: float,
+    closed_stream_names: list[str],
+    should_fail: bool = False,
+) -> Callable[[], AsyncGenerator[str, None]]:
+    async def fake_stream() -> AsyncGenerator[str, None]:
+        try:
+            await asyncio.sleep(seconds_before_first_chunk)
+            if should_fail:
+                raise ConnectionError(f"{name} failed")
+            yield f"{name}: first"
+            yield f"{name}: second"
+        finally:
+            closed_stream_names.append(name)
+
+    return fake_stream
+
+
+def collect_chunks(
+    open_streams: list[Callable[[], AsyncGenerator[str, None]]],
+    hedge_after_seconds: float | None,
+) -> list[str]:
+    async def _collect_chunks() -> list[str]:
+        return [
+            chunk
+            async for chunk in stream_from_first_responder(
+                open_streams, hedge_after_seconds=hedge_after_seconds
+            )
+        ]
+
+    return asyncio.run(_collect_chunks())
+
+
+def test_stalled_primary_is_hedged_and_cancelled() -> None:
+    closed_stream_names: list[str] = []
+    chunks = collect_chunks(
+        [
+            create_fake_stream("primary", 10, closed_stream_names),
+            create_fake_stream("secondary", 0, closed_stream_names),
+        ],
+        hedge_after_seconds=0.01,
+    )
+    assert chunks == ["secondary: first", "secondary: second"]
+    assert sorted(closed_stream_names) == ["primary", "secondary"]
+
+
+def test_fast_primary_is_not_hedged() -> None:
+    closed_stream_names: list[str] = []
+    chunks = collect_chunks(
+        [
+            create_fake_stream("primary", 0, closed_stream_names),
+            create_fake_stream("secondary", 0, closed_stream_names),
+        ],
+        hedge_after_seconds=1,
+    )
+    assert chunks == ["primary: first", "primary: second"]
+    assert closed_stream_names == ["primary"]
+
+
+def test_falls_back_on_failure() -> None:
+    closed_stream_names: list[str] = []
+    chunks = collect_chunks(
+        [
+            create_fake_stream("primary", 0, closed_stream_names, should_fail=True),
+            create_fake_stream("secondary", 0, closed_stream_names),
+        ],
+        hedge_after_seconds=None,
+    )
+    assert chunks == ["secondary: first", "secondary: second"]
+
+
+def test_raises_when_every_stream_fails() -> None:
+    closed_stream_names: list[str] = []
+    with pytest.raises(ConnectionError):
+        collect_chunks(
+            [
+                create_fake_stream("primary", 0, closed_stream_names, should_fail=True),
+                create_fake_stream(
+                    "secondary", 0, closed_stream_names, should_fail=True
+                ),
+            ],
+            hedge_after_seconds=None,
+        )
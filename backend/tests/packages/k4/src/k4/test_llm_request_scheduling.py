@@ -0,0 +1,85 @@
+import asyncio
+from typing import AsyncIterator
+
+from k4.llm_provider_management import K4LlmProvider, LlmRequestLimits
+from k4.llm_request_scheduling import (
+    LlmRequestRetryPolicy,
+    LlmRequestScheduler,
+    is_retryable_llm_error,
+)
+
+
+class FakeLlmError(Exception):
+    def __init__(self, status_code: int) -> None:
+        self.status_code = status_code
+
+
+def test_is_retryable_llm_error() -> None:
+    assert is_retryable_llm_error(FakeLlmError(429))
+    assert is_retryable_llm_error(FakeLlmError(503))
+    assert not is_retryable_llm_error(FakeLlmError(400))
+    assert not is_retryable_llm_error(ValueError())
+
+
+def test_queue_is_fair_across_users() -> None:
+    scheduler = LlmRequestScheduler(
+        get_limits=lambda llm_provider, model: LlmRequestLimits(
+            max_concurrent_requests=1 if model is None else None
+        )
+    )
+    served_user_ids: list[int] = []
+
+    async def make_request(user_id: int) -> None:
+        async with scheduler.reserve(
+            K4LlmProvider.OPENAI, "gpt-4o", user_id, count_tokens=lambda: 1
+        ):
+            served_user_ids.append(user_id)
+            await asyncio.sleep(0.01)
+
+    async def make_requests() -> None:
+        # user 1 floods the queue before user 2 shows up
+        tasks = [asyncio.create_task(make_request(1)) for _ in range(4)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(make_request(2)))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(make_requests())
+    assert served_user_ids == [1, 1, 2, 1, 1]
+
+    provider_metrics = next(
+        metrics for metrics in scheduler.get_metrics() if metrics.model is None
+    )
+    assert provider_metrics.num_in_flight == 0
+    assert provider_metrics.num_queued == 0
+    assert provider_metrics.wait_time.count == 5
+
+
+def test_open_stream_with_retries_retries_before_the_first_chunk() -> None:
+    scheduler = LlmRequestScheduler(
+        get_limits=lambda llm_provider, model: LlmRequestLimits(),
+        retry_policy=LlmRequestRetryPolicy(base_delay_seconds=0),
+    )
+    num_attempts = 0
+
+    async def open_stream() -> AsyncIterator[str]:
+        nonlocal num_attempts
+        num_attempts += 1
+        if num_attempts == 1:
+            raise FakeLlmError(429)
+
+        async def stream() -> AsyncIterator[str]:
+            yield "hello"
+            yield "world"
+
+        return stream()
+
+    async def collect_chunks() -> list[str]:
+        return [
+            chunk
+            async for chunk in scheduler.open_stream_with_retries(
+                K4LlmProvider.OPENAI, "gpt-4o", open_stream
+            )
+        ]
+
+    assert asyncio.run(collect_chunks()) == ["hello", "world"]
+    assert num_attempts == 2
@@ -0,0 +1,51 @@
+import json
+import logging
+import queue
+
+from k4_logger import lazy, reset_request_id, set_request_id
+from k4_logger.json_lines_logging import (
+    JsonLinesFormatter,
+    SamplingFilter,
+    UnformattedQueueHandler,
+)
+from k4_logger.request_ids import RequestIdFilter
+
+
+def test_records_are_formatted_by_the_listener() -> None:
+    num_formats = 0
+
+    def expensive() -> str:
+        nonlocal num_formats
+        num_formats += 1
+        return "details"
+
+    log_records: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    queue_handler = UnformattedQueueHandler(log_records)
+    queue_handler.addFilter(RequestIdFilter())
+    logger = logging.getLogger("test_json_lines_logging")
+    logger.propagate = False
+    logger.addHandler(queue_handler)
+
+    token = set_request_id("abc")
+    try:
+        logger.info("Something happened. %s", lazy(expensive), extra={"user_id": 1})
+    finally:
+        reset_request_id(token)
+    record = log_records.get_nowait()
+    assert num_formats == 0
+
+    assert json.loads(JsonLinesFormatter().format(record)) | {"timestamp": None} == {
+        "timestamp": None,
+        "level": "INFO",
+        "logger": "test_json_lines_logging",
+        "message": "Something happened. details",
+        "request_id": "abc",
+        "user_id": 1,
+    }
+    assert num_formats == 1
+
+
+def test_warnings_are_never_sampled_out() -> None:
+    sampling_filter = SamplingFilter(sample_rate=0)
+    assert not sampling_filter.filter(logging.makeLogRecord({"levelno": logging.INFO}))
+    assert sampling_filter.filter(logging.makeLogRecord({"levelno": logging.WARNING}))
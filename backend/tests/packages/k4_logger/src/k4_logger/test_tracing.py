@@ -0,0 +1,152 @@
+import asyncio
+import json
+from pathlib import Path
+from typing import AsyncGenerator
+
+import pytest
+from k4_logger import detached_span, get_current_span, span, trace, tracing
+from k4_logger.tracing import InMemoryTraceExporter, NdjsonFileTraceExporter
+
+
+@pytest.fixture
+def in_memory_traces(monkeypatch: pytest.MonkeyPatch) -> InMemoryTraceExporter:
+    in_memory_traces = InMemoryTraceExporter(max_num_traces=2)
+    monkeypatch.setattr(tracing, "_trace_exporters", [in_memory_traces])
+    return in_memory_traces
+
+
+def test_spans_nest_within_their_trace(
+    in_memory_traces: InMemoryTraceExporter,
+) -> None:
+    with trace("POST /message", request_id="abc") as request_span:
+        with span("auth"):
+            pass
+        with span("get complete chat for llm") as complete_chat_span:
+            with span("postgres MessagesManager"):
+                pass
+            complete_chat_span.set_attribute("num_messages", 3)
+        with pytest.raises(ValueError):
+            with span("validation"):
+                raise ValueError("too many tokens")
+        assert get_current_span() is request_span
+    assert get_current_span() is None
+
+    [request_trace] = in_memory_traces.get_traces()
+    assert request_trace.name == "POST /message"
+    spans_by_name = {
+        finished_span.name: finished_span for finished_span in request_trace.spans
+    }
+    assert list(spans_by_name) == [
+        "POST /message",
+        "auth",
+        "get complete chat for llm",
+        "postgres MessagesManager",
+        "validation",
+    ]
+    assert spans_by_name["POST /message"].parent_span_id is None
+    assert spans_by_name["POST /message"].attributes == {"request_id": "abc"}
+    assert (
+        spans_by_name["postgres MessagesManager"].parent_span_id
+        == spans_by_name["get complete chat for llm"].span_id
+    )
+    assert spans_by_name["get complete chat for llm"].attributes == {"num_messages": 3}
+    assert spans_by_name["validation"].status == "error"
+    assert spans_by_name["auth"].status == "ok"
+
+
+def test_spans_outside_of_a_trace_are_not_recorded(
+    in_memory_traces: InMemoryTraceExporter,
+) -> None:
+    with span("auth") as auth_span:
+        auth_span.set_attribute("user_id", 1)
+        assert not auth_span.is_recording
+        assert get_current_span() is None
+    assert in_memory_traces.get_traces() == []
+
+
+def test_spans_of_tasks_outliving_the_request_are_part_of_its_trace(
+    in_memory_traces: InMemoryTraceExporter,
+) -> None:
+    async def generate_response() -> None:
+        with span("generate response"):
+            await asyncio.sleep(0.01)
+
+    async def handle_request() -> asyncio.Task[None]:
+        with trace("POST /chat"):
+            return asyncio.create_task(generate_response())
+
+    async def main() -> None:
+        generation_task = await handle_request()
+        # the request's span is exported without waiting for the response
+        assert [
+            finished_span.name
+            for finished_span in in_memory_traces.get_traces()[0].spans
+        ] == ["POST /chat"]
+        await generation_task
+
+    asyncio.run(main())
+    [request_trace] = in_memory_traces.get_traces()
+    assert [finished_span.name for finished_span in request_trace.spans] == [
+        "POST /chat",
+        "generate response",
+    ]
+    assert request_trace.duration_seconds >= 0.01
+
+
+def test_only_the_latest_traces_are_kept_in_memory(
+    in_memory_traces: InMemoryTraceExporter,
+) -> None:
+    for request_index in range(3):
+        with trace(f"GET /chat {request_index}"):
+            pass
+    assert [request_trace.name for request_trace in in_memory_traces.get_traces()] == [
+        "GET /chat 2",
+        "GET /chat 1",
+    ]
+
+
+def test_spans_are_written_as_json_lines(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    traces_file_path = tmp_path / "traces" / "traces.ndjson"
+    ndjson_exporter = NdjsonFileTraceExporter(traces_file_path)
+    monkeypatch.setattr(tracing, "_trace_exporters", [ndjson_exporter])
+    with trace("GET /chat_previews"):
+        with span("auth"):
+            pass
+    ndjson_exporter.stop()
+
+    written_spans = [
+        json.loads(line) for line in traces_file_path.read_text().splitlines()
+    ]
+    assert [written_span["name"] for written_span in written_spans] == [
+        "auth",
+        "GET /chat_previews",
+    ]
+    assert written_spans[0]["trace_id"] == written_spans[1]["trace_id"]
+
+
+def test_a_suspended_generator_doesnt_capture_its_consumers_spans(
+    in_memory_traces: InMemoryTraceExporter,
+) -> None:
+    async def stream_response() -> AsyncGenerator[str, None]:
+        with detached_span("stream response"):
+            for token in ["hello", "world"]:
+                yield token
+
+    async def handle_request() -> None:
+        with trace("POST /message"):
+            async for _ in stream_response():
+                with span("send chunk"):
+                    pass
+
+    asyncio.run(handle_request())
+    [request_trace] = in_memory_traces.get_traces()
+    spans_by_name = {
+        finished_span.name: finished_span for finished_span in request_trace.spans
+    }
+    for span_name in ["stream response", "send chunk"]:
+        assert (
+            spans_by_name[span_name].parent_span_id
+            == spans_by_name["POST /message"].span_id
+        )
@@ -0,0 +1,53 @@
+import asyncio
+import operator
+import time
+
+from utils import biter
+
+
+def test_chunked() -> None:
+    assert list(biter(range(5)).chunked(2)) == [(0, 1), (2, 3), (4,)]
+
+
+def test_map_async_bounds_concurrency() -> None:
+    num_in_flight = 0
+    max_num_in_flight = 0
+
+    async def slow_double(value: int) -> int:
+        nonlocal num_in_flight, max_num_in_flight
+        num_in_flight += 1
+        max_num_in_flight = max(max_num_in_flight, num_in_flight)
+        # the first values take the longest
+        await asyncio.sleep(0.01 * (10 - value))
+        num_in_flight -= 1
+        return value * 2
+
+    async def collect(ordered: bool) -> list[int]:
+        return [
+            result
+            async for result in biter(range(10)).map_async(
+                slow_double, max_concurrency=3, ordered=ordered
+            )
+        ]
+
+    assert asyncio.run(collect(ordered=True)) == [value * 2 for value in range(10)]
+    assert max_num_in_flight == 3
+    unordered_results = asyncio.run(collect(ordered=False))
+    assert sorted(unordered_results) == [value * 2 for value in range(10)]
+    assert unordered_results != sorted(unordered_results)
+
+
+def test_parallel_map() -> None:
+    def slow_negate(value: int) -> int:
+        time.sleep(0.01 * (10 - value))
+        return -value
+
+    assert list(biter(range(10)).parallel_map(slow_negate, max_workers=4)) == [
+        -value for value in range(10)
+    ]
+    assert sorted(
+        biter(range(10)).parallel_map(slow_negate, max_workers=4, ordered=False)
+    ) == sorted(-value for value in range(10))
+    assert list(
+        biter(range(10)).parallel_map(operator.neg, max_workers=2, use_processes=True)
+    ) == [-value for value in range(10)]
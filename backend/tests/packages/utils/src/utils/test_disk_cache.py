@@ -0,0 +1,44 @@
+from pathlib import Path
+
+from utils.disk_cache import TypedDiskCache
+
+
+def test_bulk_reads_and_writes(tmp_path: Path) -> None:
+    cache = TypedDiskCache[str, int](directory=tmp_path, statistics=True)
+    cache.set_many((str(number), number) for number in range(2500))
+    cache.set("expired", -1, expire=-1)
+
+    assert cache.create_dict() == {str(number): number for number in range(2500)}
+    assert cache.get_many(["1", "2", "missing", "expired"]) == {"1": 1, "2": 2}
+    stats = cache.get_stats()
+    assert (stats.hits, stats.misses) == (2, 2)
+    # reading the expired item deleted it
+    assert cache.get_size_report().num_items == 2500
+
+
+def test_evictions_are_counted(tmp_path: Path) -> None:
+    cache = TypedDiskCache[int, bytes](
+        directory=tmp_path, size_limit=0, cull_limit=10, statistics=True
+    )
+    for key in range(20):
+        cache[key] = b"x" * 1000
+    assert cache.get_stats().evictions > 0
+    assert len(cache) < 20
+
+
+def test_removing_expired_items_isnt_counted_as_evicting(tmp_path: Path) -> None:
+    cache = TypedDiskCache[int, int](directory=tmp_path, cull_limit=10)
+    for key in range(5):
+        cache.set(key, key, expire=-1)
+    # culls the expired items, but the cache is far from full
+    cache[5] = 5
+    assert list(cache.keys()) == [5]
+    assert cache.get_stats().evictions == 0
+
+
+def test_reading_the_stats_doesnt_start_counting_hits(tmp_path: Path) -> None:
+    cache = TypedDiskCache[int, int](directory=tmp_path)
+    cache[1] = 1
+    cache.get_stats()
+    cache.get(1)
+    assert (cache.get_stats().hits, cache.statistics) == (0, 0)
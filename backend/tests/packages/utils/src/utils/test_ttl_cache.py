@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import time
+
+from utils.ttl_cache import ttl_cache
+
+
+def test_concurrent_async_misses_share_one_call() -> None:
+    num_calls = 0
+
+    @ttl_cache(max_age_seconds=60)
+    async def double(value: int) -> int:
+        nonlocal num_calls
+        num_calls += 1
+        await asyncio.sleep(0.01)
+        return value * 2
+
+    async def call_concurrently() -> list[int]:
+        return await asyncio.gather(*(double(2) for _ in range(10)), double(3))
+
+    assert asyncio.run(call_concurrently()) == [4] * 10 + [6]
+    assert num_calls == 2
+    stats = double.get_stats()
+    assert (stats.hits, stats.misses, stats.size) == (0, 11, 2)
+
+
+def test_concurrent_sync_misses_share_one_call() -> None:
+    num_calls = 0
+    results: list[int] = []
+
+    @ttl_cache(max_age_seconds=60)
+    def get_value() -> int:
+        nonlocal num_calls
+        num_calls += 1
+        time.sleep(0.05)
+        return 1
+
+    threads = [
+        threading.Thread(target=lambda: results.append(get_value())) for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [1] * 5
+    assert num_calls == 1
+    assert get_value() == 1
+    assert get_value.get_stats().hits == 1
+
+
+def test_stale_values_are_served_while_refreshed() -> None:
+    values = iter([1, 2])
+
+    @ttl_cache(max_age_seconds=0.05, stale_while_revalidate_seconds=60)
+    async def get_value() -> int:
+        return next(values)
+
+    async def call_until_refreshed() -> list[int]:
+        results = [await get_value()]
+        await asyncio.sleep(0.1)
+        results.append(await get_value())
+        # let the background refresh run
+        await asyncio.sleep(0)
+        results.append(await get_value())
+        return results
+
+    assert asyncio.run(call_until_refreshed()) == [1, 1, 2]
+    assert get_value.get_stats().stale_hits == 1
+
+
+def test_least_recently_used_values_are_evicted() -> None:
+    @ttl_cache(max_age_seconds=60, max_size=2)
+    def identity(value: int) -> int:
+        return value
+
+    identity(1)
+    identity(2)
+    identity(1)
+    identity(3)
+    stats = identity.get_stats()
+    assert (stats.evictions, stats.size) == (1, 2)
+    identity(1)
+    assert identity.get_stats().hits == 2
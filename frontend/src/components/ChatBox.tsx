@@ -6,10 +6,13 @@ import {
     Chat,
     LlmStreamingStart,
     LlmStreamingChunk,
+    LlmStreamingEnd,
+    ChatStreamError,
     ChatInDb,
 } from "../model/Chat";
 import { User } from "../model/User";
 import ReactMarkdown from "react-markdown";
+import { readServerSentEvents } from "../utils/serverSentEvents";
 
 interface MessageInDb {
     message_id: number;
@@ -162,149 +165,77 @@ function ChatBox({
                 }
             } else {
                 setTextAreaValue("");
-                const reader = response.body!.getReader();
-                const decoder = new TextDecoder();
-
                 let response_message_so_far = "";
-                while (true) {
-                    const { done, value } = await reader.read();
-                    if (done) {
-                        setChatPreviews((existingChatPreviews) => {
-                            return existingChatPreviews.map(
-                                (existingChatPreview) => {
-                                    if (
-                                        chatId &&
-                                        existingChatPreview.chat_in_db
-                                            .chat_id === chatId
-                                    ) {
-                                        const updatedChatPreview = {
-                                            ...existingChatPreview,
-                                            most_recent_message_in_db: {
-                                                ...existingChatPreview.most_recent_message_in_db,
-                                                text: response_message_so_far,
-                                            },
-                                        };
-                                        return updatedChatPreview;
-                                    } else {
-                                        return existingChatPreview;
-                                    }
-                                }
-                            );
-                        });
-                        break;
-                    }
-
-                    const chunk = decoder.decode(value, { stream: true });
-                    const lines = chunk.split("\n").filter(Boolean);
-
-                    for (const line of lines) {
-                        const parsedLine:
-                            | MessageInDb
-                            | LlmStreamingStart
-                            | LlmStreamingChunk = JSON.parse(line);
-                        if ("message_id" in parsedLine) {
-                            // received part 1 of 3: the message we sent. This includes the
-                            // chat_id of the (potentially new) chat.
-                            const userMessage = parsedLine;
-                            chatId = userMessage.chat_id;
+                for await (const serverSentEvent of readServerSentEvents(
+                    response,
+                    new URL("/chat/stream", server.url).toString()
+                )) {
+                    const parsedLine:
+                        | MessageInDb
+                        | LlmStreamingStart
+                        | LlmStreamingChunk
+                        | LlmStreamingEnd
+                        | ChatStreamError = JSON.parse(
+                        serverSentEvent.data
+                    );
+                    if ("message_id" in parsedLine) {
+                        // received part 1 of 3: the message we sent. This includes the
+                        // chat_id of the (potentially new) chat.
+                        const userMessage = parsedLine;
+                        chatId = userMessage.chat_id;
 
-                            if (isNewChat) {
-                                const newChatInDb: ChatInDb = {
-                                    chat_id: userMessage.chat_id,
-                                    is_archived: false,
-                                    last_message_timestamp:
-                                        userMessage.inserted_at,
-                                    title: "",
-                                    user_id: user.user_id,
-                                };
-                                setChats((existingChats) => {
-                                    return {
-                                        ...existingChats,
-                                        [userMessage.chat_id]: {
-                                            chat_in_db: newChatInDb,
-                                            messages: [userMessage],
-                                        },
-                                    };
-                                });
-                                const newChatPreview: ChatPreview = {
-                                    chat_in_db: newChatInDb,
-                                    most_recent_message_in_db: userMessage,
+                        if (isNewChat) {
+                            const newChatInDb: ChatInDb = {
+                                chat_id: userMessage.chat_id,
+                                is_archived: false,
+                                last_message_timestamp:
+                                    userMessage.inserted_at,
+                                title: "",
+                                user_id: user.user_id,
+                            };
+                            setChats((existingChats) => {
+                                return {
+                                    ...existingChats,
+                                    [userMessage.chat_id]: {
+                                        chat_in_db: newChatInDb,
+                                        messages: [userMessage],
+                                    },
                                 };
-                                setChatPreviews(
-                                    (currentChatPreviews: ChatPreview[]) => {
-                                        return [
-                                            newChatPreview,
-                                            ...currentChatPreviews,
-                                        ];
-                                    }
-                                );
-                                setSelectedChatPreview(newChatPreview);
-                            } else {
-                                setChats((existingChats) => {
-                                    const updatedChats = { ...existingChats };
-                                    const chatMessages = [
-                                        ...updatedChats[userMessage.chat_id]!
-                                            .messages,
+                            });
+                            const newChatPreview: ChatPreview = {
+                                chat_in_db: newChatInDb,
+                                most_recent_message_in_db: userMessage,
+                            };
+                            setChatPreviews(
+                                (currentChatPreviews: ChatPreview[]) => {
+                                    return [
+                                        newChatPreview,
+                                        ...currentChatPreviews,
                                     ];
-
-                                    if (
-                                        !chatMessages.some(
-                                            (msg) =>
-                                                msg.message_id ===
-                                                userMessage.message_id
-                                        )
-                                    ) {
-                                        // Prevent duplicate messages
-                                        chatMessages.push(userMessage);
-                                    }
-
-                                    updatedChats[userMessage.chat_id] = {
-                                        ...updatedChats[userMessage.chat_id],
-                                        messages: chatMessages,
-                                    };
-                                    return updatedChats;
-                                });
-                                setChatPreviews((existingChatPreviews) => {
-                                    return existingChatPreviews.map(
-                                        (existingChatPreview) => {
-                                            if (
-                                                existingChatPreview.chat_in_db
-                                                    .chat_id ===
-                                                parsedLine.chat_id
-                                            ) {
-                                                const updatedChatPreview = {
-                                                    ...existingChatPreview,
-                                                    most_recent_message_in_db: {
-                                                        ...existingChatPreview.most_recent_message_in_db,
-                                                        text: parsedLine.text,
-                                                    },
-                                                };
-                                                return updatedChatPreview;
-                                            } else {
-                                                return existingChatPreview;
-                                            }
-                                        }
-                                    );
-                                });
-                            }
-                        } else if (parsedLine.chunk_type == "msg_start") {
+                                }
+                            );
+                            setSelectedChatPreview(newChatPreview);
+                        } else {
                             setChats((existingChats) => {
                                 const updatedChats = { ...existingChats };
                                 const chatMessages = [
-                                    ...(updatedChats[parsedLine.chat_id]
-                                        ?.messages || []),
+                                    ...updatedChats[userMessage.chat_id]!
+                                        .messages,
                                 ];
 
-                                chatMessages.push({
-                                    message_id: -1,
-                                    user_id: null,
-                                    chat_id: parsedLine.chat_id,
-                                    inserted_at: "",
-                                    text: "",
-                                });
+                                if (
+                                    !chatMessages.some(
+                                        (msg) =>
+                                            msg.message_id ===
+                                            userMessage.message_id
+                                    )
+                                ) {
+                                    // Prevent duplicate messages
+                                    chatMessages.push(userMessage);
+                                }
 
-                                updatedChats[parsedLine.chat_id] = {
-                                    ...updatedChats[parsedLine.chat_id],
+                                updatedChats[userMessage.chat_id] = {
+                                    ...updatedChats[userMessage.chat_id],
                                     messages: chatMessages,
                                 };
                                 return updatedChats;
@@ -314,13 +245,14 @@ function ChatBox({
                                     (existingChatPreview) => {
                                         if (
                                             existingChatPreview.chat_in_db
-                                                .chat_id === parsedLine.chat_id
+                                                .chat_id ===
+                                            parsedLine.chat_id
                                         ) {
                                             const updatedChatPreview = {
                                                 ...existingChatPreview,
                                                 most_recent_message_in_db: {
                                                     ...existingChatPreview.most_recent_message_in_db,
-                                                    text: "...response started...",
+                                                    text: parsedLine.text,
                                                 },
                                             };
                                             return updatedChatPreview;
@@ -330,58 +262,130 @@ function ChatBox({
                                     }
                                 );
                             });
-                        } else {
-                            setChats((existingChats) => {
-                                const chat = existingChats[parsedLine.chat_id];
-                                const updatedMessages = chat.messages.map(
-                                    (message, index) => {
-                                        if (
-                                            index ===
-                                            chat.messages.length - 1
-                                        ) {
-                                            response_message_so_far =
-                                                message.text + parsedLine.chunk;
-                                            return {
-                                                ...message,
-                                                text: response_message_so_far,
-                                            };
-                                        }
-                                        return message;
-                                    }
-                                );
+                        }
+                    } else if (parsedLine.chunk_type == "msg_start") {
+                        setChats((existingChats) => {
+                            const updatedChats = { ...existingChats };
+                            const chatMessages = [
+                                ...(updatedChats[parsedLine.chat_id]
+                                    ?.messages || []),
+                            ];
 
-                                return {
-                                    ...existingChats,
-                                    [parsedLine.chat_id]: {
-                                        ...chat,
-                                        messages: updatedMessages,
-                                    },
-                                };
+                            chatMessages.push({
+                                message_id: -1,
+                                user_id: null,
+                                chat_id: parsedLine.chat_id,
+                                inserted_at: "",
+                                text: "",
                             });
-                            setChatPreviews((existingChatPreviews) => {
-                                return existingChatPreviews.map(
-                                    (existingChatPreview) => {
-                                        if (
-                                            existingChatPreview.chat_in_db
-                                                .chat_id === parsedLine.chat_id
-                                        ) {
-                                            const updatedChatPreview = {
-                                                ...existingChatPreview,
-                                                most_recent_message_in_db: {
-                                                    ...existingChatPreview.most_recent_message_in_db,
-                                                    text: "...response pending...",
-                                                },
-                                            };
-                                            return updatedChatPreview;
-                                        } else {
-                                            return existingChatPreview;
-                                        }
+
+                            updatedChats[parsedLine.chat_id] = {
+                                ...updatedChats[parsedLine.chat_id],
+                                messages: chatMessages,
+                            };
+                            return updatedChats;
+                        });
+                        setChatPreviews((existingChatPreviews) => {
+                            return existingChatPreviews.map(
+                                (existingChatPreview) => {
+                                    if (
+                                        existingChatPreview.chat_in_db
+                                            .chat_id === parsedLine.chat_id
+                                    ) {
+                                        const updatedChatPreview = {
+                                            ...existingChatPreview,
+                                            most_recent_message_in_db: {
+                                                ...existingChatPreview.most_recent_message_in_db,
+                                                text: "...response started...",
+                                            },
+                                        };
+                                        return updatedChatPreview;
+                                    } else {
+                                        return existingChatPreview;
                                     }
-                                );
-                            });
-                        }
+                                }
+                            );
+                        });
+                    } else if (parsedLine.chunk_type == "msg_end") {
+                        // the response is saved
+                    } else if (parsedLine.chunk_type == "error") {
+                        console.log(
+                            "unexpected issue with chat response",
+                            parsedLine
+                        );
+                    } else {
+                        setChats((existingChats) => {
+                            const chat = existingChats[parsedLine.chat_id];
+                            const updatedMessages = chat.messages.map(
+                                (message, index) => {
+                                    if (
+                                        index ===
+                                        chat.messages.length - 1
+                                    ) {
+                                        response_message_so_far =
+                                            message.text + parsedLine.chunk;
+                                        return {
+                                            ...message,
+                                            text: response_message_so_far,
+                                        };
+                                    }
+                                    return message;
+                                }
+                            );
+
+                            return {
+                                ...existingChats,
+                                [parsedLine.chat_id]: {
+                                    ...chat,
+                                    messages: updatedMessages,
+                                },
+                            };
+                        });
+                        setChatPreviews((existingChatPreviews) => {
+                            return existingChatPreviews.map(
+                                (existingChatPreview) => {
+                                    if (
+                                        existingChatPreview.chat_in_db
+                                            .chat_id === parsedLine.chat_id
+                                    ) {
+                                        const updatedChatPreview = {
+                                            ...existingChatPreview,
+                                            most_recent_message_in_db: {
+                                                ...existingChatPreview.most_recent_message_in_db,
+                                                text: "...response pending...",
+                                            },
+                                        };
+                                        return updatedChatPreview;
+                                    } else {
+                                        return existingChatPreview;
+                                    }
+                                }
+                            );
+                        });
                     }
                 }
+                setChatPreviews((existingChatPreviews) => {
+                    return existingChatPreviews.map(
+                        (existingChatPreview) => {
+                            if (
+                                chatId &&
+                                existingChatPreview.chat_in_db
+                                    .chat_id === chatId
+                            ) {
+                                const updatedChatPreview = {
+                                    ...existingChatPreview,
+                                    most_recent_message_in_db: {
+                                        ...existingChatPreview.most_recent_message_in_db,
+                                        text: response_message_so_far,
+                                    },
+                                };
+                                return updatedChatPreview;
+                            } else {
+                                return existingChatPreview;
+                            }
+                        }
+                    );
+                });
             }
             setIsInputDisabled(false);
         }
@@ -34,3 +34,14 @@ export interface LlmStreamingChunk {
     chunk_type: "text";
     chunk: string;
 }
+
+export interface LlmStreamingEnd {
+    chat_id: number;
+    chunk_type: "msg_end";
+}
+
+export interface ChatStreamError {
+    chunk_type: "error";
+    status_code: number;
+    detail: string;
+}
@@ -0,0 +1,70 @@
+export interface ServerSentEvent {
+    id: string | null;
+    data: string;
+}
+
+const MAX_RESUMES = 3;
+
+function parseServerSentEvent(rawEvent: string): ServerSentEvent {
+    let id: string | null = null;
+    const dataLines: string[] = [];
+    for (const line of rawEvent.split("\n")) {
+        if (line.startsWith("id:")) {
+            id = line.slice("id:".length).trim();
+        } else if (line.startsWith("data:")) {
+            dataLines.push(line.slice("data:".length).trimStart());
+        }
+    }
+    return { id, data: dataLines.join("\n") };
+}
+
+/**
+ * Reads the events of a `text/event-stream` response. An event can arrive split across
+ * several chunks, so whatever follows the last complete event is kept for the next
+ * chunk.
+ *
+ * If the connection drops, the server keeps generating the response, so the stream is
+ * resumed from `resumeUrl`, from after the last event we got.
+ */
+export async function* readServerSentEvents(
+    response: Response,
+    resumeUrl: string
+): AsyncGenerator<ServerSentEvent> {
+    let lastEventId: string | null = null;
+    let numResumes = 0;
+    while (true) {
+        const reader = response.body!.getReader();
+        const decoder = new TextDecoder();
+        let unparsedText = "";
+        try {
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) {
+                    return;
+                }
+                unparsedText += decoder.decode(value, { stream: true });
+                const rawEvents = unparsedText.split("\n\n");
+                unparsedText = rawEvents.pop()!;
+                for (const rawEvent of rawEvents) {
+                    const event = parseServerSentEvent(rawEvent);
+                    if (event.id !== null) {
+                        lastEventId = event.id;
+                    }
+                    yield event;
+                }
+            }
+        } catch (error) {
+            if (lastEventId === null || numResumes >= MAX_RESUMES) {
+                throw error;
+            }
+            numResumes += 1;
+            response = await fetch(resumeUrl, {
+                credentials: "include",
+                headers: { "Last-Event-ID": lastEventId },
+            });
+            if (!response.ok) {
+                throw error;
+            }
+        }
+    }
+}